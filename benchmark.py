@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# Benchmarks for the parts of MultiChat that get slower as chats get bigger.
+# Run all of them with: python benchmark.py
+# Or just some of them with: python benchmark.py backread
+# To compare two commits, save the results from one and compare the other:
+#   python benchmark.py --json before.json
+#   python benchmark.py --compare before.json
+# Make a synthetic chat folder to try things on with: python benchmark.py --generate DIR
+import argparse
+import contextlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import multiChat
+
+# Synthetic chats. Everything comes from a fixed seed, so the same
+# arguments always make the same files and runs can be compared.
+WORDS = ("the a I you we it that this is was so just like really think know "
+    "what when where why how not no yes maybe okay sure pizza coffee tea work "
+    "sleep tired today tomorrow yesterday night morning weekend game book show "
+    "music song friend cat dog home outside rain sun cold warm food dinner "
+    "lunch bed again still never always something nothing everything good bad "
+    "great weird funny sad happy love hate need want going doing said told "
+    "remember forgot lol haha hmm oh wait right well though because").split()
+ANSI_COLORS = [31, 32, 33, 34, 35, 36, 91, 92, 93, 94, 95, 96]
+CORPUS_START = date(2020, 1, 1)
+
+# Names for user_count users: Alice, Bob, ..., then Alice 2, Bob 2, ...
+def make_user_names(user_count):
+    first_names = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy", "Mallory", "Niaj", "Olivia", "Peggy", "Rupert", "Sybil", "Trent", "Victor", "Walter", "Zoe"]
+    return [first_names[number % len(first_names)] + (f" {number // len(first_names) + 1}" if number >= len(first_names) else "") for number in range(user_count)]
+
+# A user list like one loaded from /load: numbered proxies, with some
+# users given short custom proxies and colors
+def make_user_list(user_count):
+    randomizer = random.Random(1)
+    user_list = multiChat.UserRegistry()
+    for number, name in enumerate(make_user_names(user_count)):
+        proxy = name[:2].lower() + str(number) + ":" if number % 3 == 0 else None
+        user_list.add(name, proxy, randomizer.choice(multiChat.COLOR_LIST) if number % 2 == 0 else "default")
+    return user_list
+
+def random_sentence(randomizer):
+    return " ".join(randomizer.choices(WORDS, k=randomizer.randint(2, 24))).capitalize()
+
+# Write a chat log that looks like years of use: sessions on different
+# days, a few people talking in each, colored prefaces for some of
+# them, and the dice rolls, quotes and emotes MultiChat writes.
+# Returns the user names used.
+def make_log(path, line_count, user_count=50, seed=0):
+    randomizer = random.Random(seed)
+    names = make_user_names(user_count)
+    colors = {name: randomizer.choice(ANSI_COLORS) for name in names[::2]}
+    day = CORPUS_START
+    lines_written = 0
+    with open(path, "w", encoding="utf-8") as log_file:
+        while lines_written < line_count:
+            chunk = [f"-----{day.strftime(multiChat.SESSION_DATE_FORMAT)}-----\n\n"]
+            speakers = randomizer.sample(names, min(len(names), randomizer.randint(2, 8)))
+            moment = datetime.combine(day, datetime.min.time()) + timedelta(hours=randomizer.randint(8, 22))
+            for _ in range(min(randomizer.randint(20, 400), line_count - lines_written)):
+                speaker = randomizer.choice(speakers)
+                moment += timedelta(seconds=randomizer.randint(1, 120))
+                preface = f"{speaker}, {moment.strftime('%H:%M:%S')}: "
+                if speaker in colors:
+                    preface = f"\x1b[{colors[speaker]}m{preface}\x1b[0m"
+                kind = randomizer.random()
+                if kind < 0.03:
+                    sides = randomizer.choice([6, 20, 100])
+                    chunk.append(f"{speaker} rolled a {sides}-sided die and rolled a {randomizer.randint(1, sides)}!\n")
+                elif kind < 0.04:
+                    chunk.append(f'{speaker} added: "{random_sentence(randomizer)}" to the quotes!\n')
+                elif kind < 0.05:
+                    chunk.append(preface + "/quote\n")
+                    chunk.append(f"MultiChat: On {day.strftime(multiChat.SESSION_DATE_FORMAT)}, {randomizer.choice(names)} said: {random_sentence(randomizer)}\n")
+                elif kind < 0.07:
+                    chunk.append(preface + randomizer.choice(["(╯°□°）╯︵ ┻━┻", "👍", "Eyes emoji"]) + "\n")
+                else:
+                    chunk.append(preface + random_sentence(randomizer) + "\n")
+                lines_written += 1
+            chunk.append("\n\n")
+            log_file.write("".join(chunk))
+            day += timedelta(days=randomizer.choice([1, 1, 1, 2, 3, 7, 30]))
+    return names
+
+# Write a quotes file with quote_count quotes from user_count users
+def make_quotes(path, quote_count, user_count=50, seed=0):
+    randomizer = random.Random(seed)
+    names = make_user_names(user_count)
+    with open(path, "w", encoding="utf-8") as quote_file:
+        for number in range(quote_count):
+            day = CORPUS_START + timedelta(days=number // 10)
+            quote_file.write(f"On {day.strftime(multiChat.SESSION_DATE_FORMAT)}, {randomizer.choice(names)} said: {random_sentence(randomizer)}\n")
+
+# A whole chat folder: a big chat, a few smaller ones, a quotes file,
+# and saved users
+def make_corpus(directory, line_count, user_count=50):
+    import pickle
+    os.makedirs(directory, exist_ok=True)
+    make_log(os.path.join(directory, "chat.txt"), line_count, user_count)
+    for number in range(3):
+        make_log(os.path.join(directory, f"side-chat-{number + 1}.txt"), line_count // 20, max(2, user_count // 10), seed=number + 1)
+    make_quotes(os.path.join(directory, "quotes.txt"), max(100, line_count // 100), user_count)
+    with open(os.path.join(directory, "saved-users.pkl"), "wb") as savefile:
+        pickle.dump(make_user_list(user_count).to_dict(), savefile)
+
+# Results from this run, for --json and --compare
+RESULTS = []
+
+# Record a measurement and print text about it, if given.
+# better is "higher" or "lower".
+def report(benchmark, metric, value, unit, better, text=None):
+    RESULTS.append({"benchmark": benchmark, "metric": metric, "value": value, "unit": unit, "better": better})
+    if text is not None:
+        print(text)
+
+# Time a function, keeping the best of a few runs
+def best_time(function, repeats=5):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Startup backread: should stay flat as the log grows
+def bench_backread(workdir, args):
+    backread_linecount = 100
+    for line_count in [args.lines // 100, args.lines // 10, args.lines]:
+        path = os.path.join(workdir, f"backread-{line_count}.txt")
+        make_log(path, line_count, args.users)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        tail = best_time(lambda: multiChat.tail_log(path, backread_linecount))
+        def read_everything():
+            with open(path, "r", encoding="utf-8") as log_file:
+                log_file.readlines()[-backread_linecount:]
+        readlines = best_time(read_everything)
+        report("backread", f"tail_log_{line_count}_lines", tail * 1000, "ms", "lower", f"backread {line_count:>9} lines ({size_mb:7.1f} MB): tail_log {tail * 1000:8.3f} ms, readlines {readlines * 1000:8.3f} ms")
+    # Painting a big backread: a print() per line, the way it used to be,
+    # against rendering it all (with colors) and printing once. Printed to
+    # a pseudo-terminal where there is one, since that's where the cost of
+    # each separate write shows up.
+    paint_count = 10_000
+    lines = multiChat.tail_log(path, paint_count)
+    user_list = make_user_list(args.users)
+    with open_terminal() as terminal, contextlib.redirect_stdout(terminal):
+        # Colors are only used when printing to a terminal
+        multiChat.COLOR_CODES.clear()
+        def print_each():
+            for line in lines:
+                print(line, end="")
+        per_line = best_time(print_each)
+        batched = best_time(lambda: print(multiChat.render_log_lines(lines, user_list), end=""))
+    multiChat.COLOR_CODES.clear()
+    report("backread", f"paint_{paint_count}_lines", batched * 1000, "ms", "lower", f"backread paint {paint_count} lines: per-line print {per_line * 1000:8.3f} ms, colored and batched {batched * 1000:8.3f} ms")
+
+# A line buffered text file that acts like a terminal: a pseudo-terminal
+# with a thread reading everything written to it, or os.devnull where
+# there are no pseudo-terminals
+@contextlib.contextmanager
+def open_terminal():
+    if not hasattr(os, "openpty"):
+        with open(os.devnull, "w", buffering=1, encoding="utf-8") as terminal:
+            yield terminal
+        return
+    import threading
+    reader, writer = os.openpty()
+    def read_everything():
+        try:
+            while os.read(reader, 65536):
+                pass
+        except OSError:
+            pass
+    thread = threading.Thread(target=read_everything, daemon=True)
+    thread.start()
+    try:
+        with open(writer, "w", buffering=1, encoding="utf-8") as terminal:
+            yield terminal
+    finally:
+        os.close(reader)
+
+# Message write throughput for each log durability mode
+def bench_log_writes(workdir, args):
+    message_count = 2000
+    for mode in multiChat.LOG_DURABILITY_MODES:
+        path = os.path.join(workdir, f"writes-{mode}.txt")
+        with open(path, "w") as log_file:
+            log_writer = multiChat.LogWriter(log_file, mode)
+            start = time.perf_counter()
+            for number in range(message_count):
+                log_writer.write(f"User {number % 7}, 12:00:00: This is test message number {number}.\n")
+            log_writer.finish()
+            elapsed = time.perf_counter() - start
+        report("writes", mode, message_count / elapsed, "messages/s", "higher", f"log writes {mode:>5}: {message_count / elapsed:12,.0f} messages/s")
+
+# Command lookup: how long it takes to work out what handles a message.
+# Most messages are plain chat, so that case matters most.
+def bench_dispatch(workdir, args):
+    message_count = 100_000
+    messages = [f"This is test message number {number}." for number in range(16)]
+    messages += ["/dice 20", "/search pizza", "/commands", "tableflip", "I say thumbsup", "/unknown thing"]
+    for label, sample in [("plain", messages[:16]), ("mixed", messages)]:
+        batch = (sample * (message_count // len(sample) + 1))[:message_count]
+        def dispatch_all():
+            for message in batch:
+                multiChat.find_handler(message)
+        elapsed = best_time(dispatch_all)
+        report("dispatch", label, elapsed / message_count * 1e9, "ns/message", "lower", f"dispatch {label:>5}: {elapsed / message_count * 1e9:8.0f} ns/message ({len(multiChat.COMMANDS)} commands registered)")
+
+# Switch detection: every message is checked against the user list
+# before anything else. Should cost the same with 10 users or 100,000.
+def bench_switch(workdir, args):
+    message_count = 100_000
+    for user_count in [10, 1_000, 100_000]:
+        user_list = make_user_list(user_count)
+        proxies = [user.proxy for user in user_list]
+        randomizer = random.Random(2)
+        # Mostly ordinary messages, with a switch every now and then
+        messages = [randomizer.choice(proxies) if number % 10 == 0 else random_sentence(randomizer) for number in range(1000)]
+        batch = (messages * (message_count // len(messages) + 1))[:message_count]
+        for case_sensitivity in [True, False]:
+            def check_all():
+                for message in batch:
+                    user_list.find_switch(message, case_sensitivity)
+            elapsed = best_time(check_all)
+            label = "case-sensitive" if case_sensitivity else "any case"
+            report("switch", f"{user_count}_users_{'exact' if case_sensitivity else 'casefold'}", elapsed / message_count * 1e9, "ns/message", "lower", f"switch {user_count:>7} users, {label:>14}: {elapsed / message_count * 1e9:8.0f} ns/message")
+
+# /searchall over a whole synthetic chat folder, in one process and
+# spread over several, for a common word, two words together, a user,
+# and a word that's never used
+def bench_searchall(workdir, args):
+    corpus = os.path.join(workdir, "corpus")
+    make_corpus(corpus, args.lines, args.users)
+    size_mb = sum(multiChat.log_size(os.path.join(corpus, chat_name + ".txt")) for chat_name in multiChat.find_chats(corpus)) / 1024 / 1024
+    user = make_user_names(args.users)[0]
+    for label, query in [("word", "pizza"), ("words", "pizza tired"), ("user", "@" + user), ("missing", "zzzz")]:
+        for processes, mode in [(1, "serial"), (os.cpu_count() or 1, "parallel")]:
+            elapsed = best_time(lambda: multiChat.search_all_chats(corpus, query, "%H:%M:%S", processes=processes), repeats=3)
+            report("searchall", f"{label}_{mode}", size_mb / elapsed, "MB/s", "higher", f"searchall {label:>7} {mode:>8}: {size_mb / elapsed:8.1f} MB/s ({size_mb:.1f} MB)")
+
+# Quotes: building the index from scratch once, loading it after that,
+# and picking a random quote or counting someone's quotes
+def bench_quotes(workdir, args):
+    quote_count = max(1000, args.lines // 10)
+    quote_path = os.path.join(workdir, "quotes.txt")
+    make_quotes(quote_path, quote_count, args.users)
+    name = make_user_names(args.users)[0]
+    start = time.perf_counter()
+    quote_index = multiChat.load_quote_index(quote_path)
+    elapsed = time.perf_counter() - start
+    report("quotes", "index_build", elapsed * 1000, "ms", "lower", f"quotes {quote_count} quotes: building the index {elapsed * 1000:8.1f} ms")
+    elapsed = best_time(lambda: multiChat.load_quote_index(quote_path))
+    report("quotes", "index_load", elapsed * 1000, "ms", "lower", f"quotes {quote_count} quotes: loading the index {elapsed * 1000:8.1f} ms")
+    for label, function in [("random", lambda: multiChat.random_quote(quote_index, quote_path)), ("random_author", lambda: multiChat.random_quote(quote_index, quote_path, name)), ("count_author", lambda: multiChat.count_quotes(quote_index, name))]:
+        elapsed = best_time(lambda: [function() for _ in range(1000)]) / 1000
+        report("quotes", label, elapsed * 1e6, "us", "lower", f"quotes {quote_count} quotes: {label:>13} {elapsed * 1e6:8.1f} us")
+
+# Loading settings, both up to date and from before any migrations
+def bench_settings(workdir, args):
+    import pickle
+    settings_dir = os.path.join(workdir, "settings")
+    os.makedirs(settings_dir, exist_ok=True)
+    current = multiChat.Settings(multiChat.build_default_settings(), settings_dir)
+    current.dirty = True
+    current.save()
+    elapsed = best_time(lambda: multiChat.Settings.load(settings_dir), 50)
+    report("settings", "load", elapsed * 1e6, "us", "lower", f"settings load {'current':>9}: {elapsed * 1e6:8.1f} us")
+    # The oldest settings files only had these
+    old_values = {key: current[key] for key in ["savedir", "timestamps", "timestamp_format"]}
+    def load_old():
+        with open(os.path.join(settings_dir, "settings.pkl"), "wb") as settings_file:
+            pickle.dump(old_values, settings_file)
+        multiChat.Settings.load(settings_dir).save()
+    elapsed = best_time(load_old, 50)
+    report("settings", "load_migrate_save", elapsed * 1e6, "us", "lower", f"settings load {'old':>9}: {elapsed * 1e6:8.1f} us (with migrating and saving)")
+
+# Headless ingest throughput, in each log durability mode
+def bench_ingest(workdir, args):
+    message_count = 100_000
+    lines = [f"{'abc'[number % 3]}\tThis is test message number {number}.\n" for number in range(message_count)]
+    for mode in multiChat.LOG_DURABILITY_MODES:
+        settings = multiChat.Settings(multiChat.build_default_settings(), workdir)
+        settings["log_durability"] = mode
+        path = os.path.join(workdir, f"ingest-{mode}.txt")
+        with open(path, "w+") as log_file:
+            start = time.perf_counter()
+            multiChat.ingest(iter(lines), multiChat.UserRegistry(), log_file, settings)
+            elapsed = time.perf_counter() - start
+        report("ingest", mode, message_count / elapsed, "messages/s", "higher", f"ingest {mode:>5}: {message_count / elapsed:12,.0f} messages/s")
+
+# A log on a slow disk: every write takes delay seconds
+class SlowLogWriter(multiChat.LogWriter):
+    delay = 0.005
+
+    def append(self, descriptor, data):
+        time.sleep(self.delay)
+        super().append(descriptor, data)
+
+def percentile(times, fraction):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+# How long the chat loop is kept from the next keystroke after each
+# message, when every log write takes 5 ms. Writing inline blocks for
+# the whole write; writing in the background shouldn't block at all.
+def bench_latency(workdir, args):
+    import asyncio
+    message_count = 200
+    settings = multiChat.Settings(multiChat.build_default_settings(), workdir)
+    def make_state(name):
+        log_file = open(os.path.join(workdir, name), "w+")
+        state = multiChat.ChatState(multiChat.UserRegistry(), workdir, log_file, name, settings)
+        state.log_writer = SlowLogWriter(log_file)
+        state.switch_to(state.user_list.add("Alice"))
+        return state
+    # Writing inline, as before
+    state = make_state("latency-inline.txt")
+    inline = []
+    for number in range(message_count):
+        start = time.perf_counter()
+        state.write(f"Alice, 12:00:00: This is test message number {number}.\n", "Alice")
+        inline.append(time.perf_counter() - start)
+    # Writing in the background, the way chat_loop() does
+    state = make_state("latency-background.txt")
+    background = []
+    async def run():
+        state.io = multiChat.BackgroundIO()
+        state.io.start()
+        for number in range(message_count):
+            start = time.perf_counter()
+            state.write(f"Alice, 12:00:00: This is test message number {number}.\n", "Alice")
+            # Let the event loop go round once, as it would for the next keystroke
+            await asyncio.sleep(0)
+            background.append(time.perf_counter() - start)
+            # Typing the next message
+            await asyncio.sleep(0.002)
+        await state.io.stop()
+    asyncio.run(run())
+    for label, times in [("inline", inline), ("background", background)]:
+        report("latency", label + "_p99", percentile(times, 0.99) * 1000, "ms", "lower", f"latency {label:>10}: p50 {percentile(times, 0.5) * 1000:7.3f} ms, p99 {percentile(times, 0.99) * 1000:7.3f} ms per message (5 ms disk writes)")
+
+# SQLite storage: messages/s added the way the chat does it (one commit
+# per message), bulk import, and indexed queries on the imported chat
+def bench_storage(workdir, args):
+    message_count = 2000
+    line_count = 200_000
+    storage_dir = os.path.join(workdir, "storage")
+    os.makedirs(storage_dir, exist_ok=True)
+    user = multiChat.UserRegistry().add("User 1")
+    for mode in multiChat.LOG_DURABILITY_MODES:
+        storage = multiChat.SQLiteStorage(storage_dir, mode)
+        start = time.perf_counter()
+        for number in range(message_count):
+            storage.add_text("live-" + mode, f"User 1, 12:00:00: This is test message number {number}.\n", user)
+            storage.commit()
+        elapsed = time.perf_counter() - start
+        storage.close()
+        report("storage", "appends_" + mode, message_count / elapsed, "messages/s", "higher", f"storage appends {mode:>5}: {message_count / elapsed:12,.0f} messages/s")
+    names = make_log(os.path.join(storage_dir, "imported.txt"), line_count, args.users)
+    storage = multiChat.SQLiteStorage(storage_dir)
+    start = time.perf_counter()
+    multiChat.import_into_sqlite(storage, storage_dir, multiChat.UserRegistry(), "%H:%M:%S")
+    elapsed = time.perf_counter() - start
+    report("storage", "import", line_count / elapsed, "lines/s", "higher", f"storage import: {line_count / elapsed:12,.0f} lines/s")
+    day = CORPUS_START.isoformat()
+    for label, query in [("author", dict(author=names[3])), ("date", dict(since=day, until=day)), ("text", dict(words=["pizza"])), ("author+text", dict(author=names[3], words=["coffee"]))]:
+        elapsed = best_time(lambda: storage.query_messages("imported", **query))
+        report("storage", "query_" + label, elapsed * 1000, "ms", "lower", f"storage query {label:>11}: {elapsed * 1000:8.3f} ms ({line_count} lines)")
+    storage.close()
+
+# One of several MultiChats writing to the same log at once. Every
+# fourth record is three lines long, like a date marker or a quote.
+# Each writer saves the offsets write() gave it next to the log, so they
+# can be checked afterwards
+def append_records(path, writer_number, record_count):
+    import pickle
+    offsets = []
+    with open(path, "r+") as log_file:
+        log_writer = multiChat.LogWriter(log_file)
+        for number in range(record_count):
+            if number % 4 == 0:
+                text = "".join(f"writer {writer_number} record {number} part {part}/3 {'x' * 60}\n" for part in range(3))
+            else:
+                text = f"writer {writer_number} record {number} part 0/1 {'x' * 60}\n"
+            offsets.append((log_writer.write(text), text.partition("\n")[0]))
+        log_writer.finish()
+    with open(f"{path}.offsets-{writer_number}.pkl", "wb") as offsets_file:
+        pickle.dump(offsets, offsets_file)
+
+# Archive the log over and over (with a tiny size limit so it's always
+# due) until told to stop, the way the first MultiChat to open a chat
+# would while others are writing to it
+def archive_repeatedly(path, stop):
+    multiChat.SEGMENT_MAX_BYTES = 64 * 1024
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        while not stop.is_set():
+            with open(path, "r+") as log_file:
+                multiChat.archive_log_if_due(log_file, "gzip")
+            time.sleep(0.01)
+
+# The way logs used to be written: a buffered r+ handle from the end of the file
+def append_records_buffered(path, writer_number, record_count):
+    with open(path, "r+") as log_file:
+        log_file.seek(0, os.SEEK_END)
+        for number in range(record_count):
+            log_file.write(f"writer {writer_number} record {number} part 0/1 {'x' * 60}\n")
+            log_file.flush()
+
+# Check every line is whole and every record's lines are together,
+# reading through any archived segments too.
+# Returns how many records are missing or broken.
+def check_records(path, writer_count, record_count):
+    import re
+    record_line = re.compile(r"^writer (\d+) record (\d+) part (\d+)/(\d+) x{60}$")
+    seen = set()
+    broken = 0
+    expected_part = None
+    for offset, line in multiChat.iter_log_lines(path):
+        match = record_line.match(line.decode("utf-8").rstrip("\n"))
+        if not match:
+            broken += 1
+            expected_part = None
+            continue
+        writer, record, part, parts = (int(group) for group in match.groups())
+        if part == 0:
+            expected_part = (writer, record, 1, parts)
+        elif expected_part != (writer, record, part, parts):
+            broken += 1
+            continue
+        else:
+            expected_part = (writer, record, part + 1, parts)
+        if part == parts - 1:
+            seen.add((writer, record))
+    return writer_count * record_count - len(seen) + broken
+
+# Check the offsets append_records() saved point at the lines written there.
+# Returns how many don't.
+def check_offsets(path, writer_count):
+    import pickle
+    wrong = 0
+    for writer_number in range(writer_count):
+        with open(f"{path}.offsets-{writer_number}.pkl", "rb") as offsets_file:
+            offsets = pickle.load(offsets_file)
+        lines = multiChat.read_log_lines(path, [offset for offset, first_line in offsets])
+        for (offset, first_line), line in zip(sorted(offsets), lines):
+            if line.decode("utf-8").rstrip("\n") != first_line:
+                wrong += 1
+    return wrong
+
+# Several processes appending to the same log at once: nothing may be
+# lost or torn, even while another one keeps archiving the log, and the
+# offsets write() hands back must be right. Also shows what the old
+# buffered writes did.
+def bench_appends(workdir, args):
+    import multiprocessing
+    writer_count = 8
+    record_count = 2000
+    passed = True
+    for label, target, archiving in [("buffered r+ (old)", append_records_buffered, False), ("O_APPEND + lock", append_records, False), ("while archiving", append_records, True)]:
+        path = os.path.join(workdir, f"appends-{target.__name__}{'-archiving' if archiving else ''}.txt")
+        open(path, "w").close()
+        start = time.perf_counter()
+        writers = [multiprocessing.Process(target=target, args=(path, number, record_count)) for number in range(writer_count)]
+        if archiving:
+            stop = multiprocessing.Event()
+            archiver = multiprocessing.Process(target=archive_repeatedly, args=(path, stop))
+            archiver.start()
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        if archiving:
+            stop.set()
+            archiver.join()
+        elapsed = time.perf_counter() - start
+        bad = check_records(path, writer_count, record_count)
+        text = f"appends {label:>17}: {writer_count} writers, {writer_count * record_count / elapsed:10,.0f} records/s, {bad} records lost or torn"
+        if target is append_records:
+            wrong = check_offsets(path, writer_count)
+            text += f", {wrong} wrong offsets"
+            if archiving:
+                text += f", {len(multiChat.load_segments(path))} segments"
+            metric = "archiving_" if archiving else ""
+            report("appends", metric + "records", writer_count * record_count / elapsed, "records/s", "higher", text)
+            report("appends", metric + "lost_or_torn", bad, "records", "lower")
+            report("appends", metric + "wrong_offsets", wrong, "offsets", "lower")
+            if bad or wrong:
+                passed = False
+        else:
+            print(text)
+    return passed
+
+MULTICHAT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "multiChat.py")
+
+# Run MultiChat with its settings and logs kept inside workdir
+def multichat_environment(workdir):
+    environment = dict(os.environ)
+    environment["HOME"] = workdir
+    environment["XDG_CONFIG_HOME"] = os.path.join(workdir, "config")
+    environment["XDG_DATA_HOME"] = os.path.join(workdir, "data")
+    environment["TERM"] = "dumb"
+    return environment
+
+# Start MultiChat and time how long it takes to ask for the first user
+def time_to_first_prompt(workdir):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MULTICHAT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=multichat_environment(workdir))
+    output = b""
+    while b"enter the name of user" not in output:
+        data = process.stdout.read1(4096)
+        if not data:
+            break
+        output += data
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    if b"enter the name of user" not in output:
+        raise RuntimeError("MultiChat exited before showing the first prompt:\n" + output.decode(errors="replace"))
+    return elapsed
+
+# Parse python -X importtime output into (cumulative microseconds, module)
+# for the modules multiChat imports directly
+def import_times(workdir):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import multiChat"], cwd=os.path.dirname(MULTICHAT), capture_output=True, text=True, env=multichat_environment(workdir))
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, module = line.removeprefix("import time:").split("|")
+        if not cumulative.strip().isdigit():
+            continue # Header line
+        # Nesting is shown by indentation; two spaces means multiChat imported it
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth <= 1:
+            times.append((int(cumulative), module.strip()))
+    return times
+
+# Cold start: time to the first prompt, and which imports cost the most.
+# Fails if the first prompt takes longer than --startup-budget-ms.
+def bench_startup(workdir, args):
+    first_prompt = min(time_to_first_prompt(workdir) for _ in range(5))
+    times = import_times(workdir)
+    total = dict((module, cumulative) for cumulative, module in times).get("multiChat", 0)
+    report("startup", "first_prompt", first_prompt * 1000, "ms", "lower", f"startup: first prompt after {first_prompt * 1000:.1f} ms (budget {args.startup_budget_ms} ms), importing multiChat took {total / 1000:.1f} ms")
+    for cumulative, module in sorted(times, reverse=True)[1:6]:
+        print(f"    {module:<20} {cumulative / 1000:8.1f} ms")
+    if first_prompt * 1000 > args.startup_budget_ms:
+        print("startup: over budget!")
+        return False
+    return True
+
+BENCHMARKS = {
+    "backread": bench_backread,
+    "switch": bench_switch,
+    "quotes": bench_quotes,
+    "settings": bench_settings,
+    "writes": bench_log_writes,
+    "dispatch": bench_dispatch,
+    "ingest": bench_ingest,
+    "latency": bench_latency,
+    "storage": bench_storage,
+    "searchall": bench_searchall,
+    "appends": bench_appends,
+    "startup": bench_startup,
+}
+
+# Where this run came from, so saved results can be told apart
+def run_details():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(MULTICHAT), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    import platform
+    return {"commit": commit, "time": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "platform": platform.platform()}
+
+# Show how this run's results compare to a saved one. Returns False if
+# anything got worse by more than tolerance (a fraction).
+def compare_results(baseline_path, tolerance):
+    import json
+    with open(baseline_path, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+    old_values = {(result["benchmark"], result["metric"]): result["value"] for result in baseline["results"]}
+    print()
+    print(f"Compared with {baseline_path} (commit {baseline.get('commit')}):")
+    passed = True
+    for result in RESULTS:
+        old_value = old_values.get((result["benchmark"], result["metric"]))
+        if old_value is None:
+            continue
+        if old_value == 0:
+            change = 0 if result["value"] == 0 else float("inf")
+        else:
+            change = (result["value"] - old_value) / old_value
+        # Positive is worse, whichever way the metric goes
+        worse_by = -change if result["better"] == "higher" else change
+        flag = ""
+        if worse_by > tolerance:
+            flag = "  <-- slower"
+            passed = False
+        print(f"    {result['benchmark'] + ' ' + result['metric']:<40} {old_value:14.3f} -> {result['value']:14.3f} {result['unit']:<12} {change * 100:+7.1f}%{flag}")
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MultiChat.")
+    parser.add_argument("names", nargs="*", choices=[[]] + list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--startup-budget-ms", type=float, default=300, help="fail if the first prompt takes longer than this (default: 300)")
+    parser.add_argument("--lines", type=int, default=1_000_000, help="lines in the biggest synthetic chat log (default: 1000000)")
+    parser.add_argument("--users", type=int, default=50, help="users in the synthetic chat logs (default: 50)")
+    parser.add_argument("--json", metavar="FILE", help="save the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with ones saved by --json, and fail if any got worse")
+    parser.add_argument("--tolerance", type=float, default=20, help="how many percent worse a result can get before --compare fails (default: 20)")
+    parser.add_argument("--generate", metavar="DIR", help="write a synthetic chat folder (chat logs, quotes and saved users) to DIR, then exit")
+    args = parser.parse_args()
+    if args.generate is not None:
+        make_corpus(args.generate, args.lines, args.users)
+        print(f"Wrote a {args.lines}-line chat and friends to {args.generate}")
+        return
+    names = args.names or list(BENCHMARKS)
+    passed = True
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            if BENCHMARKS[name](workdir, args) is False:
+                passed = False
+    if args.json is not None:
+        import json
+        with open(args.json, "w") as results_file:
+            json.dump({**run_details(), "lines": args.lines, "users": args.users, "results": RESULTS}, results_file, indent=1)
+    if args.compare is not None and not compare_results(args.compare, args.tolerance / 100):
+        passed = False
+    if not passed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,77 @@
 #!/usr/bin/env python3
 # Used to display date and time for messages.
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 # Used to set home directory for chat logs.
 import platform
 # Used to make sure chat directory exists.
 import os
 from pathlib import Path
+# Used to only work out directories once
+import functools
+import itertools
+# Used to check for optional libraries without loading them
+import importlib
+import importlib.util
 # Proper arrow key scrolling on Un*x
 try:
     if platform.system() != "Windows": import readline
 except:
     print("Could not import readline.")
-# Used for dice rolling
-import random
 # Used to save/load users
 import pickle
+# Used to find date headers in chat logs
+import re
+import bisect
+# Used for the /search index
+import dbm
+from array import array
+# Used for group commits to the log
+import threading
+import time
 
+# Heavier libraries (prompt_toolkit especially) are only imported the
+# first time they're used, so MultiChat starts up quickly. Only check
+# that they're installed for now.
 # Check if installed. If not, warn user.
-COLORS = False
-try:
-    # Used to color names/prompts.
-    from termcolor import colored;
-    COLORS = True
-except:
+COLORS = importlib.util.find_spec("termcolor") is not None
+if not COLORS:
     print("Warning: termcolor library required for color output.")
     print("It can be installed in your terminal with 'pip install termcolor'.")
     print("Continuing without color.")
 
-PROMPT_INSTALLED = False
-try:
-    # Fixes text wrap bugs by allowing input wrapping
-    from prompt_toolkit import prompt, print_formatted_text, ANSI
-    PROMPT_INSTALLED = True
-except:
+PROMPT_INSTALLED = importlib.util.find_spec("prompt_toolkit") is not None
+if not PROMPT_INSTALLED:
     print("Warning: prompt_toolkit library required for handling long messages.")
     print("It can be installed in your terminal with 'pip install prompt_toolkit'.")
     print("Continuing. Visual errors may occur when entering long lines of text.")
 
+# Used to color names/prompts.
+def colored(text, color):
+    if not COLORS:
+        return text
+    from termcolor import colored as termcolor_colored
+    return termcolor_colored(text, color)
+
+# Input for the chat loop: prompt_toolkit fixes text wrap bugs by allowing
+# input wrapping, and waiting asynchronously doesn't block anything else
+# that's going on (like saving messages in the background).
+# session is the PromptSession from make_prompt_session(), if there is one.
+async def prompt_async(message, session=None):
+    if session is not None:
+        from prompt_toolkit import ANSI
+        return await session.prompt_async(ANSI(message))
+    import asyncio
+    return await asyncio.to_thread(input, message)
+
+# asyncio and prompt_toolkit take a while to import, so start loading them
+# in the background while the user is still picking users and a chat name.
+def preload_chat_modules():
+    modules = ["asyncio"]
+    if PROMPT_INSTALLED:
+        modules.append("prompt_toolkit")
+    for module in modules:
+        threading.Thread(target=importlib.import_module, args=(module,), daemon=True).start()
+
 
 # Decide where to look for the settings file
 # The default option will be one of the following on Linux systems:
@@ -47,6 +82,8 @@ except:
 # On Windows:
 # $APPDATA\multichat
 # C:\Program Files (x86)\multichat
+# Only worked out once per run; after that the answer is remembered.
+@functools.cache
 def get_settings_dir():
     if platform.system() == "Windows":
         try:
@@ -75,55 +112,110 @@ def get_settings_dir():
 def build_default_settings():
     # Figure out default chatlog file location- distinct from settings location!
     log_dir = get_log_dir()
-    settings_dir = get_settings_dir()
     # Build the settings dict
-    default_settings = {"savedir": log_dir, "timestamps": True, "timestamp_format": "%H:%M:%S", "backread_linecount": 100, "case_sensitive_proxies": True}
+    default_settings = {"savedir": log_dir, "timestamps": True, "timestamp_format": "%H:%M:%S", "backread_linecount": 100, "case_sensitive_proxies": True, "log_durability": "os", "group_commit_messages": 20, "group_commit_ms": 1000, "log_archive_compression": "gzip", "structured_log": False, "storage_backend": "text", "schema_version": SETTINGS_SCHEMA_VERSION}
     return default_settings
 
-# Either get the user's existing settings, or assign the defaults
-def retrieve_settings():
-    settings_dir = get_settings_dir()
-    if os.path.isfile(settings_dir + "/settings.pkl") == False: 
-        settings = build_default_settings()
-    else:
+# Settings saved by older versions of MultiChat are missing newer options.
+# Each step here adds what one version introduced; settings["schema_version"]
+# records how many of the steps have already been applied to a file.
+def migrate_backread(values):
+    values.setdefault("backread_linecount", 100)
+
+def migrate_case_sensitivity(values):
+    values.setdefault("case_sensitive_proxies", True)
+
+def migrate_durability(values):
+    values.setdefault("log_durability", "os")
+    values.setdefault("group_commit_messages", 20)
+    values.setdefault("group_commit_ms", 1000)
+
+def migrate_archiving(values):
+    values.setdefault("log_archive_compression", "gzip")
+
+def migrate_structured_log(values):
+    values.setdefault("structured_log", False)
+
+def migrate_storage_backend(values):
+    values.setdefault("storage_backend", "text")
+
+SETTINGS_MIGRATIONS = [migrate_backread, migrate_case_sensitivity, migrate_durability, migrate_archiving, migrate_structured_log, migrate_storage_backend]
+SETTINGS_SCHEMA_VERSION = len(SETTINGS_MIGRATIONS)
+
+# Options that are worked out each run rather than saved
+RUNTIME_SETTINGS = ["random_flavortext"]
+
+# The user's settings. Used like a dict: settings["timestamps"], etc.
+# Changes are remembered and only written out when save() is called, and
+# the file is replaced in one go so a crash can't leave half of it behind.
+class Settings:
+    def __init__(self, values, settings_dir):
+        self.values = values
+        self.settings_dir = settings_dir
+        self.path = settings_dir + "/settings.pkl"
+        self.dirty = False
+
+    # Either get the user's existing settings, or assign the defaults
+    @classmethod
+    def load(cls, settings_dir):
+        if os.path.isfile(settings_dir + "/settings.pkl") == False:
+            return cls(build_default_settings(), settings_dir)
         with open(settings_dir + "/settings.pkl", "rb") as settingsfile:
-            settings = pickle.load(settingsfile)
-        # Deal with backwards compatibility for new settings
-        try:
-            test = settings["backread_linecount"]
-        except:
-            settings["backread_linecount"] = 100
-            settings_dir = get_settings_dir()
-            save_settings(settings, settings_dir)
-        try:
-            casesensitive = settings["case_sensitive_proxies"]
-        except:
-            settings["case_sensitive_proxies"] = True
-            settings_dir = get_settings_dir()
-            save_settings(settings, settings_dir)
+            settings = cls(pickle.load(settingsfile), settings_dir)
+        settings.migrate()
+        return settings
+
+    # Bring settings from older versions of MultiChat up to date
+    def migrate(self):
+        version = self.values.get("schema_version", 0)
+        for migration in SETTINGS_MIGRATIONS[version:]:
+            migration(self.values)
+        if version != SETTINGS_SCHEMA_VERSION:
+            self["schema_version"] = SETTINGS_SCHEMA_VERSION
         try:
-            timestamp_format = settings["timestamp_format"]
-            now.strftime(settings["timestamp_format"])
-        except:
+            datetime.now().strftime(self.values["timestamp_format"])
+        except Exception:
             print("Invalid or missing timestamp format setting; reverting to base format (%H:%M:%S).")
-            settings["timestamp_format"] = "%H:%M:%S"
-            settings_dir = get_settings_dir()
-            save_settings(settings, settings_dir)
+            self["timestamp_format"] = "%H:%M:%S"
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        if key not in RUNTIME_SETTINGS:
+            self.dirty = True
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    # Write settings to file, if anything has changed
+    def save(self):
+        if not self.dirty:
+            return True
+        make_dir_exist(self.settings_dir)
+        # Remove options that we don't want to store in the settings file
+        values = {key: value for key, value in self.values.items() if key not in RUNTIME_SETTINGS}
+        with open(self.path + ".tmp", "wb") as settingfile:
+            pickle.dump(values, settingfile)
+            settingfile.flush()
+            os.fsync(settingfile.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+        return True
+
+# Get the user's settings, ready to use
+def retrieve_settings():
+    settings_dir = get_settings_dir()
+    settings = Settings.load(settings_dir)
+    settings.save()
     # Add random flavortext
     settings["random_flavortext"] = get_flavortext(settings_dir)
     return settings
 
-# Save user settings to file
-def save_settings(settings, settings_dir):
-    if os.path.isdir(settings_dir) == False: Path(settings).mkdir(parents=True, exist_ok=True)
-    # Remove options that we don't want to store in the settings file
-    if "random_flavortext" in settings.keys():
-        del settings["random_flavortext"]
-    with open (settings_dir + "/settings.pkl", "wb") as settingfile:
-        pickle.dump(settings, settingfile)
-    return True
-
-
 # We need this directory to exist yesterday
 def make_dir_exist(dir: str) -> bool:
     if os.path.isdir(dir) == False: # Doesn't exist
@@ -144,13 +236,15 @@ def make_dir_exist(dir: str) -> bool:
 # - $HOME/multichat
 # On Windows:
 # $APPDATA\multichat
+# Only worked out once per run; after that the answer is remembered.
+@functools.cache
 def get_log_dir() -> str:
     env_home = None # Nothing default
     if platform.system() == "Windows":
         env_home = os.getenv('APPDATA')
     else:
-        for place in [os.environ['XDG_DATA_HOME'], os.environ['HOME'] + "/.local/share", os.environ['HOME'] + "/Documents", os.environ['HOME']]:
-            if make_dir_exist(place) == True:
+        for place in [os.environ.get('XDG_DATA_HOME'), os.environ['HOME'] + "/.local/share", os.environ['HOME'] + "/Documents", os.environ['HOME']]:
+            if place and make_dir_exist(place) == True:
                 env_home = place
                 break
     # Something has gone very wrong if you get here
@@ -166,7 +260,8 @@ def get_log_dir() -> str:
         log_dir_exists = make_dir_exist(log_dir)
     return log_dir
 
-def change_log_dir(settings, log_file, log_file_name, user_list):
+# Returns the new log directory and log file, or None if it couldn't be changed
+def change_log_dir(settings, log_writer, log_file_name):
     save_dir = input("Enter new chatlog save location (absolute path): ").rstrip() # Remove trailing slash, if present
     # if save_dir[-1] in ["/", "\\"]: save_dir = save_dir[:-1]
     # DO SAFETY CHECKS
@@ -179,17 +274,18 @@ def change_log_dir(settings, log_file, log_file_name, user_list):
         # Can we write to it?
         if os.access(save_dir, os.W_OK):
             settings["savedir"] = save_dir + "/multichat"
-            settings_dir = get_settings_dir()
-            save_settings(settings, settings_dir)
+            settings.save()
             clear()
             print(f"Saved. MultiChat's chat logs will now be saved to {save_dir}.")
-            print(log_file)
-            log_file.write("\n\n")
-            log_file.close() # Kill the old file, on to the new!
+            print(log_writer.log_file)
+            log_writer.write("\n\n")
+            log_writer.finish()
+            log_writer.log_file.close() # Kill the old file, on to the new!
             log_file = open_log(save_dir, log_file_name)
-            chat(user_list, save_dir, log_file, log_file_name, settings)
+            return save_dir, log_file
         else:
             print(f"Cannot access log file: permission denied. Do you have permission to write to files in {save_dir}?")
+    return None
 
 # Get list of flavortext used by /random
 def get_flavortext(settings_dir):
@@ -215,14 +311,200 @@ def get_flavortext(settings_dir):
             ]
     return flavor_options
 
+# Finds every word starting with some text, for tab completion, without
+# looking at the words that don't. Each node is a dict of the next
+# character -> node, plus the values for the word ending there under None.
+class PrefixTrie:
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, word, value):
+        node = self.root
+        for character in word:
+            node = node.setdefault(character, {})
+        node.setdefault(None, []).append(value)
+
+    def remove(self, word, value):
+        path = [self.root]
+        for character in word:
+            node = path[-1].get(character)
+            if node is None:
+                return
+            path.append(node)
+        values = path[-1].get(None, [])
+        if value in values:
+            values.remove(value)
+        if not values:
+            path[-1].pop(None, None)
+        # Prune the nodes that no longer lead anywhere
+        for depth in range(len(word), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][word[depth - 1]]
+
+    # Values of words starting with prefix, shortest and then alphabetical
+    # words first. A generator, so only as much of the trie as is needed
+    # gets looked at.
+    def complete(self, prefix):
+        node = self.root
+        for character in prefix:
+            node = node.get(character)
+            if node is None:
+                return
+        level = [node]
+        while level:
+            next_level = []
+            for node in level:
+                yield from node.get(None, ())
+                next_level.extend(node[character] for character in sorted(character for character in node if character is not None))
+            level = next_level
+
+# One user: their name, the proxy that switches to them, and their color.
+# __slots__ keeps these small, since some systems have a lot of users.
+class User:
+    __slots__ = ("username", "proxy", "color", "position")
+
+    def __init__(self, username, proxy, color="default"):
+        self.username = username
+        self.proxy = proxy
+        self.color = color
+        self.position = None
+
+# Everyone in the chat. Users can be found by proxy, by name, or by
+# case-insensitive proxy with a single dict lookup, and those lookups are
+# kept up to date as users are added, removed, or change proxy.
+class UserRegistry:
+    __slots__ = ("by_proxy", "by_name", "by_casefold", "by_prefix", "by_casefold_prefix", "order", "next_number")
+
+    def __init__(self):
+        self.by_proxy = {}
+        self.by_name = {}
+        # Casefolded proxy -> users. A list in case two proxies only differ
+        # by case; the newest one wins.
+        self.by_casefold = {}
+        # Proxies again, for tab completion, and casefolded for when proxies
+        # aren't case-sensitive, so it offers what find_switch() would find
+        self.by_prefix = PrefixTrie()
+        self.by_casefold_prefix = PrefixTrie()
+        # Same users as by_proxy, as a list so /random can pick one quickly
+        self.order = []
+        self.next_number = 1
+
+    # Build a registry from the dict saved by /save.
+    # Old saves stored just the name instead of {"username", "color"}.
+    @classmethod
+    def from_dict(cls, user_list):
+        registry = cls()
+        for proxy, user in user_list.items():
+            if isinstance(user, dict):
+                registry.add(str(user.get("username", proxy)), str(proxy), user.get("color", "default"))
+            else:
+                registry.add(str(user), str(proxy))
+        return registry
+
+    # The dict format used by /save and /load
+    def to_dict(self):
+        return {user.proxy: {"username": user.username, "color": user.color} for user in self}
+
+    def __len__(self):
+        return len(self.by_proxy)
+
+    def __iter__(self):
+        return iter(list(self.by_proxy.values()))
+
+    def __contains__(self, proxy):
+        return proxy in self.by_proxy
+
+    def get(self, proxy):
+        return self.by_proxy.get(proxy)
+
+    def find_by_name(self, username):
+        return self.by_name.get(username)
+
+    def first(self):
+        return next(iter(self.by_proxy.values()))
+
+    def random_user(self):
+        import random
+        return random.choice(self.order)
+
+    # Add a user. Without a proxy, they get the next unused number.
+    def add(self, username, proxy=None, color="default"):
+        if proxy is None:
+            while str(self.next_number) in self.by_proxy:
+                self.next_number += 1
+            proxy = str(self.next_number)
+        if proxy in self.by_proxy:
+            self.remove(proxy)
+        user = User(username, proxy, color)
+        user.position = len(self.order)
+        self.order.append(user)
+        self.by_proxy[proxy] = user
+        self.by_name[username] = user
+        self.by_casefold.setdefault(proxy.casefold(), []).append(user)
+        self.by_prefix.add(proxy, user)
+        self.by_casefold_prefix.add(proxy.casefold(), user)
+        return user
+
+    def remove(self, proxy):
+        user = self.by_proxy.pop(proxy)
+        if self.by_name.get(user.username) is user:
+            del self.by_name[user.username]
+        self.unindex_casefold(user)
+        # Swap the last user into this one's place so nothing has to shift
+        last = self.order.pop()
+        if last is not user:
+            self.order[user.position] = last
+            last.position = user.position
+        user.position = None
+        return user
+
+    def set_proxy(self, user, proxy):
+        # A user from some other registry (say, from before a /load)
+        # would leave this one half changed
+        if self.by_proxy.get(user.proxy) is not user:
+            raise ValueError(f"{user.username} is not in this user list")
+        del self.by_proxy[user.proxy]
+        self.unindex_casefold(user)
+        user.proxy = proxy
+        self.by_proxy[proxy] = user
+        self.by_casefold.setdefault(proxy.casefold(), []).append(user)
+        self.by_prefix.add(proxy, user)
+        self.by_casefold_prefix.add(proxy.casefold(), user)
+
+    def unindex_casefold(self, user):
+        self.by_prefix.remove(user.proxy, user)
+        self.by_casefold_prefix.remove(user.proxy.casefold(), user)
+        matches = self.by_casefold.get(user.proxy.casefold(), [])
+        if user in matches:
+            matches.remove(user)
+        if not matches:
+            self.by_casefold.pop(user.proxy.casefold(), None)
+
+    # If a message is a switch, return the user to switch to. Otherwise, None.
+    def find_switch(self, message, case_sensitivity=True):
+        user = self.by_proxy.get(message)
+        if user is None and case_sensitivity == False:
+            matches = self.by_casefold.get(message.casefold())
+            if matches:
+                user = matches[-1]
+        return user
+
+    # Users whose proxy starts with text, for tab completion
+    def complete_proxy(self, text, case_sensitivity=True, limit=None):
+        if case_sensitivity:
+            return list(itertools.islice(self.by_prefix.complete(text), limit))
+        return list(itertools.islice(self.by_casefold_prefix.complete(text.casefold()), limit))
+
 # Add a new user, updating the user list
 def add_user(user, user_list):
     if user:
-        new_user_number = len(user_list) + 1
-        user_list.update({str(new_user_number): {"username": str(user), 'color': 'default'}})
+        new_user = user_list.add(str(user))
         print()
         print(user + " added!")
-        print("Type " + str(new_user_number) + " to send messages as " + user + ".")
+        print("Type " + new_user.proxy + " to send messages as " + user + ".")
         print()
     else:
         print("Please enter a username when adding a new user.")
@@ -233,33 +515,29 @@ def load_users(output: bool):
     settings_dir = get_settings_dir()
     if os.path.isfile(settings_dir + "/saved-users.pkl") == False: 
         print("No saved users found. Save current users by sending /save\nwhile in chat.")
-        return {}
+        return UserRegistry()
     else:
         with open(settings_dir + "/saved-users.pkl", "rb") as savefile:
-            user_list = pickle.load(savefile)
+            user_list = UserRegistry.from_dict(pickle.load(savefile))
             print("Loaded users from file.")
             if output == True:
-                for user in user_list.keys():
-                    print("Type " + str(user) + " to send messages as " + str(user_list[user]["username"]))
+                list_users(user_list)
     return user_list
 
 # List out all users in list- output for the user to figure out who's there
 def list_users(user_list):
-    for user in user_list.keys():
-        # Fix old data format
-        if not isinstance(user_list[user], dict):
-            user_list[user] = {"username": str(user_list[user]), "color": "default"}
+    for user in user_list:
         # Information for the user :D
-        print("Type " + str(user) + " to send messages as " + user_list[user]["username"])
+        print("Type " + user.proxy + " to send messages as " + user.username)
 
 # Clears the terminal.
 def clear():
     os.system('cls' if os.name == 'nt' else 'clear')
 
-# Get initial users.
-def get_users():
-    # Get at least one user. Dictionary format.
-    user_list = {}
+# Get initial users. Saved users come from storage, if given.
+def get_users(storage=None):
+    # Get at least one user.
+    user_list = UserRegistry()
     # Variable is used to control a while loop that decides whether
     # to enter more users.
     continue_entry = True
@@ -272,8 +550,8 @@ def get_users():
 
     user_name = input("Otherwise, enter the name of user " + str(user_number) + " or q to quit: ")
 
-    # Get user name and add to dictionary
-    # Dictionary format:
+    # Get user name and add to the user list
+    # Proxy format:
     # Number: Name
     while continue_entry == True:
         # Allow for insta-quitting.
@@ -288,24 +566,24 @@ def get_users():
         if user_name == "":
             user_name = "/load"
         # Load existing users if they exist
-        if user_name == "/load" and user_list == {}:
-            user_list = load_users(False)
-            if user_list != {}:
+        if user_name == "/load" and len(user_list) == 0:
+            user_list = storage.load_users(False) if storage is not None else load_users(False)
+            if len(user_list) != 0:
                 user_number = len(user_list)
                 continue_entry = False
                 # Deal with lack of color support
                 if not COLORS:
                     for user in user_list:
-                        user_list[user]["color"] = "default"
+                        user.color = "default"
                 return user_list
         elif user_name == "/load":
             overwrite = input("Warning: loading saved users will overwrite current user list. Continue? y/n: ")
-            if overwrite.lower == "y" or overwrite.lower == "yes":
-                user_list = load_users(False)
+            if overwrite.lower() == "y" or overwrite.lower() == "yes":
+                user_list = storage.load_users(False) if storage is not None else load_users(False)
         # We have a username!
         elif user_name:
             # Add user.
-            user_list[str(user_number)] = {"username": str(user_name), "color": "default"}
+            user_list.add(str(user_name), str(user_number))
             user_number += 1
             print("If you're done, enter n to stop adding users.")
         # Bogus inputs
@@ -336,7 +614,2033 @@ def open_log(log_dir, log_file_name):
     # Stop the loop and return the needed information.
     else:
         return log_file
-            
+
+# Get the last line_count lines of a log file without reading all of it.
+# Seeks backwards from the end of the file one block at a time until
+# enough newlines have been seen, so the cost depends on how many lines
+# are wanted rather than on how big the log has grown.
+def tail_lines(file_path, line_count, block_size=65536):
+    if line_count <= 0:
+        return []
+    blocks = []
+    newlines = 0
+    with open(file_path, "rb") as tail_file:
+        position = tail_file.seek(0, os.SEEK_END)
+        # One extra newline marks the start of the first wanted line
+        while position > 0 and newlines <= line_count:
+            read_size = min(block_size, position)
+            position -= read_size
+            tail_file.seek(position)
+            block = tail_file.read(read_size)
+            newlines += block.count(b"\n")
+            blocks.append(block)
+    blocks.reverse()
+    text = b"".join(blocks).decode("utf-8", errors="replace")
+    return text.splitlines(keepends=True)[-line_count:]
+
+# Old parts of a chat log get archived into compressed segments next to it,
+# e.g. chat.txt grows until the month ends (or it gets too big), then its
+# contents move to chat.2024-01.txt.gz and chat.txt starts over empty.
+# chat.segments.pkl lists the segments in order along with how big each
+# one is uncompressed. Offsets into a log (used by /jump, /search, and so
+# on) count through all of the segments and then the live .txt file, as
+# if they were still one big file, so archiving doesn't move anything.
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+SEGMENT_COMPRESSION = {"gzip": ".gz", "lzma": ".xz"}
+SEGMENT_MODULES = {".gz": "gzip", ".xz": "lzma"}
+
+# Open a compressed file with whichever module its extension calls for
+def open_compressed(path, mode, extension=None):
+    if extension is None:
+        extension = os.path.splitext(path)[1]
+    if extension not in SEGMENT_MODULES:
+        return open(path, mode)
+    return importlib.import_module(SEGMENT_MODULES[extension]).open(path, mode)
+
+def segment_manifest_path(log_path):
+    return log_path.removesuffix(".txt") + ".segments.pkl"
+
+# The archived segments of a log, oldest first
+def load_segments(log_path):
+    try:
+        with open(segment_manifest_path(log_path), "rb") as manifest_file:
+            return pickle.load(manifest_file)
+    except FileNotFoundError:
+        return []
+
+def save_segments(log_path, segments):
+    manifest_path = segment_manifest_path(log_path)
+    with open(manifest_path + ".tmp", "wb") as manifest_file:
+        pickle.dump(segments, manifest_file)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+# Every piece of a log as (start offset, segment), oldest first.
+# The live .txt file comes last, with None in place of a segment.
+def log_pieces(log_path):
+    pieces = []
+    start = 0
+    for segment in load_segments(log_path):
+        pieces.append((start, segment))
+        start += segment["size"]
+    pieces.append((start, None))
+    return pieces
+
+# Open a piece of a log for reading in binary mode
+def open_log_piece(log_path, segment):
+    if segment is None:
+        return open(log_path, "rb")
+    return open_compressed(os.path.join(os.path.dirname(log_path), segment["file"]), "rb")
+
+# Size of a log, counting its archived segments uncompressed
+def log_size(log_path):
+    return log_pieces(log_path)[-1][0] + os.path.getsize(log_path)
+
+# Go through a log line by line from offset, across all of its segments.
+# Yields (offset, line) with lines as bytes.
+def iter_log_lines(log_path, offset=0):
+    pieces = log_pieces(log_path)
+    for number, (start, segment) in enumerate(pieces):
+        if number + 1 < len(pieces) and pieces[number + 1][0] <= offset:
+            continue
+        with open_log_piece(log_path, segment) as piece:
+            position = max(start, offset)
+            if position > start:
+                piece.seek(position - start)
+            for line in piece:
+                yield position, line
+                position += len(line)
+
+# Read the line starting at each offset, in order
+def read_log_lines(log_path, offsets):
+    pieces = log_pieces(log_path)
+    starts = [start for start, segment in pieces]
+    current = None
+    piece = None
+    try:
+        for offset in sorted(offsets):
+            number = bisect.bisect_right(starts, offset) - 1
+            if number != current:
+                if piece is not None:
+                    piece.close()
+                piece = open_log_piece(log_path, pieces[number][1])
+                current = number
+            piece.seek(offset - starts[number])
+            yield piece.readline()
+    finally:
+        if piece is not None:
+            piece.close()
+
+# Reads a log a page at a time from anywhere in it, for /history.
+# The live file is memory-mapped, and an archived segment is unpacked into
+# a temporary file and mapped when paging reaches it (one at a time), so
+# only the lines being shown get read and decoded however big the log is.
+class LogWindow:
+    def __init__(self, log_path):
+        self.log_path = log_path
+        # Piece number -> (mapping, file) for the live file and the
+        # segment in use
+        self.maps = {}
+        self.load_pieces()
+        self.size = self.starts[-1] + os.path.getsize(log_path)
+
+    # Find the pieces of the log. Archiving moves the live file into a new
+    # segment without changing any offsets, so if another window archives
+    # the log this is all that needs doing again.
+    def load_pieces(self):
+        self.close()
+        self.pieces = log_pieces(self.log_path)
+        self.starts = [start for start, segment in self.pieces]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        for number in list(self.maps):
+            self.unmap(number)
+
+    def unmap(self, number):
+        mapping, mapped_file = self.maps.pop(number)
+        if not isinstance(mapping, bytes):
+            mapping.close()
+        mapped_file.close()
+
+    # The bytes of piece number, mapped into memory
+    def buffer(self, number):
+        if number in self.maps:
+            return self.maps[number][0]
+        import mmap
+        segment = self.pieces[number][1]
+        if segment is None:
+            mapped_file = open(self.log_path, "rb")
+        else:
+            import shutil
+            import tempfile
+            for other in [other for other in self.maps if self.pieces[other][1] is not None]:
+                self.unmap(other)
+            print(f"MultiChat: Unpacking {segment['file']}...")
+            mapped_file = tempfile.TemporaryFile()
+            with open_log_piece(self.log_path, segment) as piece:
+                shutil.copyfileobj(piece, mapped_file)
+        # Only map what was there when the window was opened, even if
+        # more messages have been written since (and never more than the
+        # file has, in case it's just been archived)
+        length = max(0, min(self.size - self.starts[number], os.fstat(mapped_file.fileno()).st_size)) if segment is None else mapped_file.tell()
+        # Empty files can't be mapped
+        mapping = mmap.mmap(mapped_file.fileno(), length, access=mmap.ACCESS_READ) if length else b""
+        self.maps[number] = (mapping, mapped_file)
+        return mapping
+
+    # The number of the piece holding offset, and its bytes
+    def piece_at(self, offset):
+        number = bisect.bisect_right(self.starts, offset) - 1
+        # The live file being smaller than when the window was opened means
+        # it's been archived, and that part of it is in a segment now
+        if self.pieces[number][1] is None and os.path.getsize(self.log_path) < self.size - self.starts[number]:
+            self.load_pieces()
+            number = bisect.bisect_right(self.starts, offset) - 1
+        return number, self.buffer(number)
+
+    # Up to line_count lines ending at offset.
+    # Returns the offset of the first one, and the lines as text.
+    def lines_before(self, offset, line_count):
+        lines = []
+        while len(lines) < line_count and offset > 0:
+            number, buffer = self.piece_at(offset - 1)
+            end = offset - self.starts[number]
+            if end > len(buffer): # Archived while it was being read
+                break
+            line_start = buffer.rfind(b"\n", 0, end - 1) + 1
+            lines.append(buffer[line_start:end])
+            offset = self.starts[number] + line_start
+        lines.reverse()
+        return offset, [line.decode("utf-8", errors="replace") for line in lines]
+
+    # Up to line_count lines starting at offset.
+    # Returns the offset just after the last one, and the lines as text.
+    def lines_after(self, offset, line_count):
+        lines = []
+        while len(lines) < line_count and offset < self.size:
+            number, buffer = self.piece_at(offset)
+            start = offset - self.starts[number]
+            if start >= len(buffer): # Archived while it was being read
+                break
+            line_end = buffer.find(b"\n", start) + 1 or len(buffer)
+            lines.append(buffer[start:line_end])
+            offset = self.starts[number] + line_end
+        return offset, [line.decode("utf-8", errors="replace") for line in lines]
+
+# Last line_count lines of a log, reaching back into the archived
+# segments if the live file doesn't have enough of them. Compressed
+# segments can't be read from the end, so they're read a line at a time,
+# keeping only the lines still needed rather than the whole segment.
+def tail_log(log_path, line_count):
+    import collections
+    lines = tail_lines(log_path, line_count)
+    segments = load_segments(log_path)
+    while len(lines) < line_count and segments:
+        with open_log_piece(log_path, segments.pop()) as piece:
+            last_lines = collections.deque(piece, maxlen=line_count - len(lines))
+        lines = [line.decode("utf-8", errors="replace") for line in last_lines] + lines
+    return lines
+
+# Move the live log into a compressed segment if it's from an earlier month
+# or has gotten too big. log_file is the open live log, which is emptied.
+def archive_log_if_due(log_file, compression):
+    log_path = log_file.name
+    if compression not in SEGMENT_COMPRESSION:
+        return False
+    log_file.flush()
+    # Keep other MultiChats from adding to the log while it's moved
+    with LockedFile(log_file.fileno()):
+        size = os.path.getsize(log_path)
+        if size == 0:
+            return False
+        last_changed = datetime.fromtimestamp(os.path.getmtime(log_path))
+        if last_changed.strftime("%Y-%m") == datetime.now().strftime("%Y-%m") and size < SEGMENT_MAX_BYTES:
+            return False
+        print("Archiving older messages, this may take a moment...")
+        extension = SEGMENT_COMPRESSION[compression]
+        base_name = os.path.basename(log_path).removesuffix(".txt") + "." + last_changed.strftime("%Y-%m")
+        segment_name = base_name + ".txt" + extension
+        number = 1
+        while os.path.exists(os.path.join(os.path.dirname(log_path), segment_name)):
+            number += 1
+            segment_name = f"{base_name}-{number}.txt{extension}"
+        segment_path = os.path.join(os.path.dirname(log_path), segment_name)
+        # Write the segment under a temporary name so a crash can't leave half of one behind
+        with open(log_path, "rb") as source, open_compressed(segment_path + ".tmp", "wb", extension) as segment_file:
+            while True:
+                block = source.read(1024 * 1024)
+                if not block:
+                    break
+                segment_file.write(block)
+        os.replace(segment_path + ".tmp", segment_path)
+        segments = load_segments(log_path)
+        segments.append({"file": segment_name, "size": size})
+        save_segments(log_path, segments)
+        log_file.seek(0)
+        log_file.truncate()
+        log_file.flush()
+        return True
+
+# Matches the date headers written at the start of each chat session,
+# e.g. -----Monday, January 01, 2024-----
+SESSION_HEADER = re.compile(rb"^-----(.+)-----\r?\n?$")
+SESSION_DATE_FORMAT = "%A, %B %d, %Y"
+
+# The session index lives next to the log it belongs to
+def session_index_path(log_path):
+    return log_path.removesuffix(".txt") + ".sessions.pkl"
+
+# Turn the inside of a session header into an ISO date (YYYY-MM-DD)
+def parse_session_date(header_text):
+    try:
+        return datetime.strptime(header_text.decode("utf-8", errors="replace"), SESSION_DATE_FORMAT).date().isoformat()
+    except ValueError:
+        return None
+
+# Find the session headers in a log, starting at byte offset start.
+# Returns a list of (date, offset) pairs and the offset scanning stopped at.
+def scan_sessions(log_path, start=0):
+    sessions = []
+    offset = start
+    for offset, line in iter_log_lines(log_path, start):
+        match = SESSION_HEADER.match(line)
+        if match:
+            day = parse_session_date(match.group(1))
+            if day is not None:
+                sessions.append((day, offset))
+    return sessions, max(start, log_size(log_path))
+
+# Check that the log still looks the way it did when the index was saved.
+# If it shrank, or the last session header we know about moved, someone
+# edited the log outside of MultiChat and the index has to be rebuilt.
+def session_index_valid(session_index, log_path):
+    try:
+        if session_index["size"] > log_size(log_path):
+            return False
+        if session_index["sessions"]:
+            day, offset = session_index["sessions"][-1]
+            match = SESSION_HEADER.match(next(read_log_lines(log_path, [offset])))
+            if not match or parse_session_date(match.group(1)) != day:
+                return False
+    except Exception: # Missing, unreadable, or mangled
+        return False
+    return True
+
+# Written to a temporary file first, so a window reading the index never
+# sees half of it. Each process gets its own temporary file, since two
+# windows on the same chat can save at once.
+def save_session_index(session_index, log_path):
+    index_path = session_index_path(log_path)
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "wb") as index_file:
+            pickle.dump(session_index, index_file)
+        os.replace(temporary_path, index_path)
+    except OSError as error:
+        print("Could not save session index:", error)
+
+# Load the session index for a log, catching up on anything added to the
+# log since it was last saved. Only the new part of the log gets scanned,
+# unless the index is missing or out of date. The caught up index is
+# saved, unless save is False.
+def load_session_index(log_path, save=True):
+    try:
+        with open(session_index_path(log_path), "rb") as index_file:
+            session_index = pickle.load(index_file)
+    except Exception:
+        session_index = None
+    if session_index is None or not session_index_valid(session_index, log_path):
+        session_index = {"size": 0, "sessions": []}
+    if session_index["size"] < log_size(log_path):
+        new_sessions, session_index["size"] = scan_sessions(log_path, session_index["size"])
+        session_index["sessions"].extend(new_sessions)
+        if save:
+            save_session_index(session_index, log_path)
+    return session_index
+
+# Remember that a session header was written at offset, along with any
+# that another MultiChat wrote since the index was loaded
+def add_session(session_index, log_path, day, offset):
+    new_sessions, session_index["size"] = scan_sessions(log_path, session_index["size"])
+    session_index["sessions"].extend(new_sessions)
+    if (day, offset) not in new_sessions:
+        bisect.insort(session_index["sessions"], (day, offset), key=lambda session: session[1])
+    save_session_index(session_index, log_path)
+
+# Find where the first session on or after day starts, or None
+def find_session_offset(session_index, day):
+    sessions = session_index["sessions"]
+    position = bisect.bisect_left(sessions, (day,))
+    if position == len(sessions):
+        return None
+    return sessions[position][1]
+
+# Print lines from a log, starting at byte offset.
+# Stops after line_count lines, or at the end of the log if line_count is None.
+def print_log_from(log_path, offset, line_count=None):
+    for number, (line_offset, line) in enumerate(iter_log_lines(log_path, offset)):
+        if line_count is not None and number >= line_count:
+            break
+        print(line.decode("utf-8", errors="replace"), end="")
+
+# Check that a date is in YYYY-MM-DD format
+def parse_iso_date(text):
+    try:
+        return date.fromisoformat(text.strip()).isoformat()
+    except ValueError:
+        return None
+
+# Colored prefaces end up in the log as ANSI escape codes
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+# Split a log line into the author and the message.
+# Lines look like "name, time: message" or "name: message" depending on
+# the timestamp setting. author is None for lines without a preface.
+def split_preface(line):
+    author, time_text, message = parse_preface(line)
+    return author, message
+
+# Like split_preface(), but also returns the timestamp text (or None)
+def parse_preface(line):
+    line = ANSI_ESCAPE.sub("", line)
+    preface, separator, message = line.partition(": ")
+    if not separator:
+        return None, None, line
+    time_text = None
+    if ", " in preface:
+        preface, time_text = preface.rsplit(", ", 1)
+    return preface, time_text, message
+
+# The terminal codes that start and end each color, worked out once per color
+COLOR_CODES = {}
+
+def color_codes(color):
+    codes = COLOR_CODES.get(color)
+    if codes is None:
+        if color == "default" or not COLORS:
+            codes = ("", "")
+        else:
+            start, marker, end = colored("\0", color).partition("\0")
+            codes = (start, end)
+        COLOR_CODES[color] = codes
+    return codes
+
+# Build the text for a run of log lines, with each user's preface in their
+# current color, so it can be printed all at once. Lines from anyone not
+# in user_list are left as they are.
+def render_log_lines(lines, user_list):
+    # Name -> color codes, or None for people who aren't users
+    author_codes = {}
+    parts = []
+    for line in lines:
+        plain = ANSI_ESCAPE.sub("", line) if "\x1b" in line else line
+        preface, separator, message = plain.partition(": ")
+        if separator:
+            author = preface.rsplit(", ", 1)[0] if ", " in preface else preface
+            codes = author_codes.get(author, False)
+            if codes is False:
+                user = user_list.find_by_name(author)
+                codes = author_codes[author] = color_codes(user.color) if user is not None else None
+            if codes is not None:
+                parts.append(codes[0] + preface + separator + codes[1] + message)
+                continue
+        parts.append(line)
+    return "".join(parts)
+
+# The search index is a dbm database next to the log.
+# For every word it stores how many times it has been seen under
+# "t:<word>", and the byte offsets of the lines it appears in under
+# "c:<word>:<chunk number>", SEARCH_CHUNK_SIZE offsets per chunk.
+# Authors are stored as "@<name>" so they can be searched the same way.
+# Chunks mean adding a message only rewrites one small value per word,
+# and a search only reads the words it asks for.
+SEARCH_CHUNK_SIZE = 512
+SEARCH_RESULT_LIMIT = 20
+SEARCH_WORD = re.compile(r"\w+")
+
+def search_index_path(log_path):
+    return log_path.removesuffix(".txt") + ".search"
+
+# Words (and the author, if known) that a log line should be found by
+def search_terms(line, author=None):
+    line_author, message = split_preface(line)
+    if author is None:
+        author = line_author
+    terms = set(SEARCH_WORD.findall(message.casefold()))
+    if author:
+        terms.add("@" + author.casefold())
+    return terms
+
+# Append offsets to a word's postings, starting a new chunk as each fills up
+def add_postings(database, term, offsets):
+    term = term.encode("utf-8")
+    count = int(database.get(b"t:" + term, b"0"))
+    position = 0
+    while position < len(offsets):
+        chunk_number, used = divmod(count, SEARCH_CHUNK_SIZE)
+        take = offsets[position:position + SEARCH_CHUNK_SIZE - used]
+        chunk_key = b"c:" + term + b":" + str(chunk_number).encode()
+        database[chunk_key] = database.get(chunk_key, b"") + array("Q", take).tobytes()
+        count += len(take)
+        position += len(take)
+    database[b"t:" + term] = str(count).encode()
+
+# Every offset stored for a word, oldest first
+def get_postings(database, term):
+    term = term.encode("utf-8")
+    count = int(database.get(b"t:" + term, b"0"))
+    postings = array("Q")
+    for chunk_number in range((count + SEARCH_CHUNK_SIZE - 1) // SEARCH_CHUNK_SIZE):
+        postings.frombytes(database[b"c:" + term + b":" + str(chunk_number).encode()])
+    return postings
+
+# Collect the terms for a line into pending (term -> offsets)
+def collect_line_postings(pending, line, offset, author=None):
+    if line.strip() and not SESSION_HEADER.match(line):
+        for term in search_terms(line.decode("utf-8", errors="replace"), author):
+            pending.setdefault(term, []).append(offset)
+
+# Collect the terms for each line of data, returning the offset after it
+def collect_postings(pending, data, offset, author=None):
+    for line in data.splitlines(keepends=True):
+        collect_line_postings(pending, line, offset, author)
+        offset += len(line)
+    return offset
+
+def write_postings(search_index, pending, size):
+    database = search_index["database"]
+    for term, offsets in pending.items():
+        add_postings(database, term, offsets)
+    search_index["size"] = size
+    database[b"!size"] = str(size).encode()
+
+# Open (or start) the search index for a log. Nothing is scanned here so
+# opening a chat stays fast- anything missing from the index gets added
+# by catch_up_search_index() the first time /search is used.
+def open_search_index(log_path):
+    index_path = search_index_path(log_path)
+    try:
+        database = dbm.open(index_path, "c")
+        size = int(database.get(b"!size", b"0"))
+    except Exception:
+        database = dbm.open(index_path, "n")
+        size = 0
+    # The log got shorter, so it was edited outside MultiChat. Start over.
+    if size > log_size(log_path):
+        database.close()
+        database = dbm.open(index_path, "n")
+        size = 0
+    in_sync = size == log_size(log_path)
+    return {"database": database, "size": size, "in_sync": in_sync}
+
+# Index everything added to the log since the index was last updated
+def catch_up_search_index(search_index, log_path):
+    if search_index["in_sync"]:
+        return
+    pending = {}
+    for offset, line in iter_log_lines(log_path, search_index["size"]):
+        # Don't hold too much in memory when indexing a big log
+        if len(pending) > 100000:
+            write_postings(search_index, pending, offset)
+            pending = {}
+        collect_line_postings(pending, line, offset)
+    write_postings(search_index, pending, log_size(log_path))
+    search_index["in_sync"] = True
+
+# Index a chunk of text that was just written to the log at offset.
+# If something else was written to the log first (another MultiChat
+# with the same chat open), the index catches up on the next search.
+def index_log_write(search_index, log_file, text, author=None, offset=None):
+    if search_index is None or not search_index["in_sync"]:
+        return
+    if offset is not None and offset != search_index["size"]:
+        search_index["in_sync"] = False
+        return
+    data = text.replace("\n", os.linesep).encode(log_file.encoding, errors="replace")
+    pending = {}
+    size = collect_postings(pending, data, search_index["size"], author)
+    write_postings(search_index, pending, size)
+
+# How hard MultiChat tries to make sure messages reach the disk:
+# - fsync: every message is flushed and synced to disk before the next prompt.
+#   Safest, slowest.
+# - group: messages are handed to the operating system straight away, and
+#   synced to disk in groups, after a set number of messages or
+#   milliseconds, whichever comes first.
+# - os: every message is handed to the operating system straight away but
+#   not synced. Survives MultiChat crashing or the terminal being killed,
+#   but not the whole computer going down.
+LOG_DURABILITY_MODES = ["fsync", "group", "os"]
+
+# Several MultiChat windows can have the same chat open at once, so the
+# log is never written through a buffered file object. Each write goes
+# to the end of the file in a single os.write() on a descriptor opened
+# with O_APPEND, which the OS won't interleave with anyone else's, while
+# holding an advisory lock on the file, so writes of several lines can't be
+# split up and archiving (which takes the same lock) can't empty the log
+# in the middle of one. Locking needs fcntl, which Windows doesn't have;
+# there, writes are still appended but not locked.
+HAS_FCNTL = importlib.util.find_spec("fcntl") is not None
+
+# Hold an exclusive lock on an open file until the with block ends
+class LockedFile:
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+
+    def __enter__(self):
+        if HAS_FCNTL:
+            import fcntl
+            fcntl.flock(self.descriptor, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exception):
+        if HAS_FCNTL:
+            import fcntl
+            fcntl.flock(self.descriptor, fcntl.LOCK_UN)
+
+# The search index, stats and archiving can only be looked after by one
+# MultiChat per chat, so the first one to open a chat claims it with a
+# lock on a file next to the log. Returns the claim, or None if another
+# MultiChat already has the chat.
+def claim_chat(log_path):
+    claim = open(log_path.removesuffix(".txt") + ".lock", "a")
+    if HAS_FCNTL:
+        import fcntl
+        try:
+            fcntl.flock(claim.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            claim.close()
+            return None
+    return claim
+
+def release_chat(claim):
+    if claim is not None:
+        claim.close()
+
+# Writes messages to a log file according to a durability mode
+class LogWriter:
+    def __init__(self, log_file, mode="os", group_messages=20, group_ms=1000):
+        self.log_file = log_file
+        self.encoding = getattr(log_file, "encoding", None) or "utf-8"
+        self.lock = threading.RLock()
+        self.timer = None
+        self.pending = 0
+        # Opened on the first write, and again after finish()
+        self.descriptor = None
+        self.archived_size = 0
+        # What the segment manifest looked like when archived_size was
+        # worked out, to notice another MultiChat archiving the log
+        self.segments_seen = None
+        self.set_mode(mode, group_messages, group_ms)
+
+    def set_mode(self, mode, group_messages=20, group_ms=1000):
+        if mode not in LOG_DURABILITY_MODES:
+            raise ValueError(f"Unknown log durability mode: {mode}")
+        with self.lock:
+            self.mode = mode
+            self.group_messages = max(1, int(group_messages))
+            self.group_ms = max(1, int(group_ms))
+            self.commit()
+
+    def open(self):
+        if self.descriptor is None:
+            self.descriptor = os.open(self.log_file.name, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        return self.descriptor
+
+    # Offsets count the archived parts of the log too, like log_size().
+    # Another MultiChat may have archived the log since the last write, so
+    # check whether the segment manifest has changed. Call with the log locked.
+    def update_archived_size(self):
+        try:
+            status = os.stat(segment_manifest_path(self.log_file.name))
+            segments_seen = (status.st_ino, status.st_size, status.st_mtime_ns)
+        except FileNotFoundError:
+            segments_seen = None
+        if segments_seen != self.segments_seen:
+            self.archived_size = log_pieces(self.log_file.name)[-1][0]
+            self.segments_seen = segments_seen
+
+    # Add text to the end of the log. Returns the offset it starts at,
+    # counting archived parts, which can be further along than expected
+    # if another MultiChat is writing to the same log.
+    # Every write holds the lock on the log, so that other MultiChats'
+    # lines stay whole and archiving never moves the log out from under one.
+    def write(self, text):
+        data = text.replace("\n", os.linesep).encode(self.encoding, errors="replace")
+        with self.lock:
+            descriptor = self.open()
+            with LockedFile(descriptor):
+                self.update_archived_size()
+                self.append(descriptor, data)
+                offset = self.archived_size + os.lseek(descriptor, 0, os.SEEK_CUR) - len(data)
+            if self.mode == "fsync":
+                self.commit()
+            elif self.mode == "group":
+                self.pending += 1
+                if self.pending >= self.group_messages:
+                    self.commit()
+                elif self.timer is None:
+                    # Make sure a quiet chat still gets synced eventually
+                    self.timer = threading.Timer(self.group_ms / 1000, self.commit)
+                    self.timer.daemon = True
+                    self.timer.start()
+            return offset
+
+    # One write almost always takes everything; keep going if it doesn't
+    def append(self, descriptor, data):
+        written = os.write(descriptor, data)
+        while written < len(data):
+            written += os.write(descriptor, data[written:])
+
+    # Make sure anything written through the log file object itself has
+    # reached the OS. Writes through write() always have.
+    def flush(self):
+        with self.lock:
+            if not self.log_file.closed:
+                self.log_file.flush()
+
+    # Sync everything written so far to disk
+    def commit(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = 0
+            if self.descriptor is not None and self.mode != "os":
+                start = time.perf_counter()
+                os.fsync(self.descriptor)
+                if PERF is not None:
+                    PERF.record("flush", start)
+
+    # Sync anything outstanding, stop the group commit timer, and let go
+    # of the log. The log file object is left open for whoever opened it.
+    def finish(self):
+        with self.lock:
+            self.commit()
+            if self.descriptor is not None:
+                os.close(self.descriptor)
+                self.descriptor = None
+
+# Runs slow file work (log writes, index updates, settings saves) on a
+# worker thread, in the order it was asked for, so a slow disk never
+# holds up typing. Jobs that pile up while one is running are done
+# together in one trip to the worker. Errors are kept for report_errors()
+# rather than printed over whatever the user is typing.
+class BackgroundIO:
+    def __init__(self):
+        import asyncio
+        self.queue = asyncio.Queue()
+        self.errors = []
+        self.task = None
+
+    # Start working through jobs; call from inside the event loop
+    def start(self):
+        import asyncio
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def submit(self, function, *args):
+        self.queue.put_nowait((function, args))
+
+    async def run(self):
+        import asyncio
+        while True:
+            jobs = [await self.queue.get()]
+            while not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+            await asyncio.to_thread(self.run_jobs, jobs)
+            for job in jobs:
+                self.queue.task_done()
+
+    def run_jobs(self, jobs):
+        for function, args in jobs:
+            try:
+                function(*args)
+            except Exception as error:
+                self.errors.append(error)
+
+    # Wait for everything submitted so far to be done
+    async def drain(self):
+        await self.queue.join()
+
+    async def stop(self):
+        await self.drain()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    # Tell the user about anything that went wrong in the background
+    def report_errors(self):
+        while self.errors:
+            error = self.errors.pop(0)
+            if isinstance(error, PermissionError):
+                print("Cannot save to file: permission denied. Do you have permission to write to your log save location?")
+            else:
+                print("Error:", error)
+                print("Your message may not have been saved.")
+
+# Optional timing of the things MultiChat does for every message, to see
+# what's slow when it feels sluggish. Off unless turned on with /perf on
+# or --profile, and costs nothing while off.
+# Times are kept in a histogram per step rather than as a list, so memory
+# stays the same however long the chat goes on. Each bucket is 25% wider
+# than the last, which is close enough for p50 and p99.
+PERF_BUCKET_BOUNDS = [1e-6 * 1.25 ** number for number in range(100)] # 1 us to about 4 hours
+PERF_STEPS = ["prompt wait", "switch check", "dispatch", "command", "log write", "index update", "flush"]
+
+class PerfStats:
+    def __init__(self):
+        # Steps run on the background writer as well as the chat loop
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.steps = {}
+
+    # Record that a step took from start until now. Returns now, so
+    # steps that follow each other can be timed back to back.
+    def record(self, step, start):
+        now = time.perf_counter()
+        elapsed = now - start
+        with self.lock:
+            timing = self.steps.get(step)
+            if timing is None:
+                timing = self.steps[step] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(PERF_BUCKET_BOUNDS) + 1)}
+            timing["count"] += 1
+            timing["total"] += elapsed
+            timing["max"] = max(timing["max"], elapsed)
+            timing["buckets"][bisect.bisect_left(PERF_BUCKET_BOUNDS, elapsed)] += 1
+        return now
+
+    # Estimate the time fraction of a step's runs finished within, in seconds
+    def percentile(self, step, fraction):
+        timing = self.steps[step]
+        wanted = fraction * timing["count"]
+        seen = 0
+        for number, count in enumerate(timing["buckets"]):
+            seen += count
+            if seen >= wanted and count:
+                if number == len(PERF_BUCKET_BOUNDS):
+                    return timing["max"]
+                return min(PERF_BUCKET_BOUNDS[number], timing["max"])
+        return timing["max"]
+
+    def print_summary(self):
+        print(f"MultiChat: Timings for the last {time.perf_counter() - self.started:.0f} seconds:")
+        print(f"{'step':<14}{'count':>8}{'total ms':>12}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        with self.lock:
+            steps = sorted(self.steps, key=lambda step: PERF_STEPS.index(step) if step in PERF_STEPS else len(PERF_STEPS))
+            for step in steps:
+                timing = self.steps[step]
+                print(f"{step:<14}{timing['count']:>8}{timing['total'] * 1000:>12.1f}{timing['total'] / timing['count'] * 1000:>10.3f}"
+                    f"{self.percentile(step, 0.5) * 1000:>10.3f}{self.percentile(step, 0.99) * 1000:>10.3f}{timing['max'] * 1000:>10.3f}")
+
+# The PerfStats being kept, or None while timing is off
+PERF = None
+
+# Build a LogWriter using the durability settings
+def make_log_writer(log_file, settings):
+    return LogWriter(log_file, settings["log_durability"], settings["group_commit_messages"], settings["group_commit_ms"])
+
+# Write to the log, keeping the search index up to date.
+# Returns the offset the text was written at.
+def write_log(log_writer, search_index, text, author=None):
+    offset = log_writer.write(text)
+    index_log_write(search_index, log_writer.log_file, text, author, offset)
+    return offset
+
+# Split a search into the words to look for and the @authors to filter by
+def parse_search_query(query):
+    import shlex
+    try:
+        parts = shlex.split(query)
+    except ValueError:
+        parts = query.split()
+    words = set()
+    authors = set()
+    for part in parts:
+        if part.startswith("@") and len(part) > 1:
+            authors.add(part[1:].casefold())
+        else:
+            words.update(SEARCH_WORD.findall(part.casefold()))
+    return sorted(words), sorted(authors)
+
+# Find the lines matching every word in a query.
+# Words starting with @ match the author instead, e.g. @Alice or @"Mary Sue".
+# Returns the total number of matches and the offsets of the newest ones.
+def search_log(search_index, query, limit=SEARCH_RESULT_LIMIT):
+    words, authors = parse_search_query(query)
+    terms = set(words) | set("@" + author for author in authors)
+    if not terms:
+        return 0, []
+    # Start with the rarest term so the intersections stay small
+    postings = sorted((get_postings(search_index["database"], term) for term in terms), key=len)
+    matches = set(postings[0])
+    for other in postings[1:]:
+        if not matches:
+            break
+        matches.intersection_update(other)
+    return len(matches), sorted(matches)[-limit:]
+
+# Print the lines of a log at each offset
+def print_log_lines(log_path, offsets):
+    for line in read_log_lines(log_path, offsets):
+        print(line.decode("utf-8", errors="replace"), end="")
+
+# Quotes are saved one per line, e.g.
+# On Monday, January 01, 2024, Alice said: hello
+QUOTE_LINE = re.compile(rb"^On [^,]+, [^,]+, \d+, (.+?) said: ")
+
+# The quote index lives next to the quotes file. It holds the byte offset
+# of every quote, plus which of those quotes each author said, so picking
+# a quote is one seek and one read instead of reading the whole file.
+def quote_index_path(quote_path):
+    return quote_path.removesuffix(".txt") + ".index.pkl"
+
+# Index the quotes in a quotes file from byte offset start onward.
+# A half-written last line is left for next time.
+def scan_quotes(quote_index, quote_path, start):
+    with open(quote_path, "rb") as quote_file:
+        quote_file.seek(start)
+        offset = start
+        for line in quote_file:
+            if not line.endswith(b"\n"):
+                break
+            index_quote(quote_index, line, offset)
+            offset += len(line)
+    quote_index["size"] = offset
+
+# Remember that the quote in line starts at offset
+def index_quote(quote_index, line, offset):
+    position = len(quote_index["offsets"])
+    quote_index["offsets"].append(offset)
+    match = QUOTE_LINE.match(line)
+    if match:
+        author = match.group(1).decode("utf-8", errors="replace").casefold()
+        quote_index["authors"].setdefault(author, array("Q")).append(position)
+
+# Check that the quotes file still looks the way it did when the index
+# was saved: it hasn't shrunk, and the last quote we know about still
+# starts at the beginning of a line and ends where the index says.
+def quote_index_valid(quote_index, quote_path):
+    try:
+        if quote_index["size"] > os.path.getsize(quote_path):
+            return False
+        if quote_index["offsets"]:
+            offset = quote_index["offsets"][-1]
+            with open(quote_path, "rb") as quote_file:
+                quote_file.seek(max(0, offset - 1))
+                if offset > 0 and quote_file.read(1) != b"\n":
+                    return False
+                if offset + len(quote_file.readline()) != quote_index["size"]:
+                    return False
+    except Exception: # Missing, unreadable, or mangled
+        return False
+    return True
+
+def save_quote_index(quote_index, quote_path):
+    try:
+        with open(quote_index_path(quote_path), "wb") as index_file:
+            pickle.dump(quote_index, index_file)
+    except OSError as error:
+        print("Could not save quote index:", error)
+
+# Load the quote index, catching up on any quotes added since it was
+# saved. Makes an empty quotes file if there isn't one yet.
+def load_quote_index(quote_path):
+    if not os.path.exists(quote_path):
+        open(quote_path, "a").close()
+    try:
+        with open(quote_index_path(quote_path), "rb") as index_file:
+            quote_index = pickle.load(index_file)
+    except Exception:
+        quote_index = None
+    if quote_index is None or not quote_index_valid(quote_index, quote_path):
+        quote_index = {"size": 0, "offsets": array("Q"), "authors": {}}
+    if quote_index["size"] < os.path.getsize(quote_path):
+        scan_quotes(quote_index, quote_path, quote_index["size"])
+        save_quote_index(quote_index, quote_path)
+    return quote_index
+
+# Add a quote to the end of the quotes file and the index.
+# The index itself gets saved when the chat ends; anything added after
+# the last save is picked back up by load_quote_index().
+def add_quote(quote_index, quote_path, quote_text):
+    line = quote_text.encode("utf-8")
+    with open(quote_path, "ab") as quote_file:
+        offset = quote_file.seek(0, os.SEEK_END)
+        quote_file.write(line)
+    index_quote(quote_index, line, offset)
+    quote_index["size"] = offset + len(line)
+
+# How many quotes there are, optionally only from one author
+def count_quotes(quote_index, author=None):
+    if author is None:
+        return len(quote_index["offsets"])
+    return len(quote_index["authors"].get(author.casefold(), ()))
+
+# Read one random quote, optionally only from one author.
+# Returns None if there are no quotes to pick from.
+def random_quote(quote_index, quote_path, author=None):
+    import random
+    if author is None:
+        if not quote_index["offsets"]:
+            return None
+        offset = random.choice(quote_index["offsets"])
+    else:
+        positions = quote_index["authors"].get(author.casefold())
+        if not positions:
+            return None
+        offset = quote_index["offsets"][random.choice(positions)]
+    with open(quote_path, "rb") as quote_file:
+        quote_file.seek(offset)
+        return quote_file.readline().decode("utf-8", errors="replace")
+
+# When turned on in /settings, every message is also recorded in a JSON
+# Lines file next to the log (chat.jsonl), one record per message:
+# {"time": "2024-01-01T12:00:00", "proxy": "1", "author": "Alice", "kind": "message", "offset": 1234}
+# kind is one of STRUCTURED_KINDS. offset is where the message starts in
+# the log, counting archived parts, the same as the session and search
+# indexes. Older logs can be filled in with --backfill-jsonl.
+STRUCTURED_KINDS = ["message", "dice", "quote", "emote"]
+
+def structured_log_path(log_path):
+    return log_path.removesuffix(".txt") + ".jsonl"
+
+# Open the structured log for appending. Callers flush the LogWriter
+# first, so that offsets start from the real end of the log.
+def open_structured_log(log_path):
+    structured_file = open(structured_log_path(log_path), "a", encoding="utf-8")
+    return {"file": structured_file, "size": log_size(log_path)}
+
+def close_structured_log(structured_log):
+    if structured_log is not None:
+        structured_log["file"].close()
+
+def structured_record(time_text, proxy, author, kind, offset):
+    import json
+    return json.dumps({"time": time_text, "proxy": proxy, "author": author, "kind": kind, "offset": offset}, ensure_ascii=False) + "\n"
+
+# Keep the structured log up to date with text written to the log.
+# Writes without a user (date markers, MultiChat notices) only move the
+# offset along. offset is where the text was written, if known.
+# Records are buffered until the caller flushes the file.
+def structured_log_write(structured_log, log_file, text, user=None, kind="message", now=None, offset=None):
+    if structured_log is None:
+        return
+    if offset is not None:
+        structured_log["size"] = offset
+    if user is not None:
+        time_text = (now or datetime.now()).isoformat(timespec="seconds")
+        structured_log["file"].write(structured_record(time_text, user.proxy, user.username, kind, structured_log["size"]))
+    structured_log["size"] += len(text.replace("\n", os.linesep).encode(log_file.encoding, errors="replace"))
+
+# Lines MultiChat writes without a preface, and what kind of line they are.
+# Names can't contain ": ", so these don't match ordinary messages.
+STRUCTURED_NAME = r"^((?:(?!: ).)+)"
+STRUCTURED_LINES = [
+    (re.compile(STRUCTURED_NAME + r" rolled a \d+-sided die and rolled a \d+!$"), "dice"),
+    (re.compile(STRUCTURED_NAME + r' added: ".*" to the quotes!$'), "quote"),
+    (re.compile(STRUCTURED_NAME + r" shrugs\.$"), "emote"),
+    (re.compile(STRUCTURED_NAME + r" has unleashed an infohazard!$"), "emote"),
+]
+# Messages after a preface that are really emotes or commands
+STRUCTURED_MESSAGES = {"(╯°□°）╯︵ ┻━┻": "emote", "Eyes emoji": "emote", "👍": "emote", "": "emote", "/quote": "quote"}
+
+# Work out who wrote a log line, when, and what kind of line it is.
+# Returns (author, time text, kind, message), or None for lines that
+# aren't messages. message is whatever came after the preface, if any.
+def classify_log_line(line):
+    line = ANSI_ESCAPE.sub("", line.rstrip("\r\n"))
+    for pattern, kind in STRUCTURED_LINES:
+        match = pattern.match(line)
+        if match:
+            return match.group(1), None, kind, ""
+    author, time_text, message = parse_preface(line)
+    if author is None or author.startswith("MultiChat"):
+        return None
+    if message.startswith("/quote "):
+        return author, time_text, "quote", message
+    return author, time_text, STRUCTURED_MESSAGES.get(message, "message"), message
+
+# Put a session date and a line's timestamp together into an ISO
+# date and time. Falls back to the date alone if the timestamp is
+# missing or doesn't match timestamp_format, or None without a date.
+def log_line_time(day, time_text, timestamp_format):
+    if day is None:
+        return None
+    if time_text is not None:
+        time_of_day = parse_log_time(time_text, timestamp_format)
+        if time_of_day is not None:
+            return day + "T" + time_of_day
+    return day
+
+# strptime is slow, and lots of lines share a timestamp
+@functools.lru_cache(maxsize=4096)
+def parse_log_time(time_text, timestamp_format):
+    try:
+        return datetime.strptime(time_text, timestamp_format).time().isoformat(timespec="seconds")
+    except ValueError:
+        return None
+
+# Rebuild the structured log for a log from scratch, reading the log a
+# line at a time. Times come from the session headers plus each line's
+# timestamp, parsed with timestamp_format; lines whose timestamp doesn't
+# parse get the date alone. Proxies come from user_list where the
+# author's name is in it. Returns the number of records written.
+def backfill_structured_log(log_path, user_list, timestamp_format):
+    record_count = 0
+    day = None
+    temporary_path = structured_log_path(log_path) + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as structured_file:
+        for offset, line in iter_log_lines(log_path):
+            header = SESSION_HEADER.match(line)
+            if header:
+                day = parse_session_date(header.group(1)) or day
+                continue
+            classified = classify_log_line(line.decode("utf-8", errors="replace"))
+            if classified is None:
+                continue
+            author, time_text, kind, message = classified
+            when = log_line_time(day, time_text, timestamp_format)
+            user = user_list.find_by_name(author)
+            proxy = user.proxy if user is not None else None
+            structured_file.write(structured_record(when, proxy, author, kind, offset))
+            record_count += 1
+    os.replace(temporary_path, structured_log_path(log_path))
+    return record_count
+
+# Running totals for /stats, kept next to the log (chat.stats.pkl):
+# per user, how many messages they've sent, how many characters were in
+# them, and when they were first and last seen; and per day, how many
+# messages were sent. Days are the session dates in the log.
+# The totals are updated as messages are written, and only the part of
+# the log written since they were last saved ever needs to be read.
+def stats_path(log_path):
+    return log_path.removesuffix(".txt") + ".stats.pkl"
+
+def new_stats():
+    return {"size": 0, "last_line": None, "day": None, "users": {}, "days": {}, "in_sync": False}
+
+# Add one line of the log (as bytes) to the totals
+def count_log_line(stats, line, offset, timestamp_format):
+    stats["size"] = offset + len(line)
+    stats["last_line"] = offset
+    header = SESSION_HEADER.match(line)
+    if header:
+        stats["day"] = parse_session_date(header.group(1)) or stats["day"]
+        return
+    classified = classify_log_line(line.decode("utf-8", errors="replace"))
+    if classified is None:
+        return
+    author, time_text, kind, message = classified
+    when = log_line_time(stats["day"], time_text, timestamp_format)
+    user_stats = stats["users"].get(author)
+    if user_stats is None:
+        user_stats = stats["users"][author] = {"messages": 0, "characters": 0, "first_seen": when, "last_seen": when}
+    user_stats["messages"] += 1
+    if kind == "message":
+        user_stats["characters"] += len(message)
+    if when is not None:
+        # Don't swap a time for just the date it's already on
+        if user_stats["last_seen"] is None or not user_stats["last_seen"].startswith(when):
+            user_stats["last_seen"] = when
+        if user_stats["first_seen"] is None:
+            user_stats["first_seen"] = when
+    if stats["day"] is not None:
+        stats["days"][stats["day"]] = stats["days"].get(stats["day"], 0) + 1
+
+# Check that the log still looks the way it did when the totals were
+# saved: it hasn't shrunk, and the last line counted still ends where
+# the totals say it does.
+def stats_valid(stats, log_path):
+    try:
+        if stats["size"] > log_size(log_path):
+            return False
+        if stats["last_line"] is not None:
+            last_line = next(read_log_lines(log_path, [stats["last_line"]]))
+            if stats["last_line"] + len(last_line) != stats["size"]:
+                return False
+    except Exception: # Missing, unreadable, or mangled
+        return False
+    return True
+
+def save_stats(stats, log_path):
+    try:
+        with open(stats_path(log_path), "wb") as stats_file:
+            pickle.dump(dict(stats, in_sync=False), stats_file)
+    except OSError as error:
+        print("Could not save stats:", error)
+
+# Load the saved totals for a log. They're only kept up to date as
+# messages are written if they were already caught up with the log;
+# otherwise catch_up_stats() does that the first time /stats is used.
+def open_stats(log_path):
+    try:
+        with open(stats_path(log_path), "rb") as stats_file:
+            stats = pickle.load(stats_file)
+    except Exception:
+        stats = None
+    if stats is None or not stats_valid(stats, log_path):
+        stats = new_stats()
+    stats["in_sync"] = stats["size"] == log_size(log_path)
+    return stats
+
+# Count everything in the log since the totals were last updated.
+# The first time, this reads the whole log, a line at a time.
+def catch_up_stats(stats, log_path, timestamp_format):
+    if not stats_valid(stats, log_path):
+        stats.update(new_stats())
+    for offset, line in iter_log_lines(log_path, stats["size"]):
+        if not line.endswith(b"\n"):
+            break
+        count_log_line(stats, line, offset, timestamp_format)
+    stats["in_sync"] = True
+
+# Keep the totals up to date with text written to the log
+def stats_log_write(stats, log_file, text, timestamp_format, offset=None):
+    if stats is None or not stats["in_sync"]:
+        return
+    # Someone else wrote to the log; catch up on it with the rest
+    if offset is not None and offset != stats["size"]:
+        stats["in_sync"] = False
+        return
+    data = text.replace("\n", os.linesep).encode(log_file.encoding, errors="replace")
+    # Split the same way reading the log back does, on \n only
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start) + 1 or len(data)
+        count_log_line(stats, data[start:end], stats["size"], timestamp_format)
+        start = end
+
+# Exporting turns a log into a web page or a Markdown document.
+# It's a pipeline of generators: the log is read a line at a time,
+# turned into events, turned into output text, and written out in
+# EXPORT_CHUNK_BYTES pieces, so even huge logs take very little memory.
+EXPORT_CHUNK_BYTES = 1024 * 1024
+EXPORT_FORMATS = {"html": ".html", "md": ".md"}
+# How each terminal color looks on a web page
+EXPORT_COLORS = {"black": "#000000", "red": "#cd3131", "green": "#0dbc79", "yellow": "#b5a600", "blue": "#2472c8", "magenta": "#bc3fbc", "cyan": "#11a8cd", "light_grey": "#a0a0a0", "dark_grey": "#666666", "light_red": "#f14c4c", "light_green": "#23d18b", "light_yellow": "#d7c62a", "light_blue": "#3b8eea", "light_magenta": "#d670d6", "light_cyan": "#29b8db", "white": "#808080"}
+# Colored prefaces are saved in the log with the terminal's color codes
+ANSI_COLOR_CODES = {30: "black", 31: "red", 32: "green", 33: "yellow", 34: "blue", 35: "magenta", 36: "cyan", 37: "light_grey", 90: "dark_grey", 91: "light_red", 92: "light_green", 93: "light_yellow", 94: "light_blue", 95: "light_magenta", 96: "light_cyan", 97: "white"}
+LEADING_ANSI_COLOR = re.compile(r"^\x1b\[(\d+)m")
+
+# Turn a log into a stream of events:
+# ("session", title, anchor) for each session header,
+# ("message", author, preface, message, color) for each message, and
+# ("line", text) for anything else.
+# Each author gets their /color from user_list, or failing that, the
+# color their preface was saved in.
+def export_events(log_path, user_list):
+    anchors = {}
+    for offset, raw_line in iter_log_lines(log_path):
+        header = SESSION_HEADER.match(raw_line)
+        line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+        if header:
+            title = header.group(1).decode("utf-8", errors="replace")
+            anchor = parse_session_date(header.group(1)) or "session"
+            anchors[anchor] = anchors.get(anchor, 0) + 1
+            if anchors[anchor] > 1:
+                anchor += "-" + str(anchors[anchor])
+            yield ("session", title, anchor)
+            continue
+        if line == "":
+            continue
+        author, time_text, message = parse_preface(line)
+        if author is None or author.startswith("MultiChat") or any(pattern.match(line) for pattern, kind in STRUCTURED_LINES):
+            yield ("line", ANSI_ESCAPE.sub("", line))
+            continue
+        user = user_list.find_by_name(author)
+        color = user.color if user is not None else "default"
+        if color == "default":
+            leading = LEADING_ANSI_COLOR.match(line)
+            if leading:
+                color = ANSI_COLOR_CODES.get(int(leading.group(1)), "default")
+        preface = author + (", " + time_text if time_text is not None else "") + ":"
+        yield ("message", author, preface, message, EXPORT_COLORS.get(color))
+
+def render_html(events, title):
+    import html
+    yield "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+    yield f"<title>{html.escape(title)}</title>\n"
+    yield "<style>body { font-family: sans-serif; max-width: 60em; margin: auto; } p { margin: 0.2em 0; white-space: pre-wrap; } .preface { font-weight: bold; } .note { color: #666666; }</style>\n"
+    yield f"</head>\n<body>\n<h1>{html.escape(title)}</h1>\n"
+    in_section = False
+    for event in events:
+        if event[0] == "session":
+            kind, session_title, anchor = event
+            if in_section:
+                yield "</section>\n"
+            yield f"<section id=\"{anchor}\">\n<h2><a href=\"#{anchor}\">{html.escape(session_title)}</a></h2>\n"
+            in_section = True
+        elif event[0] == "message":
+            kind, author, preface, message, color = event
+            style = f" style=\"color: {color}\"" if color is not None else ""
+            yield f"<p><span class=\"preface\"{style}>{html.escape(preface)}</span> {html.escape(message)}</p>\n"
+        else:
+            yield f"<p class=\"note\">{html.escape(event[1])}</p>\n"
+    if in_section:
+        yield "</section>\n"
+    yield "</body>\n</html>\n"
+
+# Characters that mean something in Markdown
+MARKDOWN_SPECIAL = re.compile(r"([\\`*_{}\[\]<>#|~])")
+
+def escape_markdown(text):
+    return MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+def render_markdown(events, title):
+    yield "# " + escape_markdown(title) + "\n"
+    for event in events:
+        if event[0] == "session":
+            kind, session_title, anchor = event
+            yield f"\n<a id=\"{anchor}\"></a>\n\n## {escape_markdown(session_title)}\n\n"
+        elif event[0] == "message":
+            kind, author, preface, message, color = event
+            preface = escape_markdown(preface)
+            if color is not None:
+                preface = f"<span style=\"color: {color}\">{preface}</span>"
+            yield f"**{preface}** {escape_markdown(message)}  \n"
+        else:
+            yield escape_markdown(event[1]) + "  \n"
+
+# Write text out in big chunks rather than a little at a time
+def write_chunked(chunks, output_path, chunk_bytes=EXPORT_CHUNK_BYTES):
+    buffer = []
+    buffered = 0
+    with open(output_path, "w", encoding="utf-8") as output_file:
+        for chunk in chunks:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= chunk_bytes:
+                output_file.write("".join(buffer))
+                buffer.clear()
+                buffered = 0
+        output_file.write("".join(buffer))
+
+# Export a log as html or md (see EXPORT_FORMATS) to output_path.
+# Written to a temporary file first, so a failed export doesn't leave
+# half a file behind.
+def export_log(log_path, output_path, export_format, user_list):
+    title = os.path.basename(log_path).removesuffix(".txt")
+    events = export_events(log_path, user_list)
+    if export_format == "html":
+        chunks = render_html(events, title)
+    else:
+        chunks = render_markdown(events, title)
+    write_chunked(chunks, output_path + ".tmp")
+    os.replace(output_path + ".tmp", output_path)
+
+# Where saved users and quotes are kept, and what chat messages can be
+# searched with. Chosen with the storage_backend setting:
+# - text: saved-users.pkl, quotes.txt and the search index, as always.
+# - sqlite: one database in the chatlog folder (multichat.db) holding
+#   users, quotes, and a copy of every line of every chat, indexed by
+#   time, author and text.
+# Either way the plaintext chat log is still written, since backread,
+# /jump, archiving and /export all read it.
+# A backend is any class with the methods TextStorage has.
+STORAGE_BACKENDS = ["text", "sqlite"]
+SQLITE_DATABASE_NAME = "multichat.db"
+SQLITE_INSERT_MESSAGE = "INSERT INTO messages (chat, time, proxy, author, kind, text, line, offset) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+class TextStorage:
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.quote_path = log_dir + "/quotes.txt"
+        self.quote_index = None
+
+    # Get ready to record a chat's messages. Returns False if the backend
+    # is missing some of what's in the log already.
+    def open_chat(self, chat_name, log_path):
+        return True
+
+    # Record text written to a chat's log at offset (or straight after the
+    # last text, if None). Nothing to do here: the log is the record.
+    # Not saved until commit().
+    def add_text(self, chat_name, text, user=None, kind="message", now=None, offset=None):
+        pass
+
+    def commit(self):
+        pass
+
+    # Find messages like search_log() does, or None to use the search index
+    def search(self, chat_name, query, limit=SEARCH_RESULT_LIMIT):
+        return None
+
+    def load_users(self, output):
+        return load_users(output)
+
+    def save_users(self, user_list):
+        with open(get_settings_dir() + "/saved-users.pkl", "wb") as savefile:
+            pickle.dump(user_list.to_dict(), savefile)
+
+    # The saved users, without printing anything
+    def saved_users(self):
+        if not os.path.isfile(get_settings_dir() + "/saved-users.pkl"):
+            return UserRegistry()
+        with open(get_settings_dir() + "/saved-users.pkl", "rb") as savefile:
+            return UserRegistry.from_dict(pickle.load(savefile))
+
+    def load_quotes(self):
+        # Only read the index the first time quotes are used
+        if self.quote_index is None:
+            self.quote_index = load_quote_index(self.quote_path)
+
+    def add_quote(self, quote_text):
+        self.load_quotes()
+        add_quote(self.quote_index, self.quote_path, quote_text)
+
+    def random_quote(self, author=None):
+        self.load_quotes()
+        return random_quote(self.quote_index, self.quote_path, author)
+
+    def count_quotes(self, author=None):
+        self.load_quotes()
+        return count_quotes(self.quote_index, author)
+
+    # Every quote, oldest first, each ending in a newline
+    def quote_lines(self):
+        if not os.path.isfile(self.quote_path):
+            return []
+        with open(self.quote_path, "r", encoding="utf-8", errors="replace") as quote_file:
+            return [line if line.endswith("\n") else line + "\n" for line in quote_file]
+
+    def add_quotes(self, quote_lines):
+        for quote_text in quote_lines:
+            self.add_quote(quote_text)
+
+    def close(self):
+        if self.quote_index is not None:
+            save_quote_index(self.quote_index, self.quote_path)
+
+class SQLiteStorage:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY, chat TEXT NOT NULL, time TEXT, proxy TEXT,
+        author TEXT, kind TEXT NOT NULL, text TEXT NOT NULL,
+        line TEXT NOT NULL, offset INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS messages_by_time ON messages (chat, time);
+    CREATE INDEX IF NOT EXISTS messages_by_author ON messages (chat, author COLLATE NOCASE, time);
+    CREATE INDEX IF NOT EXISTS messages_by_offset ON messages (chat, offset);
+    CREATE TABLE IF NOT EXISTS users (
+        position INTEGER PRIMARY KEY, proxy TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL, color TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS quotes (
+        id INTEGER PRIMARY KEY, time TEXT, author TEXT, line TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS quotes_by_author ON quotes (author COLLATE NOCASE);
+    CREATE TABLE IF NOT EXISTS chats (
+        chat TEXT PRIMARY KEY, complete_size INTEGER NOT NULL);
+    """
+    # Full-text search, kept up to date by triggers
+    FULL_TEXT_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5(text, content='messages', content_rowid='id');
+    CREATE TRIGGER IF NOT EXISTS messages_text_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_text (rowid, text) VALUES (new.id, new.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_text_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_text (messages_text, rowid, text) VALUES ('delete', old.id, old.text);
+    END;
+    """
+
+    def __init__(self, log_dir, durability="os"):
+        import sqlite3
+        self.log_dir = log_dir
+        self.path = log_dir + "/" + SQLITE_DATABASE_NAME
+        # Only ever used from one thread at a time, but not always the same one
+        self.database = sqlite3.connect(self.path, check_same_thread=False)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL can lose the last few commits in a power cut,
+        # but never corrupts the database
+        self.database.execute("PRAGMA synchronous=" + ("FULL" if durability == "fsync" else "NORMAL"))
+        self.database.executescript(self.SCHEMA)
+        try:
+            self.database.executescript(self.FULL_TEXT_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError: # SQLite built without FTS5
+            self.full_text = False
+        self.database.commit()
+        # Where the next line of each open chat will start in its log
+        self.sizes = {}
+        self.log_paths = {}
+
+    def open_chat(self, chat_name, log_path):
+        size = log_size(log_path)
+        self.sizes[chat_name] = size
+        self.log_paths[chat_name] = log_path
+        if self.complete_size(chat_name) is None:
+            # Not seen this chat before: check how much of it is here
+            line_count, line_bytes, first_offset = self.database.execute("SELECT count(*), coalesce(sum(length(CAST(line AS BLOB))), 0), min(offset) FROM messages WHERE chat = ?", (chat_name,)).fetchone()
+            complete_size = line_bytes + line_count * len(os.linesep) if first_offset in (0, None) else 0
+            with self.database:
+                self.database.execute("INSERT INTO chats (chat, complete_size) VALUES (?, ?)", (chat_name, complete_size))
+        return self.complete_size(chat_name) == size
+
+    # How much of a chat's log the database has every line of, from the
+    # start, or None if it doesn't know about the chat. Stops growing if
+    # anything gets written to the log without being added here too.
+    def complete_size(self, chat_name):
+        row = self.database.execute("SELECT complete_size FROM chats WHERE chat = ?", (chat_name,)).fetchone()
+        return None if row is None else row[0]
+
+    def add_text(self, chat_name, text, user=None, kind="message", now=None, offset=None):
+        when = (now or datetime.now()).isoformat(timespec="seconds")
+        if offset is None:
+            offset = self.sizes.get(chat_name, 0)
+        start = offset
+        rows = []
+        for number, line in enumerate(text.split("\n")[:-1]):
+            if number == 0 and user is not None:
+                author, time_text, message = parse_preface(line)
+                if author != user.username:
+                    message = ANSI_ESCAPE.sub("", line)
+                rows.append((chat_name, when, user.proxy, user.username, kind, message, line, offset))
+            else:
+                rows.append(classify_storage_row(chat_name, line, offset, when))
+            offset += len((line + os.linesep).encode("utf-8", errors="replace"))
+        self.sizes[chat_name] = offset
+        self.database.executemany(SQLITE_INSERT_MESSAGE, rows)
+        self.database.execute("UPDATE chats SET complete_size = ? WHERE chat = ? AND complete_size = ?", (offset, chat_name, start))
+
+    def commit(self):
+        self.database.commit()
+
+    # Find messages from a chat, newest last. Any of the filters can be left out:
+    # author matches regardless of case, since and until are YYYY-MM-DD dates
+    # (until includes that whole day), and every word in words has to appear.
+    # Returns the total number of matches and the newest limit of them as
+    # (offset, line) pairs.
+    def query_messages(self, chat_name, author=None, since=None, until=None, words=(), limit=SEARCH_RESULT_LIMIT):
+        conditions = ["chat = ?", "kind NOT IN ('session', 'note')"]
+        parameters = [chat_name]
+        if author is not None:
+            conditions.append("author = ? COLLATE NOCASE")
+            parameters.append(author)
+        if since is not None:
+            conditions.append("time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            parameters.append((date.fromisoformat(until) + timedelta(days=1)).isoformat())
+        if words and self.full_text:
+            conditions.append("id IN (SELECT rowid FROM messages_text WHERE messages_text MATCH ?)")
+            parameters.append(" ".join('"' + word.replace('"', '""') + '"' for word in words))
+        else:
+            for word in words:
+                conditions.append("text LIKE ?")
+                parameters.append("%" + word + "%")
+        where = " AND ".join(conditions)
+        match_count = self.database.execute(f"SELECT count(*) FROM messages WHERE {where}", parameters).fetchone()[0]
+        rows = self.database.execute(f"SELECT offset, line FROM messages WHERE {where} ORDER BY id DESC LIMIT ?", parameters + [limit]).fetchall()
+        return match_count, rows[::-1]
+
+    # Returns None if the database doesn't have all of the chat's log yet
+    # (it was never imported), since the results would be missing matches.
+    def search(self, chat_name, query, limit=SEARCH_RESULT_LIMIT):
+        log_path = self.log_paths.get(chat_name)
+        if log_path is None or self.complete_size(chat_name) != log_size(log_path):
+            return None
+        words, authors = parse_search_query(query)
+        if not words and not authors:
+            return 0, []
+        if len(authors) > 1: # A line only has one author
+            return 0, []
+        match_count, rows = self.query_messages(chat_name, authors[0] if authors else None, words=words, limit=limit)
+        return match_count, [offset for offset, line in rows]
+
+    def load_users(self, output):
+        user_list = self.saved_users()
+        if len(user_list) == 0:
+            print("No saved users found. Save current users by sending /save\nwhile in chat.")
+        else:
+            print("Loaded users from database.")
+            if output == True:
+                list_users(user_list)
+        return user_list
+
+    def save_users(self, user_list):
+        with self.database:
+            self.database.execute("DELETE FROM users")
+            self.database.executemany("INSERT INTO users (position, proxy, username, color) VALUES (?, ?, ?, ?)", [(position, user.proxy, user.username, user.color) for position, user in enumerate(user_list)])
+
+    def saved_users(self):
+        user_list = UserRegistry()
+        for proxy, username, color in self.database.execute("SELECT proxy, username, color FROM users ORDER BY position"):
+            user_list.add(username, proxy, color)
+        return user_list
+
+    def add_quote(self, quote_text):
+        self.add_quotes([quote_text], date.today().isoformat())
+
+    # Quotes added this way all get the same time (or none)
+    def add_quotes(self, quote_lines, time=None):
+        rows = []
+        for quote_text in quote_lines:
+            match = QUOTE_LINE.match(quote_text.encode("utf-8"))
+            author = match.group(1).decode("utf-8") if match else None
+            rows.append((time, author, quote_text.rstrip("\n")))
+        with self.database:
+            self.database.executemany("INSERT INTO quotes (time, author, line) VALUES (?, ?, ?)", rows)
+
+    def quote_lines(self):
+        return [line + "\n" for (line,) in self.database.execute("SELECT line FROM quotes ORDER BY id")]
+
+    # Picks a random id and takes the next quote from there, so it doesn't
+    # have to look at every quote
+    def random_quote(self, author=None):
+        import random
+        author_condition = "" if author is None else " AND author = ? COLLATE NOCASE"
+        author_parameters = [] if author is None else [author]
+        highest = self.database.execute("SELECT max(id) FROM quotes WHERE 1" + author_condition, author_parameters).fetchone()[0]
+        if highest is None:
+            return None
+        row = self.database.execute("SELECT line FROM quotes WHERE id >= ?" + author_condition + " ORDER BY id LIMIT 1", [random.randint(1, highest)] + author_parameters).fetchone()
+        return row[0] + "\n"
+
+    def count_quotes(self, author=None):
+        if author is None:
+            return self.database.execute("SELECT count(*) FROM quotes").fetchone()[0]
+        return self.database.execute("SELECT count(*) FROM quotes WHERE author = ? COLLATE NOCASE", (author,)).fetchone()[0]
+
+    def close(self):
+        self.database.commit()
+        self.database.close()
+
+# Work out what a line of a log is, for storing it in the database.
+# With a timestamp_format, when is the session's date and the line's own
+# timestamp gets added to it, the same as backfill_structured_log().
+def classify_storage_row(chat_name, line, offset, when, user_list=None, timestamp_format=None):
+    if SESSION_HEADER.match(line.encode("utf-8", errors="replace")):
+        return (chat_name, when, None, None, "session", line, line, offset)
+    classified = classify_log_line(line)
+    if classified is None:
+        return (chat_name, when, None, None, "note", ANSI_ESCAPE.sub("", line), line, offset)
+    author, time_text, kind, message = classified
+    if timestamp_format is not None:
+        when = log_line_time(when, time_text, timestamp_format)
+    user = user_list.find_by_name(author) if user_list is not None else None
+    return (chat_name, when, user.proxy if user is not None else None, author, kind, message or ANSI_ESCAPE.sub("", line), line, offset)
+
+# Bring saved users and quotes along when switching storage backends, so
+# they don't seem to vanish. The old backend's users replace the new one's,
+# unless it has none; quotes the new backend doesn't have yet are added.
+# Chat messages are left to --import-sqlite, since the logs are kept either way.
+def copy_saved_data(old_storage, new_storage):
+    user_list = old_storage.saved_users()
+    if len(user_list) != 0:
+        new_storage.save_users(user_list)
+    known_quotes = set(new_storage.quote_lines())
+    new_storage.add_quotes([quote_text for quote_text in old_storage.quote_lines() if quote_text not in known_quotes])
+
+# Open the storage backend chosen in the settings
+def open_storage(settings):
+    if settings["storage_backend"] == "sqlite":
+        return SQLiteStorage(settings["savedir"], settings["log_durability"])
+    return TextStorage(settings["savedir"])
+
+# Copy everything in a chatlog folder (every chat log and quotes.txt),
+# plus the users in user_list, into the SQLite database, replacing
+# anything from those chats that's already there. Logs are read a line
+# at a time and added in batches. Keeping the full-text index up to date row by row is
+# most of the cost of adding a message, so it's turned off while
+# importing and rebuilt in one go at the end. Returns the number of
+# lines copied.
+SQLITE_IMPORT_BATCH = 10000
+
+def import_into_sqlite(storage, log_dir, user_list, timestamp_format):
+    database = storage.database
+    if storage.full_text:
+        database.executescript("DROP TRIGGER IF EXISTS messages_text_insert; DROP TRIGGER IF EXISTS messages_text_delete;")
+    line_count = 0
+    for chat_name in find_chats(log_dir):
+        log_path = log_dir + "/" + chat_name + ".txt"
+        day = None
+        rows = []
+        size = 0
+        with database:
+            database.execute("DELETE FROM messages WHERE chat = ?", (chat_name,))
+            for offset, raw_line in iter_log_lines(log_path):
+                size = offset + len(raw_line)
+                header = SESSION_HEADER.match(raw_line)
+                if header:
+                    day = parse_session_date(header.group(1)) or day
+                line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+                rows.append(classify_storage_row(chat_name, line, offset, day, user_list, timestamp_format))
+                if len(rows) >= SQLITE_IMPORT_BATCH:
+                    database.executemany(SQLITE_INSERT_MESSAGE, rows)
+                    line_count += len(rows)
+                    rows.clear()
+            database.executemany(SQLITE_INSERT_MESSAGE, rows)
+            line_count += len(rows)
+            database.execute("INSERT OR REPLACE INTO chats (chat, complete_size) VALUES (?, ?)", (chat_name, size))
+    if storage.full_text:
+        database.executescript(SQLiteStorage.FULL_TEXT_SCHEMA)
+        with database:
+            database.execute("INSERT INTO messages_text (messages_text) VALUES ('rebuild')")
+    if len(user_list) != 0:
+        storage.save_users(user_list)
+    quote_path = log_dir + "/quotes.txt"
+    if os.path.isfile(quote_path):
+        with storage.database:
+            storage.database.execute("DELETE FROM quotes")
+            with open(quote_path, "r", encoding="utf-8", errors="replace") as quote_file:
+                for line in quote_file:
+                    match = QUOTE_LINE.match(line.encode("utf-8"))
+                    author = match.group(1).decode("utf-8") if match else None
+                    storage.database.execute("INSERT INTO quotes (time, author, line) VALUES (?, ?, ?)", (None, author, line.rstrip("\n")))
+    return line_count
+
+# Write everything in the SQLite database back out as plaintext: a .txt
+# log for each chat, saved-users.pkl and quotes.txt, all in output_dir.
+def export_from_sqlite(storage, output_dir):
+    make_dir_exist(output_dir)
+    chat_names = [row[0] for row in storage.database.execute("SELECT DISTINCT chat FROM messages")]
+    for chat_name in chat_names:
+        rows = storage.database.execute("SELECT line FROM messages WHERE chat = ? ORDER BY offset", (chat_name,))
+        write_chunked((line + "\n" for (line,) in rows), output_dir + "/" + chat_name + ".txt")
+    with open(output_dir + "/saved-users.pkl", "wb") as savefile:
+        pickle.dump(storage.load_users(False).to_dict(), savefile)
+    rows = storage.database.execute("SELECT line FROM quotes ORDER BY id")
+    write_chunked((line + "\n" for (line,) in rows), output_dir + "/quotes.txt")
+    return chat_names
+
+# Names of the chats in a chatlog folder: every .txt file but quotes.txt
+def find_chats(log_dir):
+    return sorted(log_name.removesuffix(".txt") for log_name in os.listdir(log_dir) if log_name.endswith(".txt") and log_name != "quotes.txt")
+
+# The chat catalog (/logs and --logs) lists every chat in a chatlog folder
+# with its size, sessions, messages, last activity and who's in it.
+# Working that out means reading each chat, so the results are kept in
+# catalog.pkl along with the size and modification time of each log, and
+# only chats whose logs have changed since get looked at again. Those are
+# looked at a few at a time in threads, since most of the wait is on
+# reading (and unpacking archived segments).
+CATALOG_NAME = "catalog.pkl"
+CATALOG_THREADS = 4
+
+def load_catalog(log_dir):
+    try:
+        with open(log_dir + "/" + CATALOG_NAME, "rb") as catalog_file:
+            return pickle.load(catalog_file)
+    except Exception: # Missing, unreadable, or mangled
+        return {}
+
+def save_catalog(catalog, log_dir):
+    catalog_path = log_dir + "/" + CATALOG_NAME
+    try:
+        with open(catalog_path + ".tmp", "wb") as catalog_file:
+            pickle.dump(catalog, catalog_file)
+        os.replace(catalog_path + ".tmp", catalog_path)
+    except OSError as error:
+        print("Could not save chat catalog:", error)
+
+# What a log's catalog entry was worked out from. Archiving a log
+# empties it, so this changes then too.
+def catalog_key(log_path):
+    status = os.stat(log_path)
+    return (status.st_size, status.st_mtime_ns)
+
+# Work out the catalog entry for one chat. Starts from the saved /stats
+# totals or the ones from its last catalog entry, whichever is further
+# along, so only the part of the log written since then is read. The
+# totals are kept in the catalog rather than saved as the chat's own,
+# since the chat might be open in another window that's keeping those.
+def scan_chat(log_path, timestamp_format, previous=None):
+    key = catalog_key(log_path)
+    stats = open_stats(log_path)
+    if previous is not None and previous["stats"]["size"] > stats["size"] and stats_valid(previous["stats"], log_path):
+        stats = previous["stats"]
+    catch_up_stats(stats, log_path, timestamp_format)
+    users = sorted(stats["users"].items(), key=lambda item: -item[1]["messages"])
+    last_seen = [user_stats["last_seen"] for author, user_stats in users if user_stats["last_seen"] is not None]
+    return {
+        "key": key,
+        "size": log_size(log_path),
+        # Not saved either, for the same reason
+        "sessions": len(load_session_index(log_path, save=False)["sessions"]),
+        "messages": sum(user_stats["messages"] for author, user_stats in users),
+        "last_active": max(last_seen) if last_seen else None,
+        "participants": [author for author, user_stats in users],
+        "stats": stats,
+    }
+
+# Catalog entries for every chat in log_dir, by chat name, scanning any
+# that changed since the catalog was last saved
+def build_catalog(log_dir, timestamp_format):
+    catalog = load_catalog(log_dir)
+    chat_names = find_chats(log_dir)
+    changed = [chat_name for chat_name in chat_names if chat_name not in catalog or catalog[chat_name]["key"] != catalog_key(log_dir + "/" + chat_name + ".txt")]
+    if changed:
+        from concurrent.futures import ThreadPoolExecutor
+        if len(changed) > 1:
+            print(f"MultiChat: Reading {len(changed)} chats, this may take a moment...")
+        with ThreadPoolExecutor(max_workers=CATALOG_THREADS) as executor:
+            entries = executor.map(lambda chat_name: scan_chat(log_dir + "/" + chat_name + ".txt", timestamp_format, catalog.get(chat_name)), changed)
+            catalog.update(zip(changed, entries))
+    if changed or len(catalog) != len(chat_names):
+        catalog = {chat_name: catalog[chat_name] for chat_name in chat_names}
+        save_catalog(catalog, log_dir)
+    return catalog
+
+# Print the catalog, most recently active chats first
+def print_catalog(catalog):
+    if not catalog:
+        print("MultiChat: No chats yet.")
+        return
+    for chat_name, entry in sorted(catalog.items(), key=lambda item: item[1]["last_active"] or "", reverse=True):
+        participants = entry["participants"]
+        people = ", ".join(participants[:5]) + (f" and {len(participants) - 5} more" if len(participants) > 5 else "")
+        last_active = entry["last_active"].replace("T", " ") if entry["last_active"] else "never"
+        print(f"{chat_name}: {entry['size'] / 1024 / 1024:.1f} MB, {entry['sessions']:,} sessions, {entry['messages']:,} messages, last active {last_active}.")
+        if people:
+            print(f"    With {people}.")
+
+# Searching every chat (/searchall and --searchall) can't use the search
+# indexes, since only chats that have been opened have one. Instead each
+# chat log is read straight through in big blocks, with one process per
+# chat so several get read at once. A compiled regex finds the lines that
+# might match in each casefolded block, and only those are decoded and
+# checked properly, the same way /search would. Each line's time comes
+# from the session header before it plus its timestamp, so the results
+# from every chat can be put in time order.
+# Blocks are searched as bytes, lowercased, when the search is plain
+# ASCII and lowercasing gives the same words as casefolding would:
+# decoding and casefolding every block is several times slower. Other
+# searches decode each block and casefold it.
+SEARCH_ALL_BLOCK_SIZE = 1024 * 1024
+# Below this much log (besides the biggest chat), starting the processes
+# takes longer than searching
+SEARCH_ALL_PARALLEL_BYTES = 4 * 1024 * 1024
+# How far back to look for a timestamp for lines without one, like dice rolls
+SEARCH_ALL_TIME_LOOKBACK = 20
+# The characters beyond ASCII that casefold() turns into ASCII, like ß into
+# ss: every character where any(c.isascii() for c in character.casefold()).
+# A block with one of these in it has to be casefolded to be searched.
+# They're looked for among the block's non-ASCII bytes only, which is much
+# quicker than searching the whole block for them.
+SEARCH_ALL_ASCII_BYTES = bytes(range(128))
+SEARCH_ALL_CASEFOLD_TO_ASCII = re.compile(b"|".join(re.escape(character.encode("utf-8")) for character in "\u00df\u0130\u0149\u017f\u01f0\u1e96\u1e97\u1e98\u1e99\u1e9a\u1e9e\u212a\ufb00\ufb01\ufb02\ufb03\ufb04\ufb05\ufb06"))
+
+# A regex for the lines that could match a search, from its words (or
+# just its authors if there are no words), for searching casefolded text
+# (as bytes if as_bytes). Blocks are searched with a line break added at
+# the start, so an author's name can be matched right after one.
+def search_candidate_pattern(words, authors, as_bytes):
+    if words:
+        # The longest word is likely to be the rarest
+        pattern = re.escape(max(words, key=len))
+    else:
+        pattern = r"\n(?:\x1b\[[0-9;]*m)*(?:" + "|".join(re.escape(author) for author in authors) + r")(?:, |: )"
+    if as_bytes:
+        return re.compile(pattern.encode("ascii"))
+    return re.compile(pattern)
+
+# Search one chat log (archived segments included) for lines with all of
+# words and from all of authors, as parsed by parse_search_query().
+# Returns the number of matches and the newest limit of them, oldest
+# first, as (time, chat name, line) with the line without its line break.
+# The times are from search_match_times().
+def search_chat_file(log_path, words, authors, timestamp_format, limit=SEARCH_RESULT_LIMIT):
+    import collections
+    chat_name = os.path.basename(log_path).removesuffix(".txt")
+    plain = all(term.isascii() for term in words + authors)
+    byte_candidates = search_candidate_pattern(words, authors, True) if plain else None
+    text_candidates = search_candidate_pattern(words, authors, False)
+    wanted = set(words)
+    match_count = 0
+    matches = collections.deque(maxlen=limit)
+    # The session at the end of the last block, as from session_at()
+    session = (None, None)
+    # Whether this block is being searched as bytes, and the line break
+    # that goes with that
+    as_bytes = plain
+    newline = b"\n"
+    # Where the lines that might be session headers start in this block,
+    # and the sessions they start, for the ones worked out so far (working
+    # out a date is slow, and lots of matches share one)
+    header_starts = []
+    header_sessions = {}
+    # Where the last line looked up by block_line_start() was, in the
+    # casefolded block and in the block
+    line_starts = [0, 0]
+
+    # The session at position in a block, from the last session header
+    # before it (or session if there isn't one), as its date and the
+    # first timestamp in it
+    def session_at(block, position):
+        for number in range(bisect.bisect_left(header_starts, position) - 1, -1, -1):
+            header_start = header_starts[number]
+            if header_start not in header_sessions:
+                header_end = block.find(newline, header_start + 1)
+                header_line = block[header_start + 1:header_end if header_end >= 0 else len(block)]
+                header = SESSION_HEADER.match(header_line if as_bytes else header_line.encode("utf-8"))
+                header_day = parse_session_date(header.group(1)) if header else None
+                header_sessions[header_start] = None if header_day is None else (header_day, first_time_after(block, header_end))
+            if header_sessions[header_start] is not None:
+                return header_sessions[header_start]
+        return session
+
+    # The timestamp of the line at line_start, or else of a line shortly
+    # before it in the same session
+    def time_at(block, line_start):
+        for number in range(SEARCH_ALL_TIME_LOOKBACK):
+            line_end = block.find(newline, line_start)
+            line = block[line_start:line_end if line_end >= 0 else len(block)]
+            if not as_bytes:
+                line = line.encode("utf-8")
+            if line_start == 0 or SESSION_HEADER.match(line):
+                return None
+            author, time_text, message = parse_preface(line.decode("utf-8", errors="replace"))
+            if time_text is not None:
+                return time_text
+            line_start = block.rfind(newline, 0, line_start - 1) + 1
+        return None
+
+    # The first timestamp in the lines shortly after the one ending at
+    # line_end, up to the next session header
+    def first_time_after(block, line_end):
+        for number in range(SEARCH_ALL_TIME_LOOKBACK):
+            if line_end < 0:
+                return None
+            line_start = line_end + 1
+            line_end = block.find(newline, line_start)
+            line = block[line_start:line_end if line_end >= 0 else len(block)]
+            if not as_bytes:
+                line = line.encode("utf-8")
+            if SESSION_HEADER.match(line):
+                return None
+            author, time_text, message = parse_preface(line.decode("utf-8", errors="replace"))
+            if time_text is not None:
+                return time_text
+        return None
+
+    # Where the line starting at position in the casefolded block starts
+    # in block. Casefolding can make text longer (ß becomes ss), and then
+    # the lines in between have to be counted. Positions only go forwards
+    # within a block.
+    def block_line_start(block, searchable, position):
+        if len(searchable) == len(block):
+            return position
+        line_start = line_starts[1]
+        for number in range(searchable.count(newline, line_starts[0], position)):
+            line_start = block.find(newline, line_start) + 1
+        line_starts[:] = [position, line_start]
+        return line_start
+
+    for start, segment in log_pieces(log_path):
+        with open_log_piece(log_path, segment) as piece:
+            leftover = b""
+            while True:
+                data = piece.read(SEARCH_ALL_BLOCK_SIZE)
+                if data:
+                    # Keep any partial line at the end for the next block
+                    data = leftover + data
+                    cut = data.rfind(b"\n") + 1
+                    data, leftover = data[:cut], data[cut:]
+                elif leftover:
+                    data, leftover = leftover, b""
+                else:
+                    break
+                block = b"\n" + data
+                as_bytes = plain and not SEARCH_ALL_CASEFOLD_TO_ASCII.search(block.translate(None, SEARCH_ALL_ASCII_BYTES))
+                if as_bytes:
+                    newline = b"\n"
+                    candidates = byte_candidates
+                    # bytes.lower() keeps every character where it was
+                    searchable = block.lower()
+                    required = [word.encode("ascii") for word in words]
+                else:
+                    newline = "\n"
+                    candidates = text_candidates
+                    block = block.decode("utf-8", errors="replace")
+                    searchable = block.casefold()
+                    required = words
+                    line_starts[:] = [0, 0]
+                header_starts[:] = [header.start() for header in re.finditer(re.escape(newline + (b"-----" if as_bytes else "-----")), block)]
+                header_sessions.clear()
+                searchable_line_end = -1
+                for candidate in candidates.finditer(searchable):
+                    inside = candidate.end() - 1
+                    # Only check each line once
+                    if inside < searchable_line_end:
+                        continue
+                    searchable_line_start = searchable.rfind(newline, 0, inside) + 1
+                    searchable_line_end = searchable.find(newline, inside)
+                    if searchable_line_end < 0:
+                        searchable_line_end = len(searchable)
+                    # Every word has to be in a line somewhere before it's worth decoding
+                    if not all(word in searchable[searchable_line_start:searchable_line_end] for word in required):
+                        continue
+                    line_start = block_line_start(block, searchable, searchable_line_start)
+                    line_end = block.find(newline, line_start)
+                    line = block[line_start:line_end if line_end >= 0 else len(block)]
+                    if as_bytes:
+                        line = line.decode("utf-8", errors="replace")
+                    line = line.rstrip("\r")
+                    terms = search_terms(line)
+                    if not wanted <= terms or not all("@" + author in terms for author in authors):
+                        continue
+                    match_count += 1
+                    # Times are only worked out for the matches that are kept
+                    matches.append((session_at(block, line_start), time_at(block, line_start), line))
+                session = session_at(block, len(block))
+    return match_count, [(when, chat_name, line) for when, (line_session, time_text, line) in zip(search_match_times(matches, timestamp_format), matches)]
+
+# Times for one chat's matches, oldest first, as ISO dates and times that
+# never go backwards, so chats can be merged by them. Each comes from the
+# session date and the line's timestamp (see log_line_time()), a day
+# later if the timestamp is earlier than the session's first one (the
+# chat went on past midnight). Anything that would still go backwards,
+# like a line with only a date, gets the time of the match before it.
+# Matches from before any session date get None.
+def search_match_times(matches, timestamp_format):
+    times = []
+    last = None
+    for (line_day, first_time_text), time_text, line in matches:
+        when_text = log_line_time(line_day, time_text, timestamp_format)
+        when = None if when_text is None else datetime.fromisoformat(when_text)
+        first_text = log_line_time(line_day, first_time_text, timestamp_format)
+        if when is not None and "T" in when_text and first_text is not None and "T" in first_text and when_text < first_text:
+            when += timedelta(days=1)
+        if last is not None and (when is None or when < last):
+            when = last
+        times.append(None if when is None else when.isoformat(timespec="seconds"))
+        last = when
+    return times
+
+# Search every chat in log_dir. Returns the number of matches and the
+# newest limit of them in time order, as from search_chat_file().
+# processes is how many chats to search at once; by default, one per CPU
+# if that would help, or just one.
+def search_all_chats(log_dir, query, timestamp_format, limit=SEARCH_RESULT_LIMIT, processes=None):
+    import heapq
+    words, authors = parse_search_query(query)
+    if not words and not authors:
+        return 0, []
+    log_paths = [log_dir + "/" + chat_name + ".txt" for chat_name in find_chats(log_dir)]
+    arguments = [(log_path, words, authors, timestamp_format, limit) for log_path in log_paths]
+    if processes is None:
+        # The biggest chat takes as long as it takes, so it's the rest
+        # that has to be worth starting processes for
+        sizes = [log_size(log_path) for log_path in log_paths]
+        processes = 1 if len(sizes) < 2 or sum(sizes) - max(sizes) < SEARCH_ALL_PARALLEL_BYTES else None
+    if processes == 1:
+        results = [search_chat_file(*chat_arguments) for chat_arguments in arguments]
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Forking while the background writer thread is running isn't safe
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(search_chat_file, *zip(*arguments)))
+    match_count = sum(chat_match_count for chat_match_count, chat_matches in results)
+    # Each chat's matches are already in time order. Lines without a date go first.
+    merged = list(heapq.merge(*(chat_matches for chat_match_count, chat_matches in results), key=lambda match: match[0] or ""))
+    return match_count, merged[-limit:]
+
 def get_log_file(log_dir):
     # Get or create log file.
     print()
@@ -351,61 +2655,181 @@ def get_log_file(log_dir):
     log_file = open_log(log_dir, log_file_name)
     return log_file, log_file_name
 
-# Test if a message is a switch. If it is, return the key to switch with.
-def check_for_switch(message: str, user_list: dict, case_sensitivity: bool):
-    try:
-        proxies = user_list.keys()
-        if case_sensitivity == False:
-            insensitive_proxies = [proxy.casefold() for proxy in proxies]
-            if message.casefold() in insensitive_proxies: # Removes case differences
-                return True
-            else:
-                return False
-        elif message in proxies:
-            return True
-        else:
-            return False
-    except Exception as ex:
-        print("Please report the following error:", "check for switch failed,", ex)
-        # If all else fails, don't switch
-        return False
-
 # CHANGE ACTIVE USER
 def switch(user):
-    active_user = user["username"]
+    active_user = user.username
     # Handle color/noncolor support
     if COLORS:
-        active_color = user["color"]
+        active_color = user.color
     else:
         active_color = "default"
     chat_message = ""
     return active_user, active_color, chat_message
 
+# Set up a message preface (used to identify messages), e.g. "Alice, 12:00: "
+def make_preface(username, color, current_time, settings):
+    if settings["timestamps"] == True:
+        preface_contents = str(username) + ", " + current_time + ": "
+    else:
+        preface_contents = str(username) + ": "
+    if color == "default": # No color set
+        return preface_contents
+    else: # Color set
+        return colored(preface_contents, color)
+
+# Everything about the chat in progress that commands might need to
+# look at or change: who's talking, where the log is, and so on.
+class ChatState:
+    def __init__(self, user_list, log_dir, log_file, log_file_name, settings):
+        self.user_list = user_list
+        self.log_dir = log_dir
+        self.log_file = log_file
+        self.log_file_name = log_file_name
+        self.settings = settings
+        self.log_writer = make_log_writer(log_file, settings)
+        self.session_index = {"size": 0, "sessions": []}
+        self.search_index = None
+        self.storage = None
+        self.structured_log = None
+        self.stats = None
+        # The claim on this chat from claim_chat(), or None if another
+        # MultiChat has it
+        self.chat_claim = None
+        # Set once the chat loop is running; until then, writes happen straight away
+        self.io = None
+        # Set to (log_dir, log_file) to start the chat over somewhere else
+        self.restart = None
+        self.active = None
+        self.active_user = ""
+        self.active_color = "default"
+        # Set up fresh for each message
+        self.now = datetime.now()
+        self.current_time = ""
+        self.preface = ""
+
+    def switch_to(self, user):
+        self.active = user
+        self.active_user, self.active_color, chat_message = switch(user)
+
+    # Write to the log, keeping the search index, structured log, stats,
+    # and storage backend up to date. author is the current user's name for anything
+    # they said, and kind is one of STRUCTURED_KINDS.
+    # Once the chat loop is running, this happens in the background.
+    def write(self, text, author=None, kind="message"):
+        user = self.active if author is not None else None
+        self.run_in_background(self.write_now, text, author, kind, user, self.now)
+
+    def write_now(self, text, author, kind, user, now):
+        start = time.perf_counter()
+        offset = write_log(self.log_writer, self.search_index, text, author)
+        if PERF is not None:
+            start = PERF.record("log write", start)
+        stats_log_write(self.stats, self.log_file, text, self.settings["timestamp_format"], offset)
+        if self.structured_log is not None:
+            structured_log_write(self.structured_log, self.log_file, text, user, kind, now, offset)
+            self.structured_log["file"].flush()
+        if self.storage is not None:
+            self.storage.add_text(self.log_file_name, text, user, kind, now, offset)
+            self.storage.commit()
+        if PERF is not None:
+            PERF.record("index update", start)
+        return offset
+
+    # Do some file work in the background if the chat loop is running,
+    # or right now if it isn't. The chat loop waits for everything to be
+    # done before running a command, so commands always see it finished.
+    def run_in_background(self, function, *args):
+        if self.io is None:
+            function(*args)
+        else:
+            self.io.submit(function, *args)
+
+# A chat command: the function that runs it, a summary for /commands,
+# and (optionally) a longer explanation shown by "/<command> help".
+# Handlers are called as handler(state, argument), where state is the
+# ChatState and argument is whatever came after the command word.
+class Command:
+    __slots__ = ("name", "handler", "summary", "details")
+
+    def __init__(self, name, handler, summary=None, details=None):
+        self.name = name
+        self.handler = handler
+        self.summary = summary
+        self.details = details
+
+# Commands by their first word, e.g. "/dice". Looking a command up is a
+# single dict lookup, however many commands there are. Anything can add
+# commands with register_command() (or the @command decorator) without
+# touching chat().
+COMMANDS = {}
+# Whole messages that do something special, lowercased, e.g. "tableflip"
+PHRASES = {}
+# Text that does something special anywhere in a message, lowercased.
+# Checked in order, after COMMANDS and PHRASES.
+TRIGGERS = []
+# Command names and aliases, for tab completion
+COMMAND_PREFIXES = PrefixTrie()
+
+def register_command(name, handler, summary=None, details=None, aliases=()):
+    new_command = Command(name, handler, summary, details)
+    for command_name in [name, *aliases]:
+        if command_name not in COMMANDS:
+            COMMAND_PREFIXES.add(command_name, command_name)
+        COMMANDS[command_name] = new_command
+    return new_command
+
+# Decorator version of register_command()
+def command(name, summary=None, details=None, aliases=()):
+    def decorator(handler):
+        register_command(name, handler, summary, details, aliases)
+        return handler
+    return decorator
+
+def register_phrases(phrases, handler):
+    for phrase in phrases:
+        PHRASES[phrase.lower()] = handler
+
+def register_trigger(text, handler):
+    TRIGGERS.append((text.lower(), handler))
+
+def show_command_help(details):
+    print("-------------")
+    print(details)
+    print("-------------")
+
+# Work out what should handle a message.
+# Returns (handler, argument), or (None, message) for a plain message.
+def find_handler(message):
+    if message.startswith("/"):
+        name, separator, argument = message.partition(" ")
+        found = COMMANDS.get(name)
+        if found is not None:
+            if argument == "help" and found.details is not None:
+                return lambda state, argument: show_command_help(found.details), argument
+            return found.handler, argument
+    lowered = message.lower()
+    handler = PHRASES.get(lowered)
+    if handler is not None:
+        return handler, message
+    for text, handler in TRIGGERS:
+        if text in lowered:
+            return handler, message
+    return None, message
+
 # The main chat sequence
 def chat(user_list, log_dir, log_file, log_file_name, settings):
-    # Setup
-    chat_message = ""
     # Deal with any goofs
     if isinstance(user_list, tuple): # If I missed any old user_counter passes
         user_list = user_list[0]
-    while user_list == {}:
-        user_list = get_users()
+    storage = open_storage(settings)
+    while len(user_list) == 0:
+        user_list = get_users(storage)
+    state = ChatState(user_list, log_dir, log_file, log_file_name, settings)
+    state.storage = storage
     # Set first active user to be user 1, as this is the
     # most expected behavior and prevents sending messages
     # as no one.
-    # Also fix the old /save format to match the new format 
-    # (so color can happen!)
-    active_user = next(iter(user_list.keys()))
-    if not isinstance(user_list[active_user], dict):
-        username = user_list[active_user]
-        user_list[active_user] = {"username": str(username), "color": "default"}
-        active_user = username
-        active_color = "default"
-    else:
-        user_info = user_list[active_user]
-        print(user_info)
-        active_user = str(user_info["username"])
-        active_color = str(user_info["color"])
+    state.switch_to(user_list.first())
 
     # Add a date marker to the top of the log file
     # (or if appending to an existing file, to the end of it).
@@ -414,31 +2838,48 @@ def chat(user_list, log_dir, log_file, log_file_name, settings):
         clear()
         # Setup
         read_line_count = int(settings["backread_linecount"])
-        # Get the old chat logs
-        oldchat = log_file.readlines()
-        # If the user saved this as a setting, get it
-        # Deal with improper values
-        if read_line_count > len(oldchat) or read_line_count < 0:
-            read_line_count = len(oldchat) - 1
-        # Print up to N lines of any existing chat to terminal.
-        for line in (oldchat[-read_line_count:]):
-            print(line, end ='')
-        #for line in log_file:
-        #    print(line, end="")
+        state.chat_claim = claim_chat(log_file.name)
+        # Move last month's messages into a compressed archive
+        if state.chat_claim is not None:
+            archive_log_if_due(log_file, settings["log_archive_compression"])
+        # Get only the end of the old chat logs- reading the whole
+        # file gets slow once a log has been around for a while.
+        oldchat = tail_log(log_file.name, read_line_count)
+        # Print up to N lines of any existing chat to terminal, in one go
+        # since printing line by line is slow with a big backread.
+        print(render_log_lines(oldchat, user_list), end="")
+        # New messages go at the end of the file
+        log_file.seek(0, os.SEEK_END)
         # Get the date and add formatting.
         now = date.today()
-        todayDate = "-----" + str(now.strftime("%A, %B %d, %Y")) + "-----"
+        todayDate = "-----" + str(now.strftime(SESSION_DATE_FORMAT)) + "-----"
         # Display the date and add it to the log file.
         print(todayDate)
-        log_file.write(todayDate + "\n\n")
+        # Keep track of where each session starts for /jump and /since
+        state.session_index = load_session_index(log_file.name)
+        state.log_writer.flush()
+        if state.chat_claim is not None:
+            state.search_index = open_search_index(log_file.name)
+            state.stats = open_stats(log_file.name)
+        else:
+            print("MultiChat: This chat is open in another window too. Messages from both are")
+            print("saved, but /search and /stats only work in the window that opened it first.")
+        if not storage.open_chat(log_file_name, log_file.name):
+            print(f"MultiChat: Older messages in this chat aren't in {SQLITE_DATABASE_NAME} yet.")
+            print("To add them, run: python multiChat.py --import-sqlite")
+        session_offset = state.write_now(todayDate + "\n\n", None, "message", None, state.now)
+        add_session(state.session_index, log_file.name, now.isoformat(), session_offset)
+        if settings["structured_log"]:
+            state.log_writer.flush()
+            state.structured_log = open_structured_log(log_file.name)
     # Notify the user if an exception occurs while getting the date.
     except Exception as error:
         print("Error getting chat file or date.")
         print(error)
-    
+
     # Print instructions for user
     print("Welcome to MultiChat!")
-    list_users(user_list)
+    list_users(state.user_list)
     print("Or type /quit to quit (case sensitive).")
     print()
     print("Type /help to view a help message,")
@@ -446,454 +2887,821 @@ def chat(user_list, log_dir, log_file, log_file_name, settings):
     print("or /users to see a list of all users.")
     print()
 
-    # Check for special inputs and handle accordingly
-    while chat_message not in ["/quit", "/exit"]:
-        # Get the time.
-        now = datetime.now()
-        current_time = now.strftime(settings["timestamp_format"])
-        # Set up message preface (used to identify messages)
-        if settings["timestamps"] == True:
-            preface_contents = str(active_user) + ", " + current_time + ": "
+    import asyncio
+    asyncio.run(chat_loop(state))
+    # Moved to a new log directory; carry on there
+    if state.restart is not None:
+        log_dir, log_file = state.restart
+        chat(state.user_list, log_dir, log_file, log_file_name, settings)
+
+# Most tab completions to offer at once; any more isn't much help
+COMPLETION_LIMIT = 50
+
+# Tab completions for a message: commands for "/...", and proxies.
+# Returns (completion, description) pairs.
+def complete_message(state, text):
+    if " " in text:
+        return []
+    completions = []
+    if text.startswith("/"):
+        for name in itertools.islice(COMMAND_PREFIXES.complete(text), COMPLETION_LIMIT):
+            summary = COMMANDS[name].summary or ""
+            completions.append((name, summary.partition(": ")[2].partition("\n")[0]))
+    for user in state.user_list.complete_proxy(text, state.settings["case_sensitive_proxies"], COMPLETION_LIMIT - len(completions)):
+        completions.append((user.proxy, user.username))
+    return completions
+
+# One prompt for the whole chat, so Up brings back earlier messages and
+# Tab completes commands and proxies. Returns None without prompt_toolkit;
+# readline (if there is one) gets the same completions instead.
+def make_prompt_session(state):
+    if not PROMPT_INSTALLED:
+        if "readline" in globals():
+            completions = []
+            def complete(text, number):
+                if number == 0:
+                    completions[:] = [completion for completion, description in complete_message(state, readline.get_line_buffer())]
+                return completions[number] if number < len(completions) else None
+            readline.set_completer_delims("")
+            readline.set_completer(complete)
+            readline.parse_and_bind("tab: complete")
+        return None
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.completion import Completer, Completion
+    from prompt_toolkit.history import InMemoryHistory
+
+    class MessageCompleter(Completer):
+        def get_completions(self, document, complete_event):
+            text = document.text_before_cursor
+            for completion, description in complete_message(state, text):
+                yield Completion(completion, start_position=-len(text), display_meta=description)
+
+    return PromptSession(history=InMemoryHistory(), completer=MessageCompleter(), complete_while_typing=False)
+
+# Check for special inputs and handle accordingly.
+# Runs in an event loop, so that while waiting for the next message,
+# saving the last one can carry on in the background.
+async def chat_loop(state):
+    settings = state.settings
+    state.io = BackgroundIO()
+    state.io.start()
+    session = make_prompt_session(state)
+    try:
+        while state.restart is None:
+            state.io.report_errors()
+            # Get the time.
+            state.now = datetime.now()
+            state.current_time = state.now.strftime(settings["timestamp_format"])
+            # Set up message preface (used to identify messages)
+            state.preface = make_preface(state.active_user, state.active_color, state.current_time, settings)
+
+            # Get chat message.
+            start = time.perf_counter()
+            chat_message = await prompt_async(state.preface, session)
+            if PERF is not None:
+                start = PERF.record("prompt wait", start)
+
+            # SWITCH ACTIVE USER
+            # Do not record the proxy in the log file.
+            switch_user = state.user_list.find_switch(chat_message, settings["case_sensitive_proxies"])
+            if PERF is not None:
+                start = PERF.record("switch check", start)
+            if switch_user is not None:
+                state.switch_to(switch_user)
+                continue
+
+            # Commands, easter eggs, and anything else special
+            handler, argument = find_handler(chat_message)
+            if PERF is not None:
+                start = PERF.record("dispatch", start)
+            if handler is not None:
+                # Let commands see everything written so far
+                await state.io.drain()
+                state.io.report_errors()
+                try:
+                    handler(state, argument)
+                # A command going wrong shouldn't end the chat; report it
+                # like a failed save and carry on
+                except Exception as error:
+                    print("Error:", error)
+                    print("That command didn't finish.")
+                finally:
+                    if PERF is not None:
+                        PERF.record("command", start)
+            # If there are no special cases, append the new message to
+            # the log file. Any errors are reported before the next prompt.
+            elif chat_message != "":
+                state.write(state.preface + chat_message + "\n", state.active_user)
+    finally:
+        # Finish saving before quitting or moving on
+        await state.io.stop()
+        state.io.report_errors()
+        state.io = None
+
+# COMMANDS
+# Each of these is registered into COMMANDS, PHRASES, or TRIGGERS as the
+# module loads. /commands lists them in alphabetical order.
+
+# If we're quitting, add space in the text file, and notify user.
+@command("/quit", "/quit: Save and quit MultiChat.", aliases=["/exit"])
+def quit_command(state, argument):
+    clear()
+    print("Chat saved.")
+    state.write("\n\n")
+    # Done after the last write, before the chat loop lets MultiChat exit
+    state.run_in_background(close_chat, state)
+    raise SystemExit
+
+# Save and close everything that goes along with the log
+def close_chat(state):
+    try:
+        state.log_writer.finish()
+        # Save the session index so it doesn't need to catch up next time.
+        # Only this session needs scanning, for headers written by any
+        # other MultiChat that had the chat open too.
+        new_sessions, state.session_index["size"] = scan_sessions(state.log_file.name, state.session_index["size"])
+        state.session_index["sessions"].extend(new_sessions)
+        save_session_index(state.session_index, state.log_file.name)
+        if state.search_index is not None:
+            state.search_index["database"].close()
+        state.storage.close()
+        close_structured_log(state.structured_log)
+        if state.stats is not None and state.stats["in_sync"]:
+            save_stats(state.stats, state.log_file.name)
+        release_chat(state.chat_claim)
+    except Exception as error:
+        print("Error adding text separator to end of file.")
+        print("Your log should still be okay, but any later")
+        print("additions will not be separated by a line.")
+
+# Help message
+@command("/help", "/help: View a help message.")
+def help_command(state, argument):
+    print()
+    print("Welcome to MultiChat!")
+    print("To view a list of users, type /users")
+    print("To add a new user to this session, type /add")
+    print("To view more commands, type /commands")
+    print()
+
+# Add a new user
+@command("/add", "/add <username>: Add new user.", """/add: Add a new user to the list. Will prompt for username.
+Alternatively, /add <user> will add <user> to the list.
+A default proxy will be assigned based on the number of users.
+Examples:
+    /add Alice: Add a user named Alice.
+    /add Bob: Add a user named Bob.
+    /add Eve: Add a user named Eve.""")
+def add_command(state, argument):
+    if argument == "":
+        print()
+        argument = input("Enter the name of the user to add: ")
+    add_user(argument, state.user_list)
+
+# Remove users from the list
+@command("/remove", "/remove: Delete a user.", """/remove <proxy>: delete the user with proxy <proxy>.
+Past messages sent as this user will still be under their name, but they will be removed
+from the user list and you will not be able to send messages as them.
+You will be asked to confirm deletion by typing their full name.
+If you're not sure what a user's <proxy> is, see /users""")
+def remove_command(state, argument):
+    user_list = state.user_list
+    # Delete the user, if they exist
+    if argument in user_list:
+        username = user_list.get(argument).username
+        if len(user_list) == 1:
+            print(f"{username} is the only user, so they can't be deleted. Add someone else first with /add.")
+            return
+        print(f"Are you sure you'd like to delete {username}?")
+        confirm = input(f"Type their name to confirm (case-sensitive): ")
+        if confirm == username:
+            removed = user_list.remove(argument)
+            print(f"{username} deleted.")
+            # Don't keep talking as someone who's gone
+            if removed is state.active:
+                state.switch_to(user_list.first())
+                print(f"Now talking as {state.active_user}.")
+            list_users(user_list)
         else:
-            preface_contents = str(active_user) + ": "
-        if active_color == "default": # No color set
-            preface = preface_contents
-        else: # Color set
-            preface = colored(preface_contents, active_color)
-
-        # Get chat message.
-        if PROMPT_INSTALLED:
-            chat_message = prompt(ANSI(preface))
+            print("Name does not match. Did you make a typo?")
+    # Oops, no user!
+    else:
+        print(f"Cannot find user with proxy {argument}. Did you typo?")
+
+# Show the chat from a given date
+JUMP_HELP = """/jump <YYYY-MM-DD>: show the start of the chat from that date.
+/since <YYYY-MM-DD>: show everything in the chat from that date onward.
+If nobody chatted on that date, the next date with messages is used.
+/jump shows as many lines as the backread setting (see /settings).
+Examples:
+    /jump 2024-01-31: show the chat from January 31st, 2024.
+    /since 2024-02-01: show all messages since February 1st, 2024."""
+
+def show_log_since(state, argument, command_name, line_count):
+    day = parse_iso_date(argument)
+    if day is None:
+        print(f"MultiChat: {command_name} needs a date in YYYY-MM-DD format, e.g. {command_name} 2024-01-31")
+        return
+    state.log_writer.flush()
+    session_offset = find_session_offset(state.session_index, day)
+    if session_offset is None:
+        print(f"MultiChat: No chat found on or after {day}.")
+    else:
+        print_log_from(state.log_file.name, session_offset, line_count)
+
+@command("/jump", "/jump <YYYY-MM-DD>: Show the chat from a given date.", JUMP_HELP)
+def jump_command(state, argument):
+    show_log_since(state, argument, "/jump", int(state.settings["backread_linecount"]))
+
+@command("/since", "/since <YYYY-MM-DD>: Show everything in the chat since a given date.", JUMP_HELP)
+def since_command(state, argument):
+    show_log_since(state, argument, "/since", None)
+
+# Page back through the whole chat
+@command("/history", "/history [YYYY-MM-DD]: Scroll back through this chat a page at a time.", """/history: page back through this chat, starting from the newest messages.
+/history <YYYY-MM-DD>: start from a given date instead.
+While paging, press Enter (or send b) for older messages, f for newer ones,
+e to go back to the newest, and q to go back to chatting.
+Pages are as tall as your terminal.
+Examples:
+    /history: scroll back from the latest messages.
+    /history 2024-01-31: start from January 31st, 2024.""")
+def history_command(state, argument):
+    import shutil
+    start = None
+    if argument.strip():
+        day = parse_iso_date(argument)
+        if day is None:
+            print("MultiChat: /history needs a date in YYYY-MM-DD format, e.g. /history 2024-01-31")
+            return
+        start = find_session_offset(state.session_index, day)
+        if start is None:
+            print(f"MultiChat: No chat found on or after {day}.")
+            return
+    state.log_writer.flush()
+    # Leave room for the prompt
+    page_size = max(5, shutil.get_terminal_size().lines - 2)
+    with LogWindow(state.log_file.name) as window:
+        if window.size == 0:
+            print("MultiChat: This chat is empty.")
+            return
+        # The page being shown is from top to bottom
+        if start is None:
+            bottom = window.size
+            top, lines = window.lines_before(bottom, page_size)
         else:
-            chat_message = input(preface)
-
-        # SWITCH ACTIVE USER  
-        # Do not record the number in the log file.
-        try: # Try switching to the user indicated by the number.
-            # We have a switch:
-            if check_for_switch(chat_message, user_list, settings["case_sensitive_proxies"]) == True:
-                # Handle the actual switch
-                if settings["case_sensitive_proxies"] == False:
-                    # Find the match
-                    for user in user_list:
-                        # Case-insensitive matching and switching
-                        if user.casefold() == chat_message.casefold():
-                            active_user, active_color, chat_message = switch(user_list[user])
-                            # Fix old user formats
-                            if not isinstance(user_list[user], dict): # If user format is outdated
-                                user_list[user] = {"username": user_list[user], "color": "default"}
-                else: # Case sensitive is simpler
-                    active_user, active_color, chat_message = switch(user_list[chat_message])
-            else: # We're not switching right now
-                chat_message = chat_message
-        except Exception as ex:
-            print(ex)
-            chat_message = chat_message
+            top = start
+            bottom, lines = window.lines_after(top, page_size)
+        while True:
+            clear()
+            print(render_log_lines(lines, state.user_list), end="")
+            if lines and not lines[-1].endswith("\n"):
+                print()
+            choice = input(f"-- {bottom * 100 // window.size}% -- Enter: older, f: newer, e: newest, q: quit: ").strip().lower()
+            if choice == "q":
+                break
+            elif choice == "f":
+                if bottom < window.size:
+                    top = bottom
+                    bottom, lines = window.lines_after(top, page_size)
+            elif choice == "e":
+                bottom = window.size
+                top, lines = window.lines_before(bottom, page_size)
+            elif top > 0:
+                bottom = top
+                top, lines = window.lines_before(bottom, page_size)
+        # Back to where the chat was
+        clear()
+        print(render_log_lines(window.lines_before(window.size, page_size)[1], state.user_list), end="")
+
+# List the chats in the chatlog folder
+@command("/logs", "/logs: List all of your chats.", """/logs: list every chat in your chatlog folder, most recently active first,
+with how big it is, how many sessions and messages it has, when it was
+last active, and who has chatted in it.
+Chats that haven't changed since the last /logs are listed straight away.""", aliases=["/chats"])
+def logs_command(state, argument):
+    state.log_writer.flush()
+    print_catalog(build_catalog(state.log_dir, state.settings["timestamp_format"]))
+
+# Search the chat
+@command("/search", "/search <words>: Find messages in this chat.", f"""/search <words>: find messages in this chat containing all of <words>.
+Add @name to only find messages from that user. Use quotes for names with spaces.
+The newest {SEARCH_RESULT_LIMIT} matches are shown.
+Examples:
+    /search pizza: find messages mentioning pizza.
+    /search pizza @Alice: find messages from Alice mentioning pizza.
+    /search @"Mary Sue": find all messages from Mary Sue.""")
+def search_command(state, argument):
+    search_index = state.search_index
+    if argument.strip() == "":
+        show_command_help(COMMANDS["/search"].details)
+        return
+    state.log_writer.flush()
+    # The database can answer in any window, if it has the whole chat
+    result = state.storage.search(state.log_file_name, argument)
+    if result is None:
+        if search_index is None:
+            print("MultiChat: Search is not available for this chat.")
+            return
+        if not search_index["in_sync"]:
+            print("MultiChat: Updating search index, this may take a moment...")
+        catch_up_search_index(search_index, state.log_file.name)
+        result = search_log(search_index, argument)
+    match_count, offsets = result
+    print_log_lines(state.log_file.name, offsets)
+    if match_count > len(offsets):
+        print(f"MultiChat: Showing the newest {len(offsets)} of {match_count} matches.")
+    else:
+        print(f"MultiChat: {match_count} matches.")
+
+# Search every chat
+@command("/searchall", "/searchall <words>: Find messages in all of your chats.", f"""/searchall <words>: find messages in any of your chats containing all of <words>.
+Works like /search (including @name), but looks through every chat in your
+chatlog folder, which is slower since it reads each one from start to end.
+The newest {SEARCH_RESULT_LIMIT} matches are shown, oldest first, with the chat each one is from.
+Examples:
+    /searchall pizza: find messages mentioning pizza in any chat.
+    /searchall pizza @Alice: find messages from Alice mentioning pizza in any chat.""")
+def searchall_command(state, argument):
+    if argument.strip() == "":
+        show_command_help(COMMANDS["/searchall"].details)
+        return
+    state.log_writer.flush()
+    match_count, matches = search_all_chats(state.log_dir, argument, state.settings["timestamp_format"])
+    print("".join(f"[{chat_name}] " + render_log_lines([line], state.user_list) + "\n" for when, chat_name, line in matches), end="")
+    if match_count > len(matches):
+        print(f"MultiChat: Showing the newest {len(matches)} of {match_count} matches.")
+    else:
+        print(f"MultiChat: {match_count} matches.")
+
+# Show who's been chatting, and how much
+@command("/stats", "/stats: Show message counts and activity for this chat.", """/stats: show how many messages each user has sent in this chat,
+how many characters were in them, and when they were first and last seen,
+plus the busiest and most recent days of chatting.
+/stats @<name> shows the stats for just one user.
+Examples:
+    /stats: show stats for everyone.
+    /stats @Alice: show stats for Alice.""")
+def stats_command(state, argument):
+    stats = state.stats
+    if stats is None:
+        print("MultiChat: Stats are not available for this chat.")
+        return
+    state.log_writer.flush()
+    if not stats["in_sync"]:
+        print("MultiChat: Updating stats, this may take a moment...")
+    catch_up_stats(stats, state.log_file.name, state.settings["timestamp_format"])
+    users = stats["users"]
+    if argument.startswith("@"):
+        author = argument.removeprefix("@").strip()
+        if author not in users:
+            print(f"MultiChat: No messages from {author} in this chat.")
+            return
+        users = {author: users[author]}
+    total = sum(user_stats["messages"] for user_stats in stats["users"].values())
+    print(f"MultiChat: {total:,} messages over {len(stats['days']):,} days.")
+    for author, user_stats in sorted(users.items(), key=lambda item: -item[1]["messages"]):
+        print(f"{author}: {user_stats['messages']:,} messages, {user_stats['characters']:,} characters. First seen {user_stats['first_seen']}, last seen {user_stats['last_seen']}.")
+    if not argument.startswith("@") and stats["days"]:
+        busiest = sorted(stats["days"].items(), key=lambda item: -item[1])[:5]
+        print("Busiest days: " + ", ".join(f"{day} ({count:,})" for day, count in busiest))
+        recent = sorted(stats["days"].items())[-5:]
+        print("Recent days: " + ", ".join(f"{day} ({count:,})" for day, count in reversed(recent)))
+
+# Show how long MultiChat is taking on each message
+@command("/perf", "/perf: Show how long MultiChat takes on each step of a message.", """/perf: show how many times each step of handling a message has run, how long
+it took in total and on average, and the typical (p50), slowest 1% (p99)
+and slowest times, in milliseconds. Timing is off until you turn it on.
+Steps: prompt wait (you typing), switch check, dispatch (finding a command),
+command, log write, index update (stats, search and storage) and flush.
+/perf on: start timing.
+/perf off: stop timing.
+/perf reset: throw away the timings so far and start again.""")
+def perf_command(state, argument):
+    global PERF
+    argument = argument.strip().lower()
+    if argument == "on":
+        if PERF is None:
+            PERF = PerfStats()
+        print("MultiChat: Timing is on. Use /perf to see the results.")
+    elif argument == "off":
+        PERF = None
+        print("MultiChat: Timing is off.")
+    elif argument == "reset":
+        if PERF is not None:
+            PERF = PerfStats()
+        print("MultiChat: Timings reset.")
+    elif PERF is None:
+        print("MultiChat: Timing is off. Turn it on with /perf on, or start MultiChat with --profile.")
+    elif not PERF.steps:
+        print("MultiChat: Nothing timed yet.")
+    else:
+        PERF.print_summary()
+
+# Export the chat as a web page or Markdown
+@command("/export", "/export <html|md> [file]: Save this chat as a web page or Markdown.", """/export <html|md> [file]: save a copy of this whole chat as a web page (html)
+or a Markdown document (md), with each user's color and a link for each day.
+Without [file], it's saved next to the chat log.
+Examples:
+    /export html: save this chat as a web page.
+    /export md ~/Documents/chat.md: save this chat as Markdown in your Documents folder.""")
+def export_command(state, argument):
+    export_format, separator, output_path = argument.strip().partition(" ")
+    export_format = export_format.lower() or "html"
+    if export_format not in EXPORT_FORMATS:
+        print("MultiChat: /export needs a format: /export html or /export md")
+        return
+    output_path = os.path.expanduser(output_path.strip()) or state.log_dir + "/" + state.log_file_name + EXPORT_FORMATS[export_format]
+    state.log_writer.flush()
+    try:
+        export_log(state.log_file.name, output_path, export_format, state.user_list)
+        print(f"MultiChat: Chat exported to {output_path}")
+    except OSError as error:
+        print("Error: Could not export chat:", error)
+
+# Clear the screen
+@command("/clear", "/clear: Clear the screen.")
+def clear_command(state, argument):
+    clear()
+
+# List all users
+@command("/users", "/users: List users in session.", aliases=["/switch"])
+def users_command(state, argument):
+    print("Users:")
+    list_users(state.user_list)
+
+# Quote saving and retrieval
+@command("/quote", "/quote: View random quotes you've added.\n/quote @<name>: View a random quote from <name>.\n/quote count: Count saved quotes.\n/quote <text>: Add text to the quotes list.", """/quote: save chat messages or read a random saved message.
+/quote <message> will store <message> as a quote that can be retrieved later.
+This quote will be attributed to the current user and the current time.
+/quote on its own will retrieve a random saved quote, if any exist.
+/quote @<name> will retrieve a random quote from <name>.
+/quote count shows how many quotes are saved; /quote count @<name> counts <name>'s.
+Examples:
+    /quote That's what she said: save a quote.
+    /quote @Alice: show something Alice said.
+    /quote count @Bob: show how many quotes Bob has.""")
+def quote_command(state, argument):
+    storage = state.storage
+    try:
+        # Only read the index the first time quotes are used
+        if isinstance(storage, TextStorage):
+            storage.load_quotes()
+    except OSError as error:
+        print("Error: Could not open quotes file:", error)
+        return
+    # Count quotes
+    if argument == "count" or argument.startswith("count @"):
+        author = argument.removeprefix("count").strip().removeprefix("@") or None
+        quote_count = storage.count_quotes(author)
+        if author is None:
+            print(f"MultiChat: {quote_count} quotes saved.")
+        else:
+            print(f"MultiChat: {quote_count} quotes saved from {author}.")
+    # Show a random quote, optionally from someone in particular
+    elif argument == "" or argument.startswith("@"):
+        author = argument.removeprefix("@").strip() or None
+        quote = storage.random_quote(author)
+        if quote is None and author is not None:
+            print(f"Unable to find any quotes from {author}; did you save any?")
+        elif quote is None:
+            print("Unable to access quotes; did you save any?")
         else:
-            # If it doesn't work, tell the user it's not working.
-            # Then make sure that chat_message is a string so as
-            # not to mess up other checks.
-            chat_message = str(chat_message)
+            print(quote, end="")
+            state.write(state.preface + ("/quote " + argument).strip() + "\n", state.active_user, "quote")
+            # Write to log file so it's not confusing later
+            state.write("MultiChat: " + quote)
+    else:
+        try:
+            # Add quote
+            today = str(state.now.strftime("%A, %B %d, %Y"))
+            quote_text =  "On " + today + ", " + state.active_user + " said: " + argument + "\n"
+            storage.add_quote(quote_text)
+            # Write to log file so it's not confusing later
+            state.write(state.active_user + ' added: "' + argument + '" to the quotes!' + "\n", state.active_user, "quote")
+            print("Multichat: Quote added!")
+        except OSError:
+            print("Error: Could not save quote.")
 
-        # If we're quitting, add space in the text file, and notify user.
-        if chat_message == "/quit" or chat_message == "/exit":
-            clear()
-            print("Chat saved.")
-            try:
-                log_file.write("\n\n")
-            except Exception as error:
-                print("Error adding text separator to end of file.")
-                print("Your log should still be okay, but any later")
-                print("additions will not be separated by a line.")
-            raise SystemExit
-        
-        # Help message
-        elif chat_message == "/help":
-            print()
-            print("Welcome to MultiChat!")
-            print("To view a list of users, type /users")
-            print("To add a new user to this session, type /add")
-            print("To view more commands, type /commands")
-            print()
-
-        # Add a new user
-        elif chat_message == "/add":
-            print()
-            new_user = input("Enter the name of the user to add: ")
-            user_list = add_user(new_user, user_list)
-        elif chat_message.startswith("/add ") == True:
-            new_user = chat_message.removeprefix("/add ")
-            if new_user == "help":
-                print("-------------")
-                print("/add: Add a new user to the list. Will prompt for username.")
-                print("Alternatively, /add <user> will add <user> to the list.")
-                print("A default proxy will be assigned based on the number of users.")
-                print("Examples:")
-                print("    /add Alice: Add a user named Alice.")
-                print("    /add Bob: Add a user named Bob.")
-                print("    /add Eve: Add a user named Eve.")
-                print("-------------")
-            else:
-                user_list = add_user(new_user, user_list)
-
-        # Remove users from the list
-        elif chat_message.startswith("/remove"):
-            del_user = chat_message.removeprefix("/remove ")
-            # Help message
-            if del_user == "help":
-                print("-------------")
-                print("/remove <proxy>: delete the user with proxy <proxy>.")
-                print("Past messages sent as this user will still be under their name, but they will be removed \nfrom the user list and you will not be able to send messages as them.")
-                print("You will be asked to confirm deletion by typing their full name.")
-                print("If you're not sure what a user's <proxy> is, see /users")
-                print("-------------")
-            # Delete the user, if they exist
-            elif del_user in user_list:
-                username = del_user["username"]
-                print(f"Are you sure you'd like to delete {username}?")
-                confirm = input(f"Type their name to confirm (case-sensitive): ").lower()
-                if confirm == username:
-                    user_list[del_user]
-                    print(f"{username} deleted.")
-                    list_users(user_list)
-                else:
-                    print("Name does not match. Did you make a typo?")
-            # Oops, no user!
-            else:
-                print(f"Cannot find user with proxy {del_user}. Did you typo?")
+@command("/quotes")
+def quotes_command(state, argument):
+    print("MultiChat: Did you mean /quote?")
 
+# Save users to file
+@command("/save", "/save: Save list of current users to file.", """/save: Save the names, colors, and proxies of current users.
+This allows these users to be loaded in a different chat with /load.
+Saved users can be found in
+    %APPDATA/multichat/saved-users.pkl (Windows)
+    ~/.config/multichat/saved-users.pkl (Linux, MacOS),
+or in multichat.db in your chatlog folder if storage is set to sqlite.""")
+def save_command(state, argument):
+    state.storage.save_users(state.user_list)
+    print("Saved users to file.")
 
-        # Clear the screen
-        elif chat_message == "/clear":
-            clear()
+# Load users from file
+@command("/load", "/load: Load saved users from file. Overwrites current user list!", """/load: Retrieve saved user names, colors, and proxies.
+Warning: old user list will be overwritten!
+/save must have been used previously to create the file that /load looks for:
+    %APPDATA/multichat/saved-users.pkl (Windows)
+    ~/.config/multichat/saved-users.pkl (Linux, MacOS)""")
+def load_command(state, argument):
+    user_list = state.storage.load_users(True)
+    # Nothing saved; keep the users there are
+    if len(user_list) == 0:
+        return
+    state.user_list = user_list
+    # Keep talking as the same person if they're in the saved users,
+    # using the loaded copy of them so /color and /proxy change that one
+    state.switch_to(user_list.find_by_name(state.active_user) or user_list.first())
 
-        # List all users
-        elif chat_message == "/users" or chat_message == "/switch":
-            print("Users:")
-            list_users(user_list)
-         
-        # Quote saving and retrieval
-        elif chat_message.startswith("/quote") == True:
-            quote_path = log_dir + "/quotes.txt"
-            if chat_message == "/quote help":
-                print("-------------")
-                print("/quote: save chat messages or read a random saved message.")
-                print("/quote <message> will store <message> as a quote that can be retrieved later.")
-                print("This quote will be attributed to the current user and the current time.")
-                print("/quote on its own will retrieve a random saved quote, if any exist.")
-                print("-------------")
-            elif chat_message == "/quote":
-                # Read from quote file
-                try:
-                    quote_file = open(quote_path, "r")
-                except: # Quotes broke, sorry. Start over.
-                    # Save the broken one, if it exists
-                    try:
-                        from shutil import copyfile
-                        shutil.copy(quote_path, quote_path + ".bak")
-                        print("Error: quotes file missing or corrupt. \nSaving old file as backup, creating new file.")
-                    except: # Can't save backup- file probably doesn't exist yet
-                        pass # we'll just replace it.
-                    # Make a new quotes file
-                    quote_file = open(quote_path, "w")
-                    quote_file.close()
-                    quote_file = open(quote_path, "r")
-                # Put all lines in a list
-                quote_list = []
-                for line in quote_file:
-                    quote_list.append(line)
-                # Pick random line
-                random.seed()
-                try:
-                    quote_count = len(quote_list)
-                    random_quote = quote_list[random.randrange(0, quote_count)]
-                    print(random_quote, end="")
-                    log_file.write(preface + chat_message + "\n")
-                    # Write to log file so it's not confusing later
-                    chat_message = "MultiChat: " + random_quote
-                    log_file.write(chat_message)
-                except:
-                    print("Unable to access quotes; did you save any?")
-                # Close the file
-                quote_file.close()
-            elif "/quotes" in chat_message:
-                print("MultiChat: Did you mean /quote?")
-            elif chat_message.startswith("/quote ") == True:
-                # Open quote file
-                quote_file = open(quote_path, "a")
-                # Remove /quote from message
+# Change settings
+@command("/settings", "/settings: Change settings for MultiChat.")
+def settings_command(state, argument):
+    settings = state.settings
+    # Retrieve settings
+    print(f"Settings (saved at {settings.settings_dir}):")
+    loc = settings["savedir"]
+    timestat = settings["timestamps"]
+    timestat_format = settings["timestamp_format"]
+    backread_linecount = settings["backread_linecount"]
+    case_sensitivity = settings["case_sensitive_proxies"]
+    durability = settings["log_durability"]
+    if durability == "group":
+        durability += f", every {settings['group_commit_messages']} messages or {settings['group_commit_ms']} ms"
+
+    print(f"1: Change chatlog save location (currently {loc})")
+    print(f"2: Toggle timestamps (currently {timestat})")
+    print(f"3: Change timestamp format (currently {timestat_format})")
+    print(f"4: Set lines of old chatlog to display (currently {backread_linecount})")
+    print(f"5: Toggle case-sensitivity for switch proxies (currently {case_sensitivity})")
+    print(f"6: Change how often messages are saved to disk (currently {durability})")
+    print(f"7: Change compression for archived chat logs (currently {settings['log_archive_compression']})")
+    print(f"8: Toggle structured JSON Lines log for scripts and tools (currently {settings['structured_log']})")
+    print(f"9: Change where users, quotes and searchable messages are stored (currently {settings['storage_backend']})")
+    setnum = input("Enter number of setting to change: ")
+    match setnum:
+        # Changing where chatlogs are saved
+        case "1":
+            print("Old files will not be copied over-")
+            print("please move these yourself if you'd like to access them.")
+            state.restart = change_log_dir(settings, state.log_writer, state.log_file_name)
+            if state.restart is not None:
+                # The chat loop starts over in the new location after this
+                close_chat(state)
+        # Toggle timestamps
+        case "2":
+            settings["timestamps"] = not settings["timestamps"]
+            print("Timestamps toggled. Currently:", settings["timestamps"])
+        # Change format of timestamps
+        case "3":
+            settings["timestamp_format"] = input("Please enter a valid datetime formatting string (e.g. %H:%M): ")
+            invalid = True
+            while invalid:
                 try:
-                    chat_message = chat_message.removeprefix("/quote ")
-                    # Add quote
-                    today = str(now.strftime("%A, %B %d, %Y"))
-                    quote_text =  "On " + today + ", " + active_user + " said: " + chat_message + "\n"
-                    quote_file.write(quote_text)
-                    # Write to log file so it's not confusing later
-                    chat_message = chat_message
-                    log_file.write(active_user + ' added: "' + chat_message + '" to the quotes!' + "\n")
-                    print("Multichat: Quote added!")
+                    state.now.strftime(settings["timestamp_format"])
+                    invalid = False
                 except:
-                    print("Error: Could not remove /quote from message.")
-                # Close file
-                finally:
-                    quote_file.close()
-            else:
-                print("MultiChat: Did you mean /quote?")
-            
-        # Save users to file
-        elif chat_message.startswith("/save"):
-            if chat_message.endswith("help"):
-                print("-------------")
-                print("/save: Save the names, colors, and proxies of current users.")
-                print("This allows these users to be loaded in a different chat with /load.")
-                print("Saved users can be found in \n    %APPDATA/multichat/saved-users.pkl (Windows)")
-                print("    ~/.config/multichat/saved-users.pkl (Linux, MacOS).")
-                print("-------------")
-            else:
-                settings_dir = get_settings_dir()
-                with open(settings_dir + "/saved-users.pkl", "wb") as savefile:
-                    pickle.dump(user_list, savefile)
-                print("Saved users to file.")
-
-        # Load users from file
-        elif chat_message.startswith("/load"):
-            if chat_message.endswith("help"):
-                print("-------------")
-                print("/load: Retrieve saved user names, colors, and proxies.")
-                print("Warning: old user list will be overwritten!")
-                print("/save must have been used previously to create the file that /load looks for:")
-                print("    %APPDATA/multichat/saved-users.pkl (Windows)")
-                print("    ~/.config/multichat/saved-users.pkl (Linux, MacOS)")
-                print("-------------")
-            else:
-                user_list = load_users(True)
-
-        # Change settings
-        elif chat_message == "/settings":
-            # Retrieve settings
-            print(f"Settings (saved at {get_settings_dir()}):")
-            loc = settings["savedir"]
-            timestat = settings["timestamps"]
-            timestat_format = settings["timestamp_format"]
-            backread_linecount = settings["backread_linecount"]
-            case_sensitivity = settings["case_sensitive_proxies"]
-                
-            print(f"1: Change chatlog save location (currently {loc})")
-            print(f"2: Toggle timestamps (currently {timestat})")
-            print(f"3: Change timestamp format (currently {timestat_format})")
-            print(f"4: Set lines of old chatlog to display (currently {backread_linecount})")
-            print(f"5: Toggle case-sensitivity for switch proxies (currently {case_sensitivity})")
-            setnum = input("Enter number of setting to change: ")
-            match setnum:
-                # Changing where chatlogs are saved
-                case "1":
-                    print("Old files will not be copied over-")
-                    print("please move these yourself if you'd like to access them.")
-                    change_log_dir(settings, log_file, log_file_name, user_list)
-                # Toggle timestamps
-                case "2":
-                    settings["timestamps"] = not settings["timestamps"]
-                    settings_dir = get_settings_dir()
-                    save_settings(settings, settings_dir)
-                    print("Timestamps toggled. Currently:", settings["timestamps"])
-                # Change format of timestamps
-                case "3":
-                    settings["timestamp_format"] = input("Please enter a valid datetime formatting string (e.g. %H:%M): ")
+                    print("Invalid datetime format string.")
                     invalid = True
-                    while invalid:
-                        try:
-                            now.strftime(settings["timestamp_format"])
-                            invalid = False
-                        except:
-                            print("Invalid datetime format string.")
-                            invalid = True
-                            settings["timestamp_format"] = input("Please enter a valid datetime formatting string (e.g. %H:%M): ")
-                    settings_dir = get_settings_dir()
-                    save_settings(settings, settings_dir)
-                    print("Timestamp format changed. Currently:", settings["timestamp_format"])
-                case "4":
-                    backread_linecount = input("Enter number of lines to display when loading saved chats: ")
-                    settings["backread_linecount"] = backread_linecount
-                    settings_dir = get_settings_dir()
-                    save_settings(settings, settings_dir)
-                    print(f"Line count set to {backread_linecount}.")
-                case "5":
-                    settings["case_sensitive_proxies"] = not settings["case_sensitive_proxies"]
-                    settings_dir = get_settings_dir()
-                    save_settings(settings, settings_dir)
-                    print("Case sensitivity toggled. Currently:", settings["case_sensitive_proxies"])
-
-
-        # Change the user's prefix color
-        elif chat_message.startswith("/color") == True:
-            if not COLORS:
-                print("Colors not supported: termcolor library not installed.")
-            else:
-                color = chat_message.removeprefix("/color ")
-                # Valid colors
-                color_list = ["red", "yellow", "green", "cyan", "blue", "magenta", "light_grey", "dark_grey", "black", "white", "light_red", "light_yellow", "light_green", "light_cyan", "light_blue", "light_magenta"]
-                # Set up sample color display, accounting for availability differences
-                color_samples = "\ndefault"
-                for color_option in color_list:
-                    try: # Every color colored with itself
-                        color_samples += ", \n" + colored(color_option, color_option)
-                    except:
-                        pass # Color not available on this system
-                # Help texts
-                if color == "/color":
-                    print("\nTo set a color for the current user, run: /color (color name)")
-                    print("For example: /color red")
-                    color = "nonsense"
-                if color == "help":
-                    print("-------------")
-                    print("/color <colorname>: set the color of the current user's name/timestamp.")
-                    print("<color> may be any standard ANSII terminal color name.")
-                    print("The following colors are allowed:")
-                    print(color_samples)
-                    print("Examples:")
-                    print("    /color red: set the current user's color to red.")
-                    print("    /color default: set the current user's color to the default text color.")
-                    print("-------------")
-                # If we have a valid color
-                if color in color_list and color != "default":
-                    # Get key for current user. I'm sorry. This is overkill.
-                    reverse_user_lookup = {}
-                    for user in user_list:
-                        try:
-                            reverse_user_lookup[user_list[user]["username"]] = user
-                        except TypeError:
-                            # String indices must be integers, not 'str'
-                            print("Oops! Please let the maintainer know that you encountered an error: user lookup searching for wrong type.")
-                    tag = reverse_user_lookup[active_user]
-                    # Set new color for current user
-                    user_list[tag]["color"] = color
-                    active_color = color
-                elif color != "help": # Invalid choice
-                    print("Please enter a valid color from the following:", color_samples, "\n")
-
-        # Load users from file
-        elif chat_message.startswith("/proxy") == True:
-            tag = chat_message.removeprefix("/proxy ")
-            if tag == "help":
-                print("-------------")
-                print("/proxy <tag>: Change the current user's proxy to <tag>.")
-                print("This allows you to set the text used to switch to the current user.")
-                print("If a message exactly matches a user's proxy text, then the next message is set \nas coming from their user. Matching is case-sensitive!")
-                print("It's a good idea to choose proxies that you don't tend to type in \nnormal conversation.")
-                print("Examples: ")
-                print('    /proxy w>: Sets switch text for current user to "w>".')
-                print('    /proxy Will: Sets switch text for current user to "Will".')
-                print('    /proxy sudo: Sets switch text for current user to "sudo".')
-                print("-------------")
-            elif len(tag) > 0 and len(chat_message) > 6:
-                if not tag.startswith("/"):
-                    # Get key for current user. I'm sorry
-                    reverse_user_lookup = {}
-                    for user in user_list:
-                        reverse_user_lookup[user_list[user]["username"]] = user
-                    old_tag = reverse_user_lookup[active_user]
-                    user_list[tag] = active_user
-                    del user_list[old_tag]
-                    print(active_user + "'s proxy changed to " + tag)
-                    list_users(user_list)
-                else:
-                    print("Proxies cannot start with / (sorry!).")
+                    settings["timestamp_format"] = input("Please enter a valid datetime formatting string (e.g. %H:%M): ")
+            print("Timestamp format changed. Currently:", settings["timestamp_format"])
+        case "4":
+            backread_linecount = input("Enter number of lines to display when loading saved chats: ")
+            settings["backread_linecount"] = backread_linecount
+            print(f"Line count set to {backread_linecount}.")
+        case "5":
+            settings["case_sensitive_proxies"] = not settings["case_sensitive_proxies"]
+            print("Case sensitivity toggled. Currently:", settings["case_sensitive_proxies"])
+        case "6":
+            print("fsync: save every message to disk right away. Safest, but slowest.")
+            print("group: save messages to disk in groups, every few messages or milliseconds.")
+            print("os: let your computer decide when to save to disk. Fastest. Messages survive")
+            print("    MultiChat closing unexpectedly, but not your computer crashing.")
+            durability = input("Enter fsync, group, or os: ").strip().lower()
+            while durability not in LOG_DURABILITY_MODES:
+                durability = input("Please enter fsync, group, or os: ").strip().lower()
+            if durability == "group":
+                try:
+                    settings["group_commit_messages"] = max(1, int(input(f"Save after how many messages? (currently {settings['group_commit_messages']}): ")))
+                except ValueError:
+                    print("Not a number; keeping", settings["group_commit_messages"])
+                try:
+                    settings["group_commit_ms"] = max(1, int(input(f"Save after how many milliseconds? (currently {settings['group_commit_ms']}): ")))
+                except ValueError:
+                    print("Not a number; keeping", settings["group_commit_ms"])
+            settings["log_durability"] = durability
+            state.log_writer.set_mode(durability, settings["group_commit_messages"], settings["group_commit_ms"])
+            print("Durability changed. Currently:", settings["log_durability"])
+        case "7":
+            print("Each month (or every 64 MB), older messages are moved out of the chat log")
+            print("into a compressed archive next to it. MultiChat still shows and searches them.")
+            print("gzip: quick to compress and read back.")
+            print("lzma: smaller archives, but slower.")
+            print("off: never archive; keep everything in one plaintext file.")
+            compression = input("Enter gzip, lzma, or off: ").strip().lower()
+            while compression not in list(SEGMENT_COMPRESSION) + ["off"]:
+                compression = input("Please enter gzip, lzma, or off: ").strip().lower()
+            settings["log_archive_compression"] = compression
+            print("Archive compression changed. Currently:", settings["log_archive_compression"])
+        case "8":
+            settings["structured_log"] = not settings["structured_log"]
+            if settings["structured_log"]:
+                state.log_writer.flush()
+                state.structured_log = open_structured_log(state.log_file.name)
+                print(f"Messages will also be recorded in {structured_log_path(state.log_file.name)}")
+                print("To fill in messages from before now, run: python multiChat.py --backfill-jsonl --chat " + state.log_file_name)
             else:
-                print("Please supply a new tag: /proxy <tag>")
-
-        # List commands
-        elif chat_message == "/commands":
-            print()
-            print("Commands:")
-            print("/add <username>: Add new user.")
-            print("/clear: Clear the screen.")
-            print("/color <color name>: Set a prefix color for this user.")
-            print("/commands: View this message.")
-            print("/dice <number>: Roll a die with <number> faces.")
-            print("/help: View a help message.")
-            print("/load: Load saved users from file. Overwrites current user list!") 
-            print("/nolog: Do not save the next message.")
-            print("/proxy <text>: Change the current user's switch text to <text>.")
-            print("/quit: Save and quit MultiChat.")
-            print("/quote: View random quotes you've added.")
-            print("/quote <text>: Add text to the quotes list.") 
-            print("/random: Change to a random user.")
-            print("/remove: Delete a user.")
-            print("/save: Save list of current users to file.") 
-            print("/settings: Change settings for MultiChat.")
-            print("/shrug: Send a shrug emote.")
-            print("/users: List users in session.")
-            print()
-
-        # Dice rolling
-        elif chat_message == "/dice":
-            print("MultiChat: /dice syntax: /dice <number>")
-            print("MultiChat: For more information, see /dice help")
-        elif chat_message.startswith("/dice ") == True:
-            dice_sides = chat_message.removeprefix("/dice ")
-            if dice_sides == "help":
-                print("-------------")
-                print("/dice <number>: roll a die with a set number of sides and shows the results.")
-                print("<number> may be any integer greater than zero.")
-                print("Examples:")
-                print("    /dice 6: rolls a 6-sided die.")
-                print("    /dice 20: rolls a 20-sided die.")
-                print("    /dice 8675309: rolls a 8,675,309-sided die.")
-                print("-------------")
-            try:
-                dice_sides = int(dice_sides)
-                if dice_sides == 1:
-                    dice_roll = 1
-                else:
-                    random.seed()
-                    dice_roll = str(random.randrange(1, dice_sides))
-                print("You rolled a " + dice_roll + "!")
-                log_file.write(active_user + " rolled a " +  str(dice_sides) + "-sided die and rolled a " + dice_roll + "!\n")
-            except:
-                if dice_sides != "help":
-                    print("Can't roll die! " + str(dice_sides) + " is not a valid number for rolling!")
-        
-        # Change to random user
-        elif chat_message == "/random":
-            # Pick the silly flavortext
-            random_flavor = random.choice(settings["random_flavortext"]).strip()
-            # Pick the random user
-            random_user = random.choice(list(user_list.keys()))
-            # Change to the random user only if it's different than the current active_user. Otherwise choose a random user again. Repeat until a different user is found.
-            if active_user != random_user:
-                active_user, active_color, chat_message = switch(user_list[random_user])
-            # Let the user know who got picked
-            print("Multichat: " + random_flavor.replace("NAME", active_user))
-
-        # Easter eggs and references
-        # Table flipping
-        elif chat_message.lower() == "flips table" or chat_message.lower() == "tableflip" or chat_message.lower() == "table flip":
-            tableflip = preface + "(╯°□°）╯︵ ┻━┻"
-            print(tableflip)
-            log_file.write(tableflip + "\n")
-
-        # Shrug
-        elif chat_message.lower() == "shrug" or chat_message.lower() == "shrugs" or chat_message == "/shrug":
-            try:
-                shrug = preface + "¯\\_('u')_/¯"
-                print(shrug)
-                log_file.write(active_user + " shrugs.")
-            except:
-                print("Inexplicably, your shoulders fail to rise. The power of /shrug is beyond you.")
-
-        # Losing the Game (sorry)
-        elif chat_message.lower() == "the game":
-            print("\nMultiChat: !!! THE GAME HAS BEEN LOST! !!!")
-            print("MultiChat: Days since last incident: 0\n")
-            you_lost = active_user + " has unleashed an infohazard!\n"
-            log_file.write(you_lost)
-        
-        # Eyes emoji
-        elif chat_message.lower() == "eyes":
-            eyes = """
+                close_structured_log(state.structured_log)
+                state.structured_log = None
+            print("Structured log toggled. Currently:", settings["structured_log"])
+        case "9":
+            print("text: saved users and quotes are kept in their own files, as always.")
+            print("sqlite: users, quotes, and a searchable copy of every message are kept in")
+            print(f"    {SQLITE_DATABASE_NAME} in your chatlog folder. Chat logs are still saved as text.")
+            backend = input("Enter text or sqlite: ").strip().lower()
+            while backend not in STORAGE_BACKENDS:
+                backend = input("Please enter text or sqlite: ").strip().lower()
+            if backend != settings["storage_backend"]:
+                settings["storage_backend"] = backend
+                state.log_writer.flush()
+                old_storage = state.storage
+                state.storage = open_storage(settings)
+                copy_saved_data(old_storage, state.storage)
+                old_storage.close()
+                print("Saved users and quotes copied over.")
+                if not state.storage.open_chat(state.log_file_name, state.log_file.name):
+                    print("To copy your existing chats over too, run: python multiChat.py --import-sqlite")
+            print("Storage changed. Currently:", settings["storage_backend"])
+    # Save whatever changed in one go
+    state.run_in_background(settings.save)
+
+# Change the user's prefix color
+COLOR_LIST = ["red", "yellow", "green", "cyan", "blue", "magenta", "light_grey", "dark_grey", "black", "white", "light_red", "light_yellow", "light_green", "light_cyan", "light_blue", "light_magenta"]
+
+@command("/color", "/color <color name>: Set a prefix color for this user.")
+def color_command(state, argument):
+    if not COLORS:
+        print("Colors not supported: termcolor library not installed.")
+        return
+    color = argument
+    # Set up sample color display, accounting for availability differences
+    color_samples = "\ndefault"
+    for color_option in COLOR_LIST:
+        try: # Every color colored with itself
+            color_samples += ", \n" + colored(color_option, color_option)
+        except:
+            pass # Color not available on this system
+    # Help texts
+    if color == "":
+        print("\nTo set a color for the current user, run: /color (color name)")
+        print("For example: /color red")
+        color = "nonsense"
+    if color == "help":
+        show_command_help("/color <colorname>: set the color of the current user's name/timestamp.\n"
+            + "<color> may be any standard ANSII terminal color name.\n"
+            + "The following colors are allowed:\n"
+            + color_samples + "\n"
+            + "Examples:\n"
+            + "    /color red: set the current user's color to red.\n"
+            + "    /color default: set the current user's color to the default text color.")
+    # If we have a valid color
+    elif color in COLOR_LIST and color != "default":
+        # Set new color for current user
+        state.active.color = color
+        state.active_color = color
+    else: # Invalid choice
+        print("Please enter a valid color from the following:", color_samples, "\n")
+
+# Change the current user's proxy
+@command("/proxy", "/proxy <text>: Change the current user's switch text to <text>.", """/proxy <tag>: Change the current user's proxy to <tag>.
+This allows you to set the text used to switch to the current user.
+If a message exactly matches a user's proxy text, then the next message is set
+as coming from their user. Matching is case-sensitive!
+It's a good idea to choose proxies that you don't tend to type in
+normal conversation.
+Examples:
+    /proxy w>: Sets switch text for current user to "w>".
+    /proxy Will: Sets switch text for current user to "Will".
+    /proxy sudo: Sets switch text for current user to "sudo".""")
+def proxy_command(state, argument):
+    user_list = state.user_list
+    tag = argument
+    if len(tag) > 0:
+        if tag in user_list and user_list.get(tag) is not state.active:
+            print(f"The proxy {tag} is already used by {user_list.get(tag).username}.")
+        elif not tag.startswith("/"):
+            if tag != state.active.proxy:
+                user_list.set_proxy(state.active, tag)
+            print(state.active_user + "'s proxy changed to " + tag)
+            list_users(user_list)
+        else:
+            print("Proxies cannot start with / (sorry!).")
+    else:
+        print("Please supply a new tag: /proxy <tag>")
+
+# List commands
+@command("/commands", "/commands: View this message.")
+def commands_command(state, argument):
+    print()
+    print("Commands:")
+    for name in sorted(COMMANDS):
+        if COMMANDS[name].name == name and COMMANDS[name].summary:
+            print(COMMANDS[name].summary)
+    print()
+
+# Dice rolling
+@command("/dice", "/dice <number>: Roll a die with <number> faces.", """/dice <number>: roll a die with a set number of sides and shows the results.
+<number> may be any integer greater than zero.
+Examples:
+    /dice 6: rolls a 6-sided die.
+    /dice 20: rolls a 20-sided die.
+    /dice 8675309: rolls a 8,675,309-sided die.""")
+def dice_command(state, argument):
+    if argument == "":
+        print("MultiChat: /dice syntax: /dice <number>")
+        print("MultiChat: For more information, see /dice help")
+        return
+    try:
+        dice_sides = int(argument)
+        if dice_sides == 1:
+            dice_roll = "1"
+        else:
+            import random
+            random.seed()
+            dice_roll = str(random.randrange(1, dice_sides))
+        print("You rolled a " + dice_roll + "!")
+        state.write(state.active_user + " rolled a " +  str(dice_sides) + "-sided die and rolled a " + dice_roll + "!\n", state.active_user, "dice")
+    except:
+        print("Can't roll die! " + str(argument) + " is not a valid number for rolling!")
+
+# Change to random user
+@command("/random", "/random: Change to a random user.")
+def random_command(state, argument):
+    if len(state.user_list) == 0:
+        print("Multichat: There's nobody to pick! Add someone with /add.")
+        return
+    # Pick the silly flavortext
+    import random
+    random_flavor = random.choice(state.settings["random_flavortext"]).strip()
+    # Pick the random user
+    random_user = state.user_list.random_user()
+    # Change to the random user only if it's different than the current active_user.
+    if random_user is not state.active:
+        state.switch_to(random_user)
+    # Let the user know who got picked
+    print("Multichat: " + random_flavor.replace("NAME", state.active_user))
+
+# Allows for not saving a message upon request
+def nolog_command(state, argument):
+    print("/nolog: The next message will not be saved in the chatlog.")
+    # Set up message preface (used to identify messages)
+    preface = colored(state.active_user + ", " + state.current_time + ": ", "dark_grey")
+    # Get chat message.
+    input(preface)
+    print("/nolog: Back to normal logging.")
+
+register_command("/nolog", nolog_command, "/nolog: Do not save the next message.", """/nolog: hide a single message from the chatlog.
+The following message will not be saved in any chatlogs or records (not even with /quote).
+Useful if you want to make sure something isn't saved in your records.
+WARNING: the message is really, truly gone once MultiChat closes!
+Don't use this for any messages that you want to read later.""")
+
+# Easter eggs and references
+# Table flipping
+def tableflip_command(state, message):
+    tableflip = state.preface + "(╯°□°）╯︵ ┻━┻"
+    print(tableflip)
+    state.write(tableflip + "\n", state.active_user, "emote")
+
+register_phrases(["flips table", "tableflip", "table flip"], tableflip_command)
+
+# Shrug
+def shrug_command(state, message):
+    try:
+        shrug = state.preface + "¯\\_('u')_/¯"
+        print(shrug)
+        state.write(state.active_user + " shrugs.\n", state.active_user, "emote")
+    except:
+        print("Inexplicably, your shoulders fail to rise. The power of /shrug is beyond you.")
+
+register_command("/shrug", shrug_command, "/shrug: Send a shrug emote.")
+register_phrases(["shrug", "shrugs"], shrug_command)
+
+# Losing the Game (sorry)
+def the_game_command(state, message):
+    print("\nMultiChat: !!! THE GAME HAS BEEN LOST! !!!")
+    print("MultiChat: Days since last incident: 0\n")
+    you_lost = state.active_user + " has unleashed an infohazard!\n"
+    state.write(you_lost, state.active_user, "emote")
+
+register_phrases(["the game"], the_game_command)
+
+# Eyes emoji
+def eyes_command(state, message):
+    eyes = """
                        wWWWWWWWww.
-                    WWW'''::::::''WWw 
-                wWWW" .,wWWWWWWw..  WWw. 
+                    WWW'''::::::''WWw
+                wWWW" .,wWWWWWWw..  WWw.
       ` `      wWW'   W888888888888W  'WXX.
        . `.  wWW'   M88888i#####888"8M  'WWX.
          ` wWWW'   M88888##d###'w8oo88M   WWMX.
@@ -907,35 +3715,22 @@ def chat(user_list, log_dir, log_file, log_file_name, settings):
                       MMMMMMMMMMMMMM
 
 """
-            print(preface + eyes)
-            log_file.write(preface + "Eyes emoji\n")
-
-        # Beetlejuice
-        elif "beetlejuice" in chat_message.lower():
-            print("Say it again!")
-            log_file.write(preface + chat_message)
-
-        # Not an easter egg, too lazy to move it
-        # Allows for not saving a message upon request
-        elif "/nolog" in chat_message:
-            if chat_message.removeprefix("/nolog") == " help": 
-                print("-------------")
-                print("/nolog: hide a single message from the chatlog.")
-                print("The following message will not be saved in any chatlogs or records (not even with /quote).")
-                print("Useful if you want to make sure something isn't saved in your records.")
-                print("WARNING: the message is really, truly gone once MultiChat closes!")
-                print("Don't use this for any messages that you want to read later.")
-                print("-------------")
-            else:
-                print("/nolog: The next message will not be saved in the chatlog.")
-                # Set up message preface (used to identify messages)
-                preface = colored(active_user + ", " + current_time + ": ", "dark_grey")
-                # Get chat message.
-                chat_message = input(preface)
-                print("/nolog: Back to normal logging.")
-
-        elif chat_message.lower() == "thumbsupper":
-            emote = """
+    print(state.preface + eyes)
+    state.write(state.preface + "Eyes emoji\n", state.active_user, "emote")
+
+register_phrases(["eyes"], eyes_command)
+
+# Beetlejuice
+def beetlejuice_command(state, message):
+    print("Say it again!")
+    state.write(state.preface + message + "\n", state.active_user)
+
+register_trigger("beetlejuice", beetlejuice_command)
+# /nolog works anywhere in a message, not just at the start
+register_trigger("/nolog", nolog_command)
+
+def thumbsupper_command(state, message):
+    emote = """
 ´´´´´´´´´´´´´´´´´´´´´´@@@@@@@@@
 ´´´´´´´´´´´´´´´´´´´´@@´´´´´´´´´´@@
 ´´´´´´@@@@@´´´´´´´@@´´´´´´´´´´´´´´@@
@@ -953,33 +3748,291 @@ def chat(user_list, log_dir, log_file, log_file_name, settings):
 ´´@@´´´´´´´´´´´@´´@@´´´´´´´´´´´´´´´´@@
 ´´´@@@@@@@@@@@@´´´´´@@´´´´´´´´´´´´@@
 ´´´´´´´´´´´´´´´´´´´´´´´@@@@@@@@@@@"""
-            print(preface + emote + "\n")
-            log_file.write(preface + emote + "\n") 
-
-        elif "thumbsup" in chat_message.lower():
-            print(preface + "👍")
-            log_file.write(preface + "👍" + "\n") 
-
-        # Done with easter eggs, back to regular code.
-        # If there are no special cases, try to append the
-        # new message to the log file. Report and handle
-        # errors if this doesn't succeed, and notify the
-        # user that their message may not have saved.
-        elif chat_message != "":
-            try:
-                # Append to file.
-                log_file.write(preface + chat_message + "\n")
-            except PermissionError:
-                print("Cannot save to file: permission denied. Do you have permission to write to your log save location?")
-                change_loc = input("Would you like to change your log save location? y/n: ")
-                if change_loc.casefold() == "y":
-                    pass
-            except Exception as error:
-                print("Error:", error)
-                print("Your message may not have been saved.")
+    print(state.preface + emote + "\n")
+    state.write(state.preface + emote + "\n", state.active_user, "emote")
+
+register_phrases(["thumbsupper"], thumbsupper_command)
+
+def thumbsup_command(state, message):
+    print(state.preface + "👍")
+    state.write(state.preface + "👍" + "\n", state.active_user, "emote")
+
+register_trigger("thumbsup", thumbsup_command)
+
+# HEADLESS INGEST
+# Load a whole transcript into a chat without going through the prompt:
+#     python multiChat.py --ingest transcript.tsv --chat mychat
+#     some-script | python multiChat.py --ingest - --chat mychat
+# Each line is "proxy<TAB>message". The proxy switches users the same way
+# typing it in chat would, and a line without a tab is sent by whoever
+# spoke last. Proxies nobody has yet become new users named after them.
+# Messages are logged as they are, so commands like /dice aren't run.
+# Lines are written out in batches, and only one batch is held at a time.
+INGEST_BATCH_MESSAGES = 1000
+
+def ingest(stream, user_list, log_file, settings, batch_messages=INGEST_BATCH_MESSAGES, storage=None):
+    log_writer = make_log_writer(log_file, settings)
+    case_sensitivity = settings["case_sensitive_proxies"]
+    time_format = settings["timestamp_format"]
+    # Same setup as a chat session: archive, then add a date marker
+    chat_claim = claim_chat(log_file.name)
+    if chat_claim is not None:
+        archive_log_if_due(log_file, settings["log_archive_compression"])
+    log_file.seek(0, os.SEEK_END)
+    session_index = load_session_index(log_file.name)
+    today = date.today()
+    log_writer.flush()
+    chat_name = os.path.basename(log_file.name).removesuffix(".txt")
+    if storage is not None:
+        storage.open_chat(chat_name, log_file.name)
+    session_offset = write_ingest_batch(log_writer, ["-----" + today.strftime(SESSION_DATE_FORMAT) + "-----\n\n"], [(None, None)], None, storage, chat_name)
+    add_session(session_index, log_file.name, today.isoformat(), session_offset)
+    log_writer.flush()
+    structured_log = open_structured_log(log_file.name) if settings["structured_log"] else None
+
+    active = user_list.first() if len(user_list) else None
+    # Prefaces only change when the time does, so reuse them until then
+    prefaces = {}
+    last_time = None
+    batch = []
+    # Who sent each message in the batch, and when
+    senders = []
+    message_count = 0
+    for line_number, line in enumerate(stream, 1):
+        proxy, separator, message = line.rstrip("\r\n").partition("\t")
+        if not separator:
+            proxy, message = "", proxy
+        if proxy:
+            switch_user = user_list.find_switch(proxy, case_sensitivity)
+            if switch_user is None:
+                switch_user = user_list.add(proxy, proxy)
+            active = switch_user
+        if message == "":
+            continue
+        if active is None:
+            print(f"Line {line_number}: no proxy given and nobody has spoken yet; skipped.")
+            continue
+        now = datetime.now()
+        current_time = now.strftime(time_format)
+        if current_time != last_time:
+            prefaces.clear()
+            last_time = current_time
+        preface = prefaces.get(active)
+        if preface is None:
+            username, color, chat_message = switch(active)
+            preface = prefaces[active] = make_preface(username, color, current_time, settings)
+        batch.append(preface + message + "\n")
+        senders.append((active, now))
+        message_count += 1
+        if len(batch) >= batch_messages:
+            write_ingest_batch(log_writer, batch, senders, structured_log, storage, chat_name)
+            batch.clear()
+            senders.clear()
+    batch.append("\n\n")
+    senders.append((None, None))
+    write_ingest_batch(log_writer, batch, senders, structured_log, storage, chat_name)
+    log_writer.finish()
+    close_structured_log(structured_log)
+    # The search index catches up on the next /search
+    new_sessions, session_index["size"] = scan_sessions(log_file.name, session_index["size"])
+    session_index["sessions"].extend(new_sessions)
+    save_session_index(session_index, log_file.name)
+    release_chat(chat_claim)
+    return message_count
+
+# Write a batch of ingested messages to the log in one go, then record
+# them in the structured log and storage from wherever the batch ended
+# up, which is only known once it's written if another MultiChat is
+# writing to the same log. Returns the offset the batch starts at.
+def write_ingest_batch(log_writer, batch, senders, structured_log, storage, chat_name):
+    batch_offset = offset = log_writer.write("".join(batch))
+    for text, (user, now) in zip(batch, senders):
+        structured_log_write(structured_log, log_writer.log_file, text, user, "message", now, offset)
+        if storage is not None:
+            storage.add_text(chat_name, text, user, "message", now, offset)
+        offset += len(text.replace("\n", os.linesep).encode(log_writer.encoding, errors="replace"))
+    if structured_log is not None:
+        structured_log["file"].flush()
+    if storage is not None:
+        storage.commit()
+    return batch_offset
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(description="Chat as multiple users and log it.")
+    parser.add_argument("--ingest", metavar="FILE", help='load "proxy<TAB>message" lines from FILE (or - for stdin) into a chat without prompting, then exit')
+    parser.add_argument("--backfill-jsonl", action="store_true", help="rebuild the structured JSON Lines log for a chat from its plaintext log, then exit")
+    parser.add_argument("--rebuild-stats", action="store_true", help="recount the /stats totals for a chat from its log, then exit")
+    parser.add_argument("--export", choices=list(EXPORT_FORMATS), help="save a chat as a web page (html) or Markdown (md), then exit")
+    parser.add_argument("--output", metavar="FILE", help="where to --export to (default: next to the chat log)")
+    parser.add_argument("--import-sqlite", action="store_true", help=f"copy every chat log, the saved users and quotes.txt into {SQLITE_DATABASE_NAME}, then exit")
+    parser.add_argument("--export-sqlite", metavar="DIR", help=f"write the chats, users and quotes in {SQLITE_DATABASE_NAME} out as plaintext files in DIR, then exit")
+    parser.add_argument("--searchall", metavar="WORDS", help="find messages containing all of WORDS (and @name to pick a user) in every chat, then exit")
+    parser.add_argument("--logs", action="store_true", help="list every chat with its size, sessions, messages, last activity and participants, then exit")
+    parser.add_argument("--chat", default="chat", help="name of the chat to use with the options above (default: chat)")
+    parser.add_argument("--profile", nargs="?", const="multichat.prof", metavar="FILE", help="time everything MultiChat does, then save a cProfile report to FILE (default: multichat.prof) and print a summary when it exits")
+    return parser.parse_args()
+
+# Ingest a transcript as the saved users (see /save)
+def main_ingest(arguments):
+    import sys
+    settings = retrieve_settings()
+    log_dir = settings["savedir"]
+    make_dir_exist(log_dir)
+    storage = open_storage(settings)
+    user_list = storage.load_users(False)
+    log_file = open_log(log_dir, arguments.chat)
+    start = time.perf_counter()
+    try:
+        if arguments.ingest == "-":
+            message_count = ingest(sys.stdin, user_list, log_file, settings, storage=storage)
+        else:
+            with open(arguments.ingest, "r", encoding="utf-8", errors="replace") as stream:
+                message_count = ingest(stream, user_list, log_file, settings, storage=storage)
+    finally:
+        log_file.close()
+        storage.close()
+    elapsed = time.perf_counter() - start
+    print(f"Ingested {message_count} messages in {elapsed:.2f} s ({message_count / max(elapsed, 1e-9):,.0f} messages/s).")
+
+# Rebuild a chat's structured log, using the saved users for proxies
+def main_backfill(arguments):
+    settings = retrieve_settings()
+    log_path = settings["savedir"] + "/" + arguments.chat + ".txt"
+    if not os.path.isfile(log_path):
+        print(f"No chat log found at {log_path}.")
+        raise SystemExit(1)
+    user_list = open_storage(settings).load_users(False)
+    record_count = backfill_structured_log(log_path, user_list, settings["timestamp_format"])
+    print(f"Wrote {record_count} records to {structured_log_path(log_path)}.")
+
+# Recount a chat's stats from scratch
+def main_rebuild_stats(arguments):
+    settings = retrieve_settings()
+    log_path = settings["savedir"] + "/" + arguments.chat + ".txt"
+    if not os.path.isfile(log_path):
+        print(f"No chat log found at {log_path}.")
+        raise SystemExit(1)
+    stats = new_stats()
+    catch_up_stats(stats, log_path, settings["timestamp_format"])
+    save_stats(stats, log_path)
+    print(f"Counted {sum(user_stats['messages'] for user_stats in stats['users'].values())} messages from {len(stats['users'])} users in {log_path}.")
+
+# Export a chat, using the saved users' colors
+def main_export(arguments):
+    settings = retrieve_settings()
+    log_path = settings["savedir"] + "/" + arguments.chat + ".txt"
+    if not os.path.isfile(log_path):
+        print(f"No chat log found at {log_path}.")
+        raise SystemExit(1)
+    output_path = arguments.output or log_path.removesuffix(".txt") + EXPORT_FORMATS[arguments.export]
+    export_log(log_path, output_path, arguments.export, open_storage(settings).load_users(False))
+    print(f"Chat exported to {output_path}")
+
+# Copy everything in the chatlog folder into the SQLite database
+def main_import_sqlite(arguments):
+    settings = retrieve_settings()
+    log_dir = settings["savedir"]
+    make_dir_exist(log_dir)
+    storage = SQLiteStorage(log_dir, settings["log_durability"])
+    start = time.perf_counter()
+    try:
+        line_count = import_into_sqlite(storage, log_dir, load_users(False), settings["timestamp_format"])
+    finally:
+        storage.close()
+    print(f"Imported {line_count} lines into {storage.path} in {time.perf_counter() - start:.2f} s.")
+    if settings["storage_backend"] != "sqlite":
+        print("To use it, set storage to sqlite in /settings.")
+
+# Write the SQLite database back out as plaintext
+def main_export_sqlite(arguments):
+    settings = retrieve_settings()
+    database_path = settings["savedir"] + "/" + SQLITE_DATABASE_NAME
+    if not os.path.isfile(database_path):
+        print(f"No database found at {database_path}.")
+        raise SystemExit(1)
+    storage = SQLiteStorage(settings["savedir"], settings["log_durability"])
+    try:
+        chat_names = export_from_sqlite(storage, arguments.export_sqlite)
+    finally:
+        storage.close()
+    print(f"Exported {len(chat_names)} chats, saved-users.pkl and quotes.txt to {arguments.export_sqlite}")
+
+# List every chat in the chatlog folder
+def main_logs(arguments):
+    settings = retrieve_settings()
+    if not os.path.isdir(settings["savedir"]):
+        print(f"No chatlog folder found at {settings['savedir']}.")
+        raise SystemExit(1)
+    print_catalog(build_catalog(settings["savedir"], settings["timestamp_format"]))
+
+# Search every chat in the chatlog folder
+def main_searchall(arguments):
+    settings = retrieve_settings()
+    if not os.path.isdir(settings["savedir"]):
+        print(f"No chatlog folder found at {settings['savedir']}.")
+        raise SystemExit(1)
+    match_count, matches = search_all_chats(settings["savedir"], arguments.searchall, settings["timestamp_format"])
+    for when, chat_name, line in matches:
+        print(f"[{chat_name}] " + ANSI_ESCAPE.sub("", line))
+    if match_count > len(matches):
+        print(f"Showing the newest {len(matches)} of {match_count} matches.")
+    else:
+        print(f"{match_count} matches.")
+
+# Run MultiChat under cProfile, with /perf timing on, and report on exit
+def main_profile(arguments):
+    global PERF
+    import cProfile
+    import pstats
+    # Resolved now, since MultiChat moves into the log directory
+    profile_path = os.path.abspath(os.path.expanduser(arguments.profile))
+    PERF = PerfStats()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, arguments)
+    finally:
+        profiler.dump_stats(profile_path)
+        print(f"MultiChat: Profile saved to {profile_path}")
+        # The background writer thread isn't profiled; its time shows up in /perf
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+        if PERF is not None and PERF.steps:
+            PERF.print_summary()
 
 # Set up main function
 def main():
+    arguments = parse_arguments()
+    if arguments.profile is not None:
+        main_profile(arguments)
+    else:
+        run(arguments)
+
+def run(arguments):
+    if arguments.ingest is not None:
+        main_ingest(arguments)
+        return
+    if arguments.backfill_jsonl:
+        main_backfill(arguments)
+        return
+    if arguments.rebuild_stats:
+        main_rebuild_stats(arguments)
+        return
+    if arguments.export is not None:
+        main_export(arguments)
+        return
+    if arguments.import_sqlite:
+        main_import_sqlite(arguments)
+        return
+    if arguments.export_sqlite is not None:
+        main_export_sqlite(arguments)
+        return
+    if arguments.logs:
+        main_logs(arguments)
+        return
+    if arguments.searchall is not None:
+        main_searchall(arguments)
+        return
+    preload_chat_modules()
     # Get user settings, including log directory location
     settings = retrieve_settings()
     # Set up a log directory
@@ -993,7 +4046,9 @@ def main():
         print("Error code:", error)
 
     # Get user names and the file to log to.
-    user_list = get_users()
+    storage = open_storage(settings)
+    user_list = get_users(storage)
+    storage.close()
     log_file, log_file_name = get_log_file(log_dir)
     # Chat and log to file.
     chat(user_list, log_dir, log_file, log_file_name, settings)
@@ -1001,9 +4056,17 @@ def main():
     log_file.close()
 
 # Run main function
-try:
-    main()
-except KeyboardInterrupt:
-    clear()
-    log_file.write("\n\n")
-    print("Quitting.")
+if __name__ == "__main__":
+    # In the PyInstaller executables, /searchall's worker processes start
+    # by running this program again; this makes them do their search
+    # instead. Only imported there, since it's slow to import.
+    import sys
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+    try:
+        main()
+    except KeyboardInterrupt:
+        clear()
+        log_file.write("\n\n")
+        print("Quitting.")